@@ -0,0 +1,126 @@
+"""
+Concurrency stress test of many sessions sharing one safety module through a SafetyServer.
+
+Each session plays a trajectory of the simulated shopping site, all of them at the same time.
+Afterwards the shared world model must be consistent: every edge, cached verdict and
+session effective state refers to a node of the graph, and no action is cached as both safe and unsafe.
+Exits with a non-zero status if an inconsistency is found.
+
+Usage:
+PYTHONPATH=.:src python src/benchmarks/concurrency_stress.py --num_sessions 200 --max_workers 32
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import sys
+import time
+
+from config import get_config
+from environments.trajectories import generate_trajectories
+from environments.web_env import webarena_actions
+from reasoning.element_prescreen import ElementPrescreen
+from safety_module import SafetyModule
+from reasoning.local_backend import get_local_client
+from reasoning.single_flight import single_flight
+from safety_server import SafetyServer
+from utils.observation_diff import ObservationDiffer
+
+
+async def run_session(server, trajectory):
+    """
+    Play a trajectory in its own session, one check at a time.
+
+    Returns:
+        Tuple: The identifier of the episode, and the number of checks.
+    """
+    episode = server.open_session()
+    differ = ObservationDiffer()
+    checks = 0
+    for step in trajectory['steps']:
+        checks += 1
+        is_safe = await server.check(episode, step['observation'], dict(step['action']), differ.diff(step['observation']))
+        if not is_safe:
+            break
+    return episode, checks
+
+
+async def run_sessions(server, trajectories):
+    return await asyncio.gather(*(run_session(server, trajectory) for trajectory in trajectories))
+
+
+def main(args):
+    config = get_config('webarena_shopping')
+    trajectories = list(generate_trajectories(args.num_sessions, seed=args.seed, adversarial_ratio=args.adversarial_ratio))
+    safety_module = SafetyModule(
+        action_space=webarena_actions, prescreen=ElementPrescreen(), model_name=args.model_name, deadline=args.deadline,
+        local_model_url=args.local_model_url, local_parallel=args.local_parallel,
+        graph_maintenance_interval=args.graph_maintenance_interval, graph_maintenance_window=args.graph_maintenance_window, **config
+    )
+    server = SafetyServer(safety_module, max_workers=args.max_workers)
+
+    start = time.perf_counter()
+    # The safety module prints its progress, which would dominate the output
+    with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO()):
+        safety_module.analyze_core_variability(config['core_variables'], config['task'])
+        results = asyncio.run(run_sessions(server, trajectories))
+        sessions = dict(server.sessions)
+        server.shutdown()
+    elapsed = time.perf_counter() - start
+
+    world_model = safety_module.world_model
+    problems = world_model.check_consistency()
+    graph = world_model.graph_db.graph
+    for episode, session in sessions.items():
+        # Sessions idle for longer than the graph maintenance window may be in pruned states, which they leave
+        # from the initial state, so only the states they were merged into must be in the graph
+        if session.effective_state in world_model.state_aliases and world_model.resolve_state(session.effective_state) not in graph:
+            problems.append(f"Session {episode} is in effective state {session.effective_state}, merged into a state not in the graph")
+        elif not args.graph_maintenance_interval and session.effective_state not in graph:
+            problems.append(f"Session {episode} is in effective state {session.effective_state}, which is not in the graph")
+    total_checks = sum(checks for _, checks in results)
+    if safety_module.get_deadline_metrics()['calls'] != total_checks:
+        problems.append(f"{total_checks} checks were made, but {safety_module.get_deadline_metrics()['calls']} were counted")
+    unknown_episodes = set(safety_module.audit_log.episodes()) - set(sessions)
+    if unknown_episodes:
+        problems.append(f"Audit records of unknown episodes: {sorted(unknown_episodes)}")
+
+    print(f"{len(results)} sessions, {total_checks} checks in {elapsed:.1f} s ({total_checks / elapsed:.1f} checks/s) "
+          f"with {args.max_workers} workers")
+    print(f"Shared world model: {graph.number_of_nodes()} nodes, {graph.number_of_edges()} edges, "
+          f"{len(world_model.cache)} safe and {len(world_model.unsafe_cache)} unsafe cached verdicts")
+    print(f"Single-flight LM requests: {single_flight.summary()}")
+    if args.graph_maintenance_interval:
+        print(f"Graph maintenance: {safety_module.graph_maintainer.stats}")
+    if args.local_model_url:
+        print(f"Local model: {get_local_client(args.local_model_url).get_stats()}")
+    if problems:
+        print(f"{len(problems)} inconsistencies:")
+        for problem in problems:
+            print(f"    {problem}")
+        sys.exit(1)
+    print("World model is consistent.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stress test many concurrent sessions sharing one safety module.")
+
+    parser.add_argument("--model_name", type=str, default="gpt-4o-mini-2024-07-18")
+    parser.add_argument('--num_sessions', type=int, default=200)
+    parser.add_argument('--max_workers', type=int, default=32)
+    parser.add_argument('--adversarial_ratio', type=float, default=0.3)
+    parser.add_argument('--deadline', type=float, default=None)
+    parser.add_argument('--local_model_url', type=str, default=None, help='URL of a local llama.cpp server to reason with.')
+    parser.add_argument('--local_parallel', type=int, default=8)
+    parser.add_argument('--graph_maintenance_interval', type=float, default=None,
+                        help='Seconds between graph maintenance passes, which run concurrently with the sessions.')
+    parser.add_argument('--graph_maintenance_window', type=float, default=3600.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument('--lm_cache_dir', type=str, default='./lm_cache')
+    args = parser.parse_args()
+
+    from cognitive_base.utils import lm_cache_init
+
+    lm_cache_init(args.lm_cache_dir)
+    main(args)
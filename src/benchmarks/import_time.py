@@ -0,0 +1,123 @@
+"""
+Cold start benchmark for short-lived guardrail processes.
+
+Measures the import time of the guardrail modules with `python -X importtime`, and the
+wall time from process start to the first verdict of a setting. Exits with a non-zero
+status if a target is missed, so it can gate changes which add import-time work.
+
+Usage:
+PYTHONPATH=.:src python src/benchmarks/import_time.py --setting_name webarena_shopping
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_DIR = os.path.dirname(SRC_DIR)
+
+first_verdict_script = """
+import sys
+from cognitive_base.utils import lm_cache_init
+from config import get_config
+from safety_module import SafetyModule
+import importlib
+
+lm_cache_init({lm_cache_dir!r})
+config = get_config({setting_name!r})
+env_cls = getattr(importlib.import_module(config['environment']), config['env_class'])
+environment = env_cls(**config)
+safety_module = SafetyModule(action_space=environment.action_space, model_name={model_name!r}, **config)
+safety_module.analyze_core_variability(config['core_variables'], config['task'])
+observation, reward, done, info = environment.reset()
+is_safe = safety_module.is_action_safe(observation, dict(config['scripted_actions'][0]))
+sys.stderr.write(f"VERDICT {{is_safe}}\\n")
+"""
+
+
+def _run(args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([REPO_DIR, SRC_DIR, env.get('PYTHONPATH', '')])
+    return subprocess.run(args, env=env, cwd=REPO_DIR, capture_output=True, text=True)
+
+
+def measure_import_time(module):
+    """
+    Measure the import time of a module in a fresh interpreter.
+
+    Args:
+        module (str): The module to import, e.g. 'safety_module'.
+
+    Returns:
+        Tuple[float, List[Tuple[float, str]]]: The cumulative import time of the module in ms,
+            and the (self time in ms, module name) of every module imported along with it, heaviest first.
+    """
+    result = _run([sys.executable, '-X', 'importtime', '-c', f'import {module}'])
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to import {module}:\n{result.stderr}")
+
+    cumulative_ms = 0.0
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append((int(self_us) / 1000, name.strip()))
+        if name.strip() == module:
+            cumulative_ms = int(cumulative_us) / 1000
+    imports.sort(reverse=True)
+    return cumulative_ms, imports
+
+
+def measure_time_to_first_verdict(setting_name, model_name, lm_cache_dir):
+    """
+    Measure the wall time from starting a guardrail process to its first verdict.
+    With a warm LM cache this is dominated by imports and setup rather than LM latency.
+
+    Returns:
+        float: The time to first verdict in seconds.
+    """
+    script = first_verdict_script.format(setting_name=setting_name, model_name=model_name, lm_cache_dir=lm_cache_dir)
+    start = time.perf_counter()
+    result = _run([sys.executable, '-c', script])
+    elapsed = time.perf_counter() - start
+    if 'VERDICT' not in result.stderr:
+        raise RuntimeError(f"Guardrail process did not reach a verdict:\n{result.stderr}")
+    return elapsed
+
+
+def main(args):
+    failed = False
+    for module in args.modules:
+        cumulative_ms, imports = measure_import_time(module)
+        status = 'OK' if cumulative_ms <= args.target_import_ms else 'OVER TARGET'
+        failed |= cumulative_ms > args.target_import_ms
+        print(f"import {module}: {cumulative_ms:.1f} ms (target {args.target_import_ms} ms) {status}")
+        for self_ms, name in imports[:args.top]:
+            print(f"    {self_ms:8.1f} ms  {name}")
+
+    if not args.skip_first_verdict:
+        elapsed = measure_time_to_first_verdict(args.setting_name, args.model_name, args.lm_cache_dir)
+        status = 'OK' if elapsed <= args.target_first_verdict_s else 'OVER TARGET'
+        failed |= elapsed > args.target_first_verdict_s
+        print(f"time to first verdict ({args.setting_name}): {elapsed:.2f} s (target {args.target_first_verdict_s} s) {status}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the cold start of the guardrail.")
+
+    parser.add_argument('--modules', nargs='+', default=['main', 'safety_module'])
+    parser.add_argument('--top', type=int, default=10, help='Number of heaviest imports to show per module.')
+    parser.add_argument('--target_import_ms', type=float, default=100.0)
+    parser.add_argument('--target_first_verdict_s', type=float, default=3.0,
+                        help='Target time to first verdict, assuming a warm LM cache.')
+    parser.add_argument('--skip_first_verdict', action='store_true', help='Only measure import times.')
+    parser.add_argument('--setting_name', type=str, default="webarena_shopping")
+    parser.add_argument("--model_name", type=str, default="gpt-4o-mini-2024-07-18")
+    parser.add_argument('--lm_cache_dir', type=str, default='./lm_cache')
+    args = parser.parse_args()
+
+    main(args)
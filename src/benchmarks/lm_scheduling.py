@@ -0,0 +1,94 @@
+"""
+Latency of blocking LM calls while background work floods a rate-limited provider, with and without priorities.
+
+A stand-in provider answers each call after a fixed latency, behind the request and token rate limits of the
+scheduler. Background workers issue calls back to back, as graph learning does under load, while blocking
+calls arrive at a steady rate. Without priorities, every call is scheduled as blocking, i.e. first come first served.
+No model is needed.
+
+Usage:
+PYTHONPATH=.:src python src/benchmarks/lm_scheduling.py --requests_per_minute 600 --duration 10
+"""
+import argparse
+import threading
+import time
+
+from reasoning.scheduler import lm_priority, lm_scheduler
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def call(tokens, latency):
+    with lm_scheduler.slot(tokens):
+        time.sleep(latency)
+
+
+def background_worker(stop, args, priority):
+    with lm_priority(priority):
+        while not stop.is_set():
+            call(args.background_tokens, args.latency)
+
+
+def run(args, prioritized):
+    lm_scheduler.configure(args.requests_per_minute, args.tokens_per_minute, args.max_concurrency)
+    stop = threading.Event()
+    workers = [
+        threading.Thread(target=background_worker, args=(stop, args, 'background' if prioritized else 'blocking'))
+        for _ in range(args.background_workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    latencies = []
+    lock = threading.Lock()
+
+    def blocking_call():
+        start = time.perf_counter()
+        call(args.blocking_tokens, args.latency)
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    callers = []
+    end = time.monotonic() + args.duration
+    while time.monotonic() < end:
+        caller = threading.Thread(target=blocking_call)
+        caller.start()
+        callers.append(caller)
+        time.sleep(1 / args.blocking_rate)
+    for caller in callers:
+        caller.join()
+    stop.set()
+    for worker in workers:
+        worker.join()
+    summary = lm_scheduler.summary()
+    lm_scheduler.reset_stats()
+    return latencies, summary
+
+
+def main(args):
+    for prioritized in (False, True):
+        latencies, summary = run(args, prioritized)
+        background_calls = summary['background']['calls'] if prioritized else summary['blocking']['calls'] - len(latencies)
+        print(f"{'Prioritized' if prioritized else 'First come first served'}: {len(latencies)} blocking calls, "
+              f"p50 {percentile(latencies, 0.5) * 1000:.0f} ms, p99 {percentile(latencies, 0.99) * 1000:.0f} ms; "
+              f"{background_calls} background calls")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare blocking call latency with and without LM call priorities.")
+
+    parser.add_argument('--requests_per_minute', type=int, default=600)
+    parser.add_argument('--tokens_per_minute', type=int, default=None)
+    parser.add_argument('--max_concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds the stand-in provider takes to answer a call.')
+    parser.add_argument('--background_workers', type=int, default=16)
+    parser.add_argument('--background_tokens', type=int, default=1500)
+    parser.add_argument('--blocking_rate', type=float, default=2.0, help='Blocking calls per second.')
+    parser.add_argument('--blocking_tokens', type=int, default=800)
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds during which blocking calls arrive.')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,124 @@
+"""
+Load test of the safety module on procedurally generated trajectories of the simulated shopping site.
+
+Reports check latency percentiles, observation sizes, and how often each kind of trajectory is
+blocked: adversarial ones (off-site, overspending) should be, benign ones should not.
+The checked steps and their verdicts can be logged with --trajectory_log, e.g. to re-score them later
+against an updated world model with `src/rescore.py`. With --compress_observations, steps only hold the
+fingerprint of their observation, and the observations are stored next to the log, compressed with a
+dictionary trained on the site's pages.
+
+Usage:
+PYTHONPATH=.:src python src/benchmarks/load_test.py --num_trajectories 50 --model_name gpt-4o-mini-2024-07-18
+"""
+import argparse
+import contextlib
+import io
+import json
+import time
+from collections import Counter, defaultdict
+
+from config import get_config
+from environments.trajectories import generate_trajectories
+from environments.web_env import webarena_actions
+from reasoning.element_prescreen import ElementPrescreen
+from safety_module import SafetyModule
+from utils.observation_diff import ObservationDiffer, format_delta
+from utils.observation_store import ObservationStore, observations_path
+from utils.profiling import get_profile_dir, profile_dir_env_var, profiler
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def main(args):
+    config = get_config('webarena_shopping')
+    latencies = []
+    observation_sizes = []
+    delta_sizes = []
+    blocked = Counter()
+    totals = Counter()
+    checks_by_kind = defaultdict(int)
+    profile_dir = get_profile_dir(args.profile)
+    if profile_dir:
+        profiler.start(overhead_budget=args.overhead_budget / 1000)
+
+    trajectory_log = open(args.trajectory_log, 'w') if args.trajectory_log else None
+    observation_store = ObservationStore() if args.trajectory_log and args.compress_observations else None
+
+    start = time.perf_counter()
+    for episode, trajectory in enumerate(generate_trajectories(args.num_trajectories, seed=args.seed, adversarial_ratio=args.adversarial_ratio)):
+        safety_module = SafetyModule(action_space=webarena_actions, prescreen=ElementPrescreen(), model_name=args.model_name, **config)
+        # The safety module prints its progress, which would dominate the output of a load test
+        with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO()):
+            safety_module.analyze_core_variability(config['core_variables'], config['task'])
+            totals[trajectory['kind']] += 1
+            differ = ObservationDiffer()
+            checked_steps = []
+            for step in trajectory['steps']:
+                observation_delta = differ.diff(step['observation'])
+                observation_sizes.append(len(step['observation']))
+                delta_sizes.append(len(step['observation']) if observation_delta['is_full'] else len(format_delta(observation_delta)))
+                check_start = time.perf_counter()
+                is_safe = safety_module.is_action_safe(step['observation'], dict(step['action']), observation_delta=observation_delta)
+                latencies.append(time.perf_counter() - check_start)
+                checks_by_kind[trajectory['kind']] += 1
+                if observation_store is not None:
+                    checked_steps.append({'fingerprint': observation_store.put(step['observation'], observation_delta['fingerprint']),
+                                          'action': step['action'], 'is_safe': is_safe})
+                else:
+                    checked_steps.append({'observation': step['observation'], 'action': step['action'], 'is_safe': is_safe})
+                if not is_safe:
+                    blocked[trajectory['kind']] += 1
+                    break
+            safety_module.shutdown()
+        if trajectory_log:
+            trajectory_log.write(json.dumps({'episode': episode, 'kind': trajectory['kind'], 'steps': checked_steps}) + '\n')
+    elapsed = time.perf_counter() - start
+    if trajectory_log:
+        trajectory_log.close()
+    if observation_store is not None:
+        observation_store.save(observations_path(args.trajectory_log))
+    if profile_dir:
+        profiler.stop()
+        profiler.dump(profile_dir)
+
+    print(f"{args.num_trajectories} trajectories, {len(latencies)} checks in {elapsed:.1f} s ({len(latencies) / elapsed:.1f} checks/s)")
+    print(f"Check latency: p50 {percentile(latencies, 0.5) * 1000:.0f} ms, "
+          f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms, p99 {percentile(latencies, 0.99) * 1000:.0f} ms")
+    print(f"Observation size: mean {sum(observation_sizes) / len(observation_sizes):.0f} chars, max {max(observation_sizes)} chars")
+    print(f"Observation delta size: mean {sum(delta_sizes) / len(delta_sizes):.0f} chars")
+    for kind, total in sorted(totals.items()):
+        print(f"    {kind}: {blocked[kind]}/{total} trajectories blocked, {checks_by_kind[kind]} checks")
+    if observation_store is not None:
+        print(f"Observation store: {observation_store.summary()}")
+    if profile_dir:
+        profiler.print_summary()
+        print(f"Profile written to {profile_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the safety module on simulated shopping trajectories.")
+
+    parser.add_argument("--model_name", type=str, default="gpt-4o-mini-2024-07-18")
+    parser.add_argument('--num_trajectories', type=int, default=50)
+    parser.add_argument('--adversarial_ratio', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument('--profile', type=str, default=None,
+                        help=f'Directory to write a profile of the safety checks to. Also enabled by the {profile_dir_env_var} environment variable.')
+    parser.add_argument('--overhead_budget', type=float, default=50,
+                        help='Budget in milliseconds of the time spent per safety check outside of LM calls.')
+    parser.add_argument('--trajectory_log', type=str, default=None,
+                        help='JSON lines file to log the checked steps and their verdicts to, for re-scoring with src/rescore.py.')
+    parser.add_argument('--compress_observations', action='store_true',
+                        help='Store the observations of the trajectory log compressed next to it, rather than in the log.')
+    parser.add_argument('--lm_cache_dir', type=str, default='./lm_cache')
+    args = parser.parse_args()
+
+    from cognitive_base.utils import lm_cache_init
+
+    lm_cache_init(args.lm_cache_dir)
+    main(args)
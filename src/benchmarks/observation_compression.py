@@ -0,0 +1,75 @@
+"""
+Benchmark of compressed observation storage on pages of the simulated shopping site.
+
+The dictionary is trained on the pages of some trajectories, and evaluated on the pages of others (another seed),
+as when a store is trained on the first pages an environment serves. Reports bytes per observation, and the time
+per step spent compressing and decompressing, for each codec: zlib without a dictionary, zlib with a preset
+dictionary, and zstd with a trained dictionary if the `zstandard` package is installed.
+
+Usage:
+PYTHONPATH=.:src python src/benchmarks/observation_compression.py --num_trajectories 50
+"""
+import argparse
+import time
+
+from environments.trajectories import generate_trajectories
+from utils.observation_store import ZLIB, ZSTD, ObservationStore, zstd_available
+
+
+def pages(num_trajectories, seed):
+    return list(dict.fromkeys(
+        step['observation'] for trajectory in generate_trajectories(num_trajectories, seed=seed) for step in trajectory['steps']
+    ))
+
+
+def run(store, training_pages, test_pages):
+    if training_pages:
+        store.train(training_pages)
+    start = time.perf_counter()
+    fingerprints = [store.put(page) for page in test_pages]
+    compress_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for fingerprint in fingerprints:
+        store.decompress(store.blobs[fingerprint])
+    decompress_seconds = time.perf_counter() - start
+    return {
+        'bytes': sum(len(store.blobs[fingerprint]) for fingerprint in fingerprints) / len(fingerprints),
+        'compress_us': compress_seconds / len(fingerprints) * 1e6,
+        'decompress_us': decompress_seconds / len(fingerprints) * 1e6,
+        'dictionary_bytes': len(store.dictionary or b''),
+    }
+
+
+def main(args):
+    training_pages = pages(args.num_trajectories, args.seed)
+    test_pages = pages(args.num_trajectories, args.seed + 1)
+    raw_bytes = sum(len(page.encode()) for page in test_pages) / len(test_pages)
+    print(f"{len(training_pages)} training pages, {len(test_pages)} test pages, mean {raw_bytes:.0f} bytes per observation")
+
+    configurations = [
+        ('zlib', ObservationStore(codec=ZLIB, level=args.level, train_after=None), []),
+        ('zlib + dictionary', ObservationStore(codec=ZLIB, level=args.level, dict_size=args.dict_size, train_after=None), training_pages),
+    ]
+    if zstd_available():
+        configurations += [
+            ('zstd', ObservationStore(codec=ZSTD, level=args.level, train_after=None), []),
+            ('zstd + dictionary', ObservationStore(codec=ZSTD, level=args.level, dict_size=args.dict_size, train_after=None), training_pages),
+        ]
+    else:
+        print("zstandard is not installed, so only zlib is benchmarked (pip install zstandard)")
+
+    for name, store, samples in configurations:
+        result = run(store, samples, test_pages)
+        print(f"{name:>18}: {result['bytes']:7.0f} bytes per observation ({raw_bytes / result['bytes']:5.1f}x), "
+              f"compress {result['compress_us']:6.1f} us, decompress {result['decompress_us']:6.1f} us per step, "
+              f"dictionary {result['dictionary_bytes']} bytes")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark compressed observation storage on simulated shopping pages.")
+    parser.add_argument('--num_trajectories', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--level', type=int, default=3)
+    parser.add_argument('--dict_size', type=int, default=16384)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,82 @@
+"""
+Throughput benchmark of the filesystem pre-screen of the code environment, in commands screened per second.
+
+Usage:
+PYTHONPATH=.:src python src/benchmarks/prescreen_throughput.py --num_commands 100000
+"""
+import argparse
+import random
+import time
+from collections import Counter
+
+from config import get_config
+from environments.code_env import CodeEnvironment
+from reasoning.filesystem_prescreen import FilesystemPrescreen
+
+command_templates = [
+    "ls -la {dir}",
+    "cat {file} | grep {word}",
+    "head -n 20 {file}",
+    "echo {word} > {new_file}",
+    "echo {word} >> {file}",
+    "mkdir -p {dir}/{word}",
+    "touch {new_file}",
+    "rm -f {dir}/*.o",
+    "rm -rf {dir}",
+    "rm -rf *",
+    "mv {file} {new_file}",
+    "cp {file} /tmp/{word}",
+    "cd {dir} && ls",
+    "cd .. && rm -rf {word}",
+    "sed -i s/{word}/x/ {file}",
+    "find . -name '*.o' -delete",
+    "python setup.py build",
+    "make 2>&1 > /dev/null",
+    "rm -rf $HOME/{word}",
+    "echo $(whoami) > {new_file}",
+]
+words = ['alpha', 'beta', 'build', 'data', 'tmp', 'cache']
+
+
+def generate_commands(num_commands, files, dirs, seed=0):
+    rng = random.Random(seed)
+    return [
+        rng.choice(command_templates).format(
+            dir=rng.choice(dirs), file=rng.choice(files), word=rng.choice(words), new_file=f"new_{rng.randrange(1000)}.txt"
+        )
+        for _ in range(num_commands)
+    ]
+
+
+def main(args):
+    config = get_config('code_os')
+    environment = CodeEnvironment(**config)
+    environment.reset()
+    try:
+        prescreen = FilesystemPrescreen(environment.workspace, config['protected_paths'])
+        files = list(config['workspace_files'])
+        dirs = sorted({path.split('/')[0] for path in files if '/' in path})
+        commands = generate_commands(args.num_commands, files, dirs, args.seed)
+
+        verdicts = Counter()
+        start = time.perf_counter()
+        for command in commands:
+            verdict, _ = prescreen.screen_command(command)
+            verdicts[verdict] += 1
+        elapsed = time.perf_counter() - start
+    finally:
+        environment.close()
+
+    print(f"Screened {len(commands)} commands in {elapsed:.2f} s: {len(commands) / elapsed:.0f} commands/s")
+    for verdict, count in verdicts.most_common():
+        print(f"    {verdict}: {count / len(commands):.1%} of commands")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the throughput of the filesystem pre-screen.")
+
+    parser.add_argument('--num_commands', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    main(args)
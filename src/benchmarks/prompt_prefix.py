@@ -0,0 +1,147 @@
+"""
+Latency of the prompts of a safety check with a local model stand-in which reuses cached prompt prefixes.
+
+The stand-in behaves like a local server with a prompt cache (e.g. llama.cpp): each slot keeps the last
+prompt it processed, a prompt goes to the slot sharing its longest prefix if it is long enough to be worth
+reusing (otherwise to the least recently used slot), and only the rest of the prompt is prefilled. Latency is simulated from the number of prefilled tokens, so no model is needed.
+
+Two layouts of the same prompts are compared over generated shopping trajectories:
+    - registry: the system message is rendered once per task by the prompt registry, and the content
+      which changes between calls comes last
+    - unordered: the templates are rendered on every call, and the content which changes between calls
+      comes before the static content
+
+Usage:
+PYTHONPATH=.:src python src/benchmarks/prompt_prefix.py --num_trajectories 20
+"""
+import argparse
+import os
+import time
+
+from config import get_config
+from environments.trajectories import generate_trajectories
+from environments.web_env import webarena_actions
+from reasoning import action_safety, generic_reasoning
+from reasoning.prompts import prompt_registry
+from utils.helpers import format_action
+from utils.observation_diff import ObservationDiffer, format_delta
+
+
+class PrefixCachingStandIn:
+    """
+    Stand-in for a local model server which reuses the cached prefix of prompts.
+    """
+    def __init__(self, num_slots=4, min_reused_tokens=64, chars_per_token=4, prefill_time_per_token=0.0002, decode_time=0.05):
+        self.slots = [''] * num_slots  # Least recently used first
+        self.min_reused_tokens = min_reused_tokens
+        self.chars_per_token = chars_per_token
+        self.prefill_time_per_token = prefill_time_per_token
+        self.decode_time = decode_time
+        self.prompt_tokens = 0
+        self.prefilled_tokens = 0
+
+    def generate(self, prompt):
+        """
+        Process a prompt, reusing the slot which shares its longest prefix.
+
+        Returns:
+            float: The simulated latency in seconds.
+        """
+        prefixes = [len(os.path.commonprefix([slot, prompt])) for slot in self.slots]
+        slot = max(range(len(self.slots)), key=lambda i: prefixes[i])
+        reused = prefixes[slot]
+        if reused // self.chars_per_token < self.min_reused_tokens:
+            # No prefix worth reusing, so evict the least recently used slot
+            slot, reused = 0, 0
+        self.slots.pop(slot)
+        self.slots.append(prompt)
+        prefilled = (len(prompt) - reused) // self.chars_per_token
+        self.prompt_tokens += len(prompt) // self.chars_per_token
+        self.prefilled_tokens += prefilled
+        return prefilled * self.prefill_time_per_token + self.decode_time
+
+
+def prompt_calls(trajectories, config):
+    """
+    The prompts of the safety checks of each step: whether the action is within its usual range,
+    and which effective state the observation is in, from the changes to the observation when they are small.
+
+    Yields:
+        Tuple[str, dict, dict, str, str]: The name of the prompt, its static and variable fields,
+            and its system and human templates.
+    """
+    task, initial_state = config['task'], config['initial_state']
+    core_variables = ", ".join(config['core_variables'])
+    states = [initial_state]
+    state_static_vars = {
+        'task': task, 'core_variables': core_variables, 'task_intro': generic_reasoning.effective_state_task_intro,
+        'state_task': generic_reasoning.effective_state_task,
+    }
+    for trajectory in trajectories:
+        differ = ObservationDiffer()
+        for step in trajectory['steps']:
+            observation_delta = differ.diff(step['observation'])
+            action = dict(step['action'], description=webarena_actions[step['action']['function_name']]['description'])
+            yield (
+                'param_within_range', {'task': task, 'initial_state': initial_state},
+                {'usual_param_range': 'Pages of the shopping site.', 'action_details': format_action(action)},
+                action_safety.param_within_range_sys_template, action_safety.param_within_range_human_template,
+            )
+            numbered_states = "\n".join(f"{i}. {state}" for i, state in enumerate(states))
+            if observation_delta['is_full']:
+                yield (
+                    'effective_state', state_static_vars, {'numbered_states': numbered_states, 'observation': step['observation']},
+                    generic_reasoning.state_sys_template, generic_reasoning.effective_state_human_template,
+                )
+            else:
+                yield (
+                    'effective_state_delta', state_static_vars,
+                    {'previous_state': states[-1], 'numbered_states': numbered_states, 'observation_delta': format_delta(observation_delta)},
+                    generic_reasoning.state_sys_template, generic_reasoning.effective_state_delta_human_template,
+                )
+            if action['function_name'] == 'click' and len(states) < 8:
+                states.append(f"state_{len(states)}")
+
+
+def run(calls, layout):
+    stand_in = PrefixCachingStandIn()
+    render_time = 0.0
+    latency = 0.0
+    for name, static_vars, variable_vars, sys_template, human_template in calls:
+        start = time.perf_counter()
+        if layout == 'registry':
+            prompt = prompt_registry.render(name, **static_vars).system_text + human_template.format(**variable_vars)
+        else:
+            prompt = human_template.format(**variable_vars) + sys_template.format(**static_vars)
+        render_time += time.perf_counter() - start
+        latency += stand_in.generate(prompt)
+    return {
+        'render_time': render_time / len(calls),
+        'latency': latency / len(calls),
+        'prefill_ratio': stand_in.prefilled_tokens / stand_in.prompt_tokens,
+    }
+
+
+def main(args):
+    config = get_config('webarena_shopping')
+    trajectories = generate_trajectories(args.num_trajectories, seed=args.seed)
+    calls = list(prompt_calls(trajectories, config))
+
+    print(f"{len(calls)} prompts")
+    results = {layout: run(calls, layout) for layout in ('unordered', 'registry')}
+    for layout, result in results.items():
+        print(f"    {layout}: render {result['render_time'] * 1e6:.1f} us, simulated latency {result['latency'] * 1000:.1f} ms, "
+              f"{result['prefill_ratio']:.0%} of prompt tokens prefilled")
+    delta = results['unordered']['latency'] - results['registry']['latency']
+    print(f"Latency delta: {delta * 1000:.1f} ms per prompt ({delta / results['unordered']['latency']:.0%})")
+    print(f"Prompt registry: {prompt_registry.stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare prompt layouts with a prefix-caching local model stand-in.")
+
+    parser.add_argument('--num_trajectories', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    main(args)
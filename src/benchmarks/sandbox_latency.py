@@ -0,0 +1,102 @@
+"""
+Latency benchmark of the sandbox pool of the code environment.
+
+Compares commands dispatched to pre-forked workers with a new sandbox per command (namespaces set up and torn
+down for each command, as without the pool), resets which swap in a spare workspace with rewriting the initial
+files, and reports the latency of previewing a command on an overlay of the workspace.
+
+Usage:
+PYTHONPATH=.:src python src/benchmarks/sandbox_latency.py --num_commands 200
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import time
+
+from config import get_config
+from environments.sandbox_pool import SandboxPool, _sandboxed, namespaces_available
+
+commands = [
+    "ls -R",
+    "cat Makefile",
+    "echo 'Run make to build the app.' >> README.md",
+    "rm -f build/*.o",
+    "grep -r main src",
+]
+
+
+def timed(function, repeats):
+    latencies = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function(i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(0.95 * (len(latencies) - 1))]
+    print(f"{name:>32}: median {statistics.median(latencies) * 1000:7.2f} ms, p95 {p95 * 1000:7.2f} ms")
+
+
+def rewrite_workspace(workspace, files):
+    shutil.rmtree(workspace, ignore_errors=True)
+    os.makedirs(workspace)
+    for path, content in files.items():
+        full_path = os.path.join(workspace, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as f:
+            f.write(content)
+
+
+def main(args):
+    files = get_config('code_os')['workspace_files']
+    if args.num_files:
+        files = {**files, **{f"src/module_{i}.c": f"int f{i}() {{ return {i}; }}\n" * 20 for i in range(args.num_files)}}
+    isolated = namespaces_available()
+    print(f"{len(files)} workspace files, workers {'isolated in namespaces' if isolated else 'not isolated (no namespaces)'}")
+
+    pool = SandboxPool(num_workers=args.num_workers)
+    try:
+        workspace = pool.new_workspace()
+        pool.reset_workspace(workspace, files)
+
+        report('command on the pool', timed(
+            lambda i: pool.run(commands[i % len(commands)], workspace, 10), args.num_commands
+        ))
+        env = {'PATH': '/usr/local/bin:/usr/bin:/bin', 'HOME': workspace, 'LANG': 'C.UTF-8'}
+        command_line = (lambda command: _sandboxed(pool.workspaces_dir, ['bash', '-c', command])) if isolated else (lambda command: ['bash', '-c', command])
+        report('command in a new sandbox', timed(
+            lambda i: subprocess.run(command_line(commands[i % len(commands)]), cwd=workspace, env=env, capture_output=True, timeout=10),
+            args.num_commands
+        ))
+        if pool.previews_available:
+            report('preview on an overlay', timed(
+                lambda i: pool.preview(commands[i % len(commands)], workspace, 10), args.num_commands
+            ))
+
+        def reset(i):
+            pool.reset_workspace(workspace, files)
+            # Spares are prepared between episodes, while the agent works
+            time.sleep(args.episode_seconds)
+
+        latencies = timed(reset, args.num_resets)
+        report('reset from a spare', [latency - args.episode_seconds for latency in latencies])
+        report('reset by rewriting the files', timed(lambda i: rewrite_workspace(workspace, files), args.num_resets))
+        print(f"Pool stats: {dict(pool.stats)}")
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the latency of the sandbox pool of the code environment.")
+    parser.add_argument('--num_commands', type=int, default=200)
+    parser.add_argument('--num_resets', type=int, default=50)
+    parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--num_files', type=int, default=200, help='Number of source files added to the workspace of the code_os setting.')
+    parser.add_argument('--episode_seconds', type=float, default=0.02, help='Time between resets, during which spares are prepared.')
+    args = parser.parse_args()
+    main(args)
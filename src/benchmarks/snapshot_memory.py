@@ -0,0 +1,155 @@
+"""
+Memory and query latency of worker processes which each load a world model, compared with workers which
+share a memory-mapped snapshot of it.
+
+A synthetic world model with many cached verdicts and effective states is saved both as JSON and as a snapshot.
+Forked workers either deserialize the JSON into their own WorldModel, or map the snapshot through an
+OverlayWorldModel, then run the same lookups. Memory is read from /proc (Linux), while all workers are alive:
+the private memory each worker wrote to, and its proportional share of all its memory (PSS), which divides
+shared pages among the workers mapping them.
+
+Usage:
+PYTHONPATH=.:src python src/benchmarks/snapshot_memory.py --num_workers 8 --num_verdicts 200000
+"""
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from models.snapshot import OverlayWorldModel, write_snapshot
+from models.world_model import WorldModel
+from utils.helpers import observation_fingerprint
+
+
+def memory_kb():
+    """
+    Get the private dirty memory and the PSS of the current process, in kB.
+    """
+    counters = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                counters[parts[0].rstrip(':')] = int(parts[1])
+    return counters['Private_Dirty'], counters['Pss']
+
+
+def synthetic_world_model(num_states, num_verdicts, num_observations, seed):
+    rng = random.Random(seed)
+    states = [f"state_{i}" for i in range(num_states)]
+    world_model = WorldModel(states[0])
+    world_model.set_variability(['money'], ['Spending up to the price of the product'])
+    world_model.add_nodes_and_edges(
+        [{'node_id': state, 'node_type': 'state'} for state in states[1:]],
+        [{'subject': rng.choice(states), 'obj': rng.choice(states), 'relation': 'transition', 'action': 'click'}
+         for _ in range(2 * num_states)]
+        + [{'subject': state, 'obj': 'money', 'relation': 'can_spend'} for state in states[:num_states // 10]],
+    )
+    keys = []
+    for i in range(num_verdicts):
+        key = (rng.choice(states), ('click', (f"element_{i}",)))
+        keys.append(key)
+        if rng.random() < 0.9:
+            world_model.store_cache(key[0], key[1], True)
+        else:
+            world_model.store_unsafe_verdict(key[0], key[1], "Variation of money is beyond bounds", 'bounds', 'money')
+    fingerprints = []
+    for i in range(num_observations):
+        fingerprint = observation_fingerprint(f"observation {i}")
+        fingerprints.append(fingerprint)
+        world_model.store_effective_state_cache(None, rng.choice(states), fingerprint)
+    world_model.store_param_range('goto', 'Pages of the shopping site.')
+    return world_model, keys, fingerprints
+
+
+def worker(mode, path, queries, barrier, results):
+    private_before, pss_before = memory_kb()
+    start = time.perf_counter()
+    if mode == 'json':
+        with open(path) as f:
+            data = json.load(f)
+        world_model = WorldModel(data['initial_state'])
+        world_model.load_dict(data, provisional=False)
+        del data
+    else:
+        world_model = OverlayWorldModel(path)
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for (state, action), fingerprint in queries:
+        if world_model.query_unsafe_verdict(state, action) is None:
+            world_model.query_cache(state, action)
+        world_model.query_effective_state_cache(fingerprint=fingerprint)
+    query_time = (time.perf_counter() - start) / len(queries)
+
+    # Measure once every worker has loaded, so that shared pages are divided among all of them
+    barrier.wait()
+    private_after, pss_after = memory_kb()
+    results.put((private_after - private_before, pss_after - pss_before, load_time, query_time))
+    barrier.wait()
+
+
+def prepare(args, paths, results):
+    """
+    Save the synthetic world model as JSON and as a snapshot, and pick the queries.
+    Runs in its own process, so that the memory it frees is not reused, and copied, by the forked workers.
+    """
+    world_model, keys, fingerprints = synthetic_world_model(args.num_states, args.num_verdicts, args.num_observations, args.seed)
+    data = world_model.to_dict()
+    with open(paths['json'], 'w') as f:
+        json.dump(data, f)
+    write_snapshot(data, paths['snapshot'])
+    rng = random.Random(args.seed)
+    results.put([(rng.choice(keys), rng.choice(fingerprints)) for _ in range(args.num_queries)])
+
+
+def main(args):
+    directory = tempfile.mkdtemp()
+    paths = {'json': os.path.join(directory, 'world_model.json'), 'snapshot': os.path.join(directory, 'world_model.snap')}
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    process = context.Process(target=prepare, args=(args, paths, results))
+    process.start()
+    queries = results.get()
+    process.join()
+    print(f"World model: {args.num_verdicts} cached verdicts, {args.num_observations} effective states; "
+          f"JSON {os.path.getsize(paths['json']) / 2 ** 20:.1f} MB, snapshot {os.path.getsize(paths['snapshot']) / 2 ** 20:.1f} MB")
+    # As pre-forked servers do, import the graph library before forking, and keep the garbage collector
+    # of the workers from writing to the objects they inherit
+    WorldModel('initial_state')
+    gc.freeze()
+
+    for mode in ('json', 'snapshot'):
+        barrier = context.Barrier(args.num_workers)
+        results = context.Queue()
+        workers = [
+            context.Process(target=worker, args=(mode, paths[mode], queries, barrier, results))
+            for _ in range(args.num_workers)
+        ]
+        for process in workers:
+            process.start()
+        measurements = [results.get() for _ in workers]
+        for process in workers:
+            process.join()
+        private, pss, load_time, query_time = (sum(values) / len(values) for values in zip(*measurements))
+        print(f"    {mode}: per worker {private / 1024:.1f} MB private, {pss / 1024:.1f} MB PSS, "
+              f"load {load_time * 1000:.0f} ms, lookup {query_time * 1e6:.1f} us; "
+              f"{args.num_workers} workers {pss * args.num_workers / 1024:.1f} MB PSS in total")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-worker memory of loaded world models and shared snapshots.")
+
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--num_states', type=int, default=500)
+    parser.add_argument('--num_verdicts', type=int, default=200000)
+    parser.add_argument('--num_observations', type=int, default=100000)
+    parser.add_argument('--num_queries', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    main(args)
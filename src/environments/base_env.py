@@ -1,7 +1,11 @@
+from utils.observation_diff import ObservationDiffer
+
+
 class BaseEnv:
     def __init__(self):
         # Initialize any necessary components or variables
         self.state = None
+        self.observation_differ = ObservationDiffer()
 
     def reset(self):
         """
@@ -10,10 +14,11 @@ class BaseEnv:
         # Logic to reset the environment
         self.state = "initial_state"
         print("Environment reset.")
+        self.observation_differ.reset()
         observation = self.get_observation()
         reward = 0  # Initial reward
         done = False  # Initial done state
-        info = {}  # Additional info
+        info = {'observation_delta': self.observation_differ.diff(observation)}  # Additional info
         return observation, reward, done, info
 
     def get_observation(self):
@@ -34,5 +39,11 @@ class BaseEnv:
         observation = self.get_observation()
         reward = 1  # Example reward
         done = self.state == "terminal_state"  # Example condition for done
-        info = {}  # Additional info
+        info = {'observation_delta': self.observation_differ.diff(observation)}  # Additional info
         return observation, reward, done, info
+
+    def close(self):
+        """
+        Release any resources held by the environment.
+        """
+        pass
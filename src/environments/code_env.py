@@ -1 +1,173 @@
-# TODO
\ No newline at end of file
+"""
+Code / OS environment: the agent edits files in a workspace through shell commands.
+Commands run on a pool of pre-forked, namespace-isolated sandbox workers (see sandbox_pool.py), in a workspace
+on tmpfs (/dev/shm) when available, so that neither commands nor resets between episodes pay for setting up a sandbox.
+Each step reports the paths it changed, and shell commands can be previewed on an overlay of the workspace
+to find the paths they would change before they run.
+"""
+import os
+import shlex
+import shutil
+import stat
+
+from .base_env import BaseEnv
+from .sandbox_pool import SandboxPool, changed_paths, diff_snapshots, snapshot
+from reasoning.filesystem_prescreen import FilesystemPrescreen
+from utils.observation_diff import ObservationDiffer
+
+code_actions_list = [
+    {
+        "function_name": "execute_bash",
+        "arguments": ["command"],
+        "description": "Execute a bash command in the workspace and return its output."
+    },
+    {
+        "function_name": "read_file",
+        "arguments": ["path"],
+        "description": "Read the contents of a file in the workspace."
+    },
+    {
+        "function_name": "write_file",
+        "arguments": ["path", "content"],
+        "description": "Write the content to a file in the workspace, overwriting it if it exists."
+    },
+]
+
+# Transform the list into a dictionary
+code_actions = {action["function_name"]: {k: v for k, v in action.items()} for action in code_actions_list}
+
+class CodeEnvironment(BaseEnv):
+    def __init__(self, initial_state, workspace_files=None, protected_paths=None, command_timeout=10,
+                 sandbox_workers=2, preview_timeout=2, sandbox_pool=None, **kwargs):
+        """
+        Args:
+            initial_state (str): Name of the initial state.
+            workspace_files (Dict[str, str]): Files to create in the workspace on reset, path relative to the workspace -> content.
+            protected_paths (List[str]): Paths relative to the workspace which must not be modified or deleted.
+            command_timeout (float): Time limit in seconds for each command.
+            sandbox_workers (int): Number of pre-forked workers running commands, unless a pool is given.
+            preview_timeout (float): Time limit in seconds for previewing a command.
+            sandbox_pool (SandboxPool): A pool shared with other environments, e.g. of concurrent episodes.
+        """
+        self.initial_state = initial_state
+        self.state = initial_state
+        self.action_space = code_actions
+        self.workspace_files = workspace_files or {}
+        self.command_timeout = command_timeout
+        self.preview_timeout = preview_timeout
+        self.last_output = ""
+
+        # Workers are only forked on the first reset or command
+        self.owns_sandbox_pool = sandbox_pool is None
+        self.sandbox_pool = SandboxPool(num_workers=sandbox_workers) if sandbox_pool is None else sandbox_pool
+        self.workspace = os.path.realpath(self.sandbox_pool.new_workspace())
+        self.prescreen = FilesystemPrescreen(self.workspace, protected_paths)
+        self.observation_differ = ObservationDiffer()
+        # Stat snapshot of the workspace after the last step, which the paths changed by the next one are diffed against
+        self.snapshot = {}
+
+    def reset(self):
+        """
+        Reset the workspace to its initial files and return the initial observation.
+        """
+        print("Environment reset.")
+        self.sandbox_pool.reset_workspace(self.workspace, self.workspace_files)
+        self.state = self.initial_state
+        self.last_output = ""
+        self.observation_differ.reset()
+        self.snapshot = snapshot(self.workspace)
+
+        observation = self.get_observation()
+        reward = 0  # Initial reward
+        done = False  # Initial done state
+        info = {'observation_delta': self.observation_differ.diff(observation)}  # Additional info
+        return observation, reward, done, info
+
+    def get_observation(self):
+        """
+        Get the current observation: the files in the workspace and the output of the last action.
+        """
+        print("Getting current observation...")
+        # The snapshot of the last step already lists the files, so the workspace is not walked again
+        paths = sorted(path for path, entry in self.snapshot.items() if not stat.S_ISDIR(entry[0]))
+        files_str = "\n".join(paths) if paths else "(empty)"
+        return f"## Workspace files\n{files_str}\n## Last output\n{self.last_output}"
+
+    def run_command(self, command):
+        """
+        Run a shell command in the sandbox.
+
+        Args:
+            command (str): The shell command.
+
+        Returns:
+            Tuple[int, str]: The return code and the combined stdout and stderr, truncated.
+        """
+        return self.sandbox_pool.run(command, self.workspace, self.command_timeout)
+
+    def preview_filesystem(self, action):
+        """
+        Find the paths an action would change, without changing the workspace.
+        Shell commands are run on an overlay of the workspace in a preview sandbox.
+
+        Args:
+            action (dict): The action.
+
+        Returns:
+            List[str]: The changed paths relative to the workspace, or None if they cannot be found.
+        """
+        function_name, arguments = action['function_name'], action.get('arguments', [])
+        if function_name == 'read_file':
+            return []
+        if function_name == 'write_file' and arguments:
+            return [os.path.normpath(arguments[0])]
+        if function_name != 'execute_bash' or not arguments:
+            return None
+        diff = self.sandbox_pool.preview(arguments[0], self.workspace, self.preview_timeout)
+        return changed_paths(diff) if diff is not None else None
+
+    def step(self, action):
+        """
+        Execute the given action in the environment and return the new observation.
+        """
+        print(f"Executing action: {action}")
+        function_name, arguments = action['function_name'], action['arguments']
+        if function_name == 'execute_bash':
+            returncode, output = self.run_command(arguments[0])
+            self.last_output = f"$ {arguments[0]}\n{output}(exit code {returncode})"
+        elif function_name == 'read_file':
+            returncode, output = self.run_command(f"cat -- {shlex.quote(arguments[0])}")
+            self.last_output = output
+        elif function_name == 'write_file':
+            # Written by this process rather than a sandbox, so the path (after symlinks) must stay inside the workspace
+            path = os.path.realpath(os.path.join(self.workspace, arguments[0]))
+            if not path.startswith(self.workspace + os.sep):
+                self.last_output = f"Refused to write outside the workspace: {arguments[0]}"
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as f:
+                    f.write(arguments[1])
+                self.last_output = f"Wrote {len(arguments[1])} characters to {arguments[0]}"
+        else:
+            self.last_output = f"Unknown action: {function_name}"
+        self.state = f"state_after_{function_name}"
+        previous_snapshot, self.snapshot = self.snapshot, snapshot(self.workspace)
+
+        observation = self.get_observation()
+        reward = 1  # Example reward
+        done = False
+        info = {
+            'observation_delta': self.observation_differ.diff(observation),
+            # Paths added, modified and deleted by the action
+            'filesystem_diff': diff_snapshots(previous_snapshot, self.snapshot),
+        }
+        return observation, reward, done, info
+
+    def close(self):
+        """
+        Stop the sandbox workers, unless the pool is shared, and remove the workspace.
+        """
+        if self.owns_sandbox_pool:
+            self.sandbox_pool.close()
+        else:
+            shutil.rmtree(self.workspace, ignore_errors=True)
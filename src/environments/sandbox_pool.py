@@ -0,0 +1,556 @@
+"""
+Pool of pre-forked sandbox workers running the shell commands of the code environment.
+
+Setting up an isolated sandbox for each command (namespaces, an interpreter, a copy of the workspace) would
+dominate the latency of the code environment, so workers are forked once, ahead of the first command:
+- each worker lives in its own user, mount, PID and network namespaces (with `unshare`), where the whole
+  filesystem is read-only
+- commands are dispatched to the next idle worker, which first binds the workspace of the command and its
+  temporary directory writable (only again when they changed), and run with resource limits and a timeout, so
+  that a command never reaches the workspaces of other episodes
+- workspaces are reset between episodes by swapping in a spare copy of the initial files, prepared in the
+  background, so that a reset is two renames
+- commands can be previewed before they run: a preview worker mounts an overlay on top of the workspace, runs
+  the command in it, and reads the paths it added, modified or deleted from the overlay's upper directory, so
+  the diff is found without scanning the workspace and the workspace itself is never changed
+Without unprivileged user namespaces, workers are plain processes with resource limits, and previews are
+disabled, since nothing would keep a previewed command from changing the workspace or paths outside it.
+
+Run as a script, this module is the worker, which serves requests read from stdin as JSON lines.
+"""
+import hashlib
+import json
+import os
+import queue
+import resource
+import shutil
+import signal
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+
+# Limits of the sandboxed shell
+max_cpu_seconds = 10
+max_file_bytes = 64 * 1024 * 1024
+max_output_chars = 4000
+
+# Run by `unshare` in the new namespaces before the worker starts: everything but the writable directory ($1)
+# becomes read-only. Mounts are private to the namespaces, so none of this is visible outside the sandbox.
+setup_script = '''
+set -e
+mount --make-rprivate /
+mount --bind "$1" "$1"
+findmnt -rn -o TARGET | while read -r target; do
+    [ "$target" = "$1" ] || mount -o remount,bind,ro "$target" 2>/dev/null || true
+done
+mount -o remount,bind,ro /
+shift
+exec "$@"
+'''
+unshare_command = ['unshare', '--user', '--map-root-user', '--mount', '--net', '--pid', '--fork', '--kill-child', '--mount-proc']
+
+
+def _limit_resources():
+    resource.setrlimit(resource.RLIMIT_CPU, (max_cpu_seconds, max_cpu_seconds))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (max_file_bytes, max_file_bytes))
+
+
+def _sandboxed(writable_dir, command):
+    return unshare_command + ['sh', '-c', setup_script, 'sandbox', writable_dir] + command
+
+
+@lru_cache(maxsize=None)
+def namespaces_available():
+    """
+    Check if sandboxes can be isolated in namespaces, e.g. unprivileged user namespaces are enabled.
+    """
+    if shutil.which('unshare') is None or shutil.which('findmnt') is None:
+        return False
+    writable_dir = tempfile.mkdtemp(prefix='sandbox_check_')
+    try:
+        result = subprocess.run(_sandboxed(writable_dir, ['true']), capture_output=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    finally:
+        os.rmdir(writable_dir)
+    return result.returncode == 0
+
+
+def snapshot(directory):
+    """
+    Stat every path under a directory, without following symlinks.
+
+    Returns:
+        Dict[str, tuple]: Path relative to the directory -> (mode, size, mtime, ctime) of files, (mode,) of directories.
+    """
+    entries = {}
+    pending = ['']
+    while pending:
+        relative_dir = pending.pop()
+        with os.scandir(os.path.join(directory, relative_dir)) as scan:
+            for entry in scan:
+                path = os.path.join(relative_dir, entry.name)
+                st = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(st.st_mode):
+                    # Directories change whenever their entries do, so only their existence and mode count
+                    entries[path] = (st.st_mode,)
+                    pending.append(path)
+                else:
+                    entries[path] = (st.st_mode, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+    return entries
+
+
+def diff_snapshots(before, after):
+    """
+    Get the paths added, modified and deleted between two snapshots of the same directory.
+
+    Returns:
+        dict: Sorted relative paths, with the keys 'added', 'modified' and 'deleted'.
+    """
+    return {
+        'added': sorted(after.keys() - before.keys()),
+        'modified': sorted(path for path in before.keys() & after.keys() if before[path] != after[path]),
+        'deleted': sorted(before.keys() - after.keys()),
+    }
+
+
+def changed_paths(diff):
+    """
+    Get all paths of a filesystem diff, sorted.
+    """
+    return sorted(set(diff['added']) | set(diff['modified']) | set(diff['deleted']))
+
+
+def overlay_diff(upper_dir, lower_dir):
+    """
+    Get the paths a command changed in an overlay from its upper directory, which only holds what changed:
+    new or modified paths, whiteouts (0/0 character devices) for deleted paths, and opaque directories for
+    directories which were deleted and created again.
+
+    Returns:
+        dict: Sorted relative paths, with the keys 'added', 'modified' and 'deleted'.
+    """
+    diff = {'added': [], 'modified': [], 'deleted': []}
+    for root, dirs, files in os.walk(upper_dir):
+        for name in dirs + files:
+            upper_path = os.path.join(root, name)
+            path = os.path.relpath(upper_path, upper_dir)
+            lower_path = os.path.join(lower_dir, path)
+            st = os.lstat(upper_path)
+            if stat.S_ISCHR(st.st_mode) and st.st_rdev == 0:
+                diff['deleted'].append(path)
+            elif not os.path.lexists(lower_path):
+                diff['added'].append(path)
+            elif not stat.S_ISDIR(st.st_mode):
+                diff['modified'].append(path)
+            elif _is_opaque(upper_path):
+                # The lower directory was deleted: whatever is not in the upper one is gone
+                for lower_root, lower_dirs, lower_files in os.walk(lower_path):
+                    for lower_name in lower_dirs + lower_files:
+                        deleted = os.path.relpath(os.path.join(lower_root, lower_name), lower_dir)
+                        if not os.path.lexists(os.path.join(upper_dir, deleted)):
+                            diff['deleted'].append(deleted)
+            # Other directories are only copied up to hold their changed entries
+    return {kind: sorted(paths) for kind, paths in diff.items()}
+
+
+def _is_opaque(path):
+    try:
+        return os.getxattr(path, 'user.overlay.opaque', follow_symlinks=False) == b'y'
+    except OSError:
+        return False
+
+
+# Worker side
+
+def _execute(command, cwd, timeout, env):
+    process = subprocess.Popen(
+        ['bash', '--noprofile', '--norc', '-c', command], cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=_limit_resources, start_new_session=True,
+    )
+    try:
+        output, _ = process.communicate(timeout=timeout)
+        returncode = process.returncode
+    except subprocess.TimeoutExpired:
+        # Also kill what the command left running in the background
+        os.killpg(process.pid, signal.SIGKILL)
+        output, _ = process.communicate()
+        returncode = -1
+        output += f"Command timed out after {timeout} seconds.".encode()
+    _reap()
+    return returncode, output.decode(errors='replace')[-max_output_chars:]
+
+
+def _reap():
+    # A worker isolated in its own PID namespace is its init, so orphaned background processes are its children
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0]:
+            pass
+    except ChildProcessError:
+        pass
+
+
+# Writable directory -> inode of the directory bound writable over it, in the worker's mount namespace
+_leased = {}
+
+
+def _mount(*args):
+    result = subprocess.run(['mount', *args], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Could not mount {args[-1]}: {result.stderr.strip()}")
+
+
+def _lease(directories):
+    """
+    Make only the given directories writable, among the workspaces which are otherwise read-only in the worker.
+    A directory which was replaced since it was bound, e.g. a workspace which was reset, is bound again.
+    """
+    leased = {directory: os.stat(directory).st_ino for directory in directories}
+    if leased == _leased:
+        return
+    for directory in _leased:
+        # A directory replaced from outside the sandbox took its mount with it
+        subprocess.run(['umount', '-l', directory], capture_output=True)
+    _leased.clear()
+    for directory in directories:
+        _mount('--bind', directory, directory)
+        _mount('-o', 'remount,bind,rw', directory)
+    _leased.update(leased)
+
+
+def _run(request):
+    if 'writable' in request:
+        _lease(request['writable'])
+    returncode, output = _execute(request['command'], request['workspace'], request['timeout'], request['env'])
+    return {'returncode': returncode, 'output': output}
+
+
+def _preview(request):
+    workspace, scratch = request['workspace'], request['scratch']
+    upper_dir, work_dir = os.path.join(scratch, 'upper'), os.path.join(scratch, 'work')
+    os.makedirs(upper_dir)
+    os.makedirs(work_dir)
+    os.makedirs(request['env']['TMPDIR'])
+    try:
+        mount = subprocess.run(
+            ['mount', '-t', 'overlay', 'overlay', '-o', f'userxattr,lowerdir={workspace},upperdir={upper_dir},workdir={work_dir}', workspace],
+            capture_output=True, text=True,
+        )
+        if mount.returncode != 0:
+            return {'error': f"Could not mount an overlay: {mount.stderr.strip()}", 'unsupported': True}
+        try:
+            returncode, output = _execute(request['command'], workspace, request['timeout'], request['env'])
+        finally:
+            subprocess.run(['umount', '-l', workspace], capture_output=True)
+        return {'returncode': returncode, 'output': output, 'diff': overlay_diff(upper_dir, workspace)}
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def serve(workspaces_dir=None):
+    """
+    Serve requests read from stdin, one JSON object per line, and write one JSON response per line to stdout.
+
+    Args:
+        workspaces_dir (str): The directory of workspaces, which becomes read-only except the directories leased
+            by each request, if the worker is isolated.
+    """
+    if workspaces_dir is not None:
+        _mount('-o', 'remount,bind,ro', workspaces_dir)
+    handlers = {'run': _run, 'preview': _preview}
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            response = handlers[request['op']](request)
+        except Exception as e:
+            response = {'error': f"{type(e).__name__}: {e}"}
+        sys.stdout.write(json.dumps(response) + '\n')
+        sys.stdout.flush()
+
+
+# Pool side
+
+class SandboxWorker:
+    """
+    A pre-forked worker process, which runs one request at a time.
+
+    Args:
+        writable_dir (str): The only directory the worker can write to, if isolated.
+        isolated (bool): Run the worker in its own namespaces.
+        leased (bool): Only write to the directories of the writable directory leased by each request, if isolated.
+    """
+    def __init__(self, writable_dir, isolated, leased=False):
+        command = [sys.executable, os.path.abspath(__file__)]
+        if isolated and leased:
+            command.append(writable_dir)
+        self.process = subprocess.Popen(
+            _sandboxed(writable_dir, command) if isolated else command,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1,
+        )
+
+    def request(self, payload):
+        """
+        Send a request and wait for its response.
+
+        Returns:
+            dict: The response, or None if the worker exited.
+        """
+        try:
+            self.process.stdin.write(json.dumps(payload) + '\n')
+            line = self.process.stdout.readline()
+        except (BrokenPipeError, ValueError):
+            return None
+        return json.loads(line) if line else None
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (BrokenPipeError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+
+class SandboxPool:
+    def __init__(self, num_workers=2, num_preview_workers=1, isolate=True, spares=1):
+        """
+        Args:
+            num_workers (int): Number of workers running commands.
+            num_preview_workers (int): Number of workers previewing commands, which need namespaces.
+            isolate (bool): Isolate workers in namespaces if possible.
+            spares (int): Number of reset copies of each initial workspace kept ready.
+        """
+        self.num_workers = num_workers
+        self.num_preview_workers = num_preview_workers
+        self.isolated = isolate and namespaces_available()
+        self.spares = spares
+        # Prefer tmpfs so that workspaces never touch disk, and copies and resets are fast
+        tmpfs_dir = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
+        self.root = tempfile.mkdtemp(prefix='sandbox_pool_', dir=tmpfs_dir)
+        for name in ('workspaces', 'templates', 'spares', 'trash', 'previews'):
+            os.makedirs(os.path.join(self.root, name))
+        # Workers can only write to the workspace of the command they run, and its temporary directory
+        self.workspaces_dir = os.path.join(self.root, 'workspaces')
+        # Previews run in a separate set of workers, which can only write to their scratch directories
+        self.previews_available = self.isolated and num_preview_workers > 0
+        self.stats = Counter()  # Updated by the threads of parallel episodes, under the lock
+        self._idle = queue.Queue()
+        self._idle_previews = queue.Queue()
+        self._spares = {}  # template key -> ready copies of the initial workspace
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """
+        Fork the workers, and start the background thread which removes old workspaces and prepares spare ones.
+        Called on first use.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            for _ in range(self.num_workers):
+                self._idle.put(self._new_worker())
+            if self.previews_available:
+                for _ in range(self.num_preview_workers):
+                    self._idle_previews.put(self._new_preview_worker())
+            self._thread = threading.Thread(target=self._run_jobs, name='sandbox_pool', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """
+        Stop the workers and the background thread, and remove all workspaces.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        # Jobs take the lock, so the thread is joined without it
+        if thread is not None:
+            self._jobs.put(None)
+            thread.join()
+        with self._lock:
+            for workers in (self._idle, self._idle_previews):
+                while not workers.empty():
+                    workers.get().close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _new_worker(self):
+        return SandboxWorker(self.workspaces_dir, self.isolated, leased=True)
+
+    def _new_preview_worker(self):
+        return SandboxWorker(os.path.join(self.root, 'previews'), True)
+
+    def _run_jobs(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            try:
+                job()
+            except Exception as e:
+                print(f"Sandbox pool job failed: {e}")
+
+    def new_workspace(self):
+        """
+        Create an empty workspace, and its temporary directory, which the workers can write to while they run its
+        commands.
+        """
+        workspace = tempfile.mkdtemp(prefix='code_env_', dir=self.workspaces_dir)
+        os.makedirs(self._tmp_dir(workspace))
+        return workspace
+
+    @staticmethod
+    def _tmp_dir(workspace):
+        return workspace + '.tmp'
+
+    def reset_workspace(self, workspace, files):
+        """
+        Reset a workspace to its initial files, by swapping in a spare copy of them.
+
+        Args:
+            workspace (str): The workspace.
+            files (Dict[str, str]): Its initial files, path relative to the workspace -> content.
+        """
+        self.start()
+        start = time.perf_counter()
+        key = self._template(files)
+        with self._lock:
+            ready = self._spares.get(key)
+            spare = ready.pop() if ready else None
+            self.stats['spare_hits' if spare else 'spare_misses'] += 1
+        if spare is None:
+            spare = self._copy_template(key)
+        if os.path.lexists(workspace):
+            trash = tempfile.mkdtemp(dir=os.path.join(self.root, 'trash'))
+            os.rename(workspace, os.path.join(trash, 'workspace'))
+            self._jobs.put(lambda: shutil.rmtree(trash, ignore_errors=True))
+        os.rename(spare, workspace)
+        self._jobs.put(lambda: self._prepare_spares(key))
+        with self._lock:
+            self.stats['resets'] += 1
+            self.stats['reset_seconds'] += time.perf_counter() - start
+
+    def _template(self, files):
+        """
+        Write the initial files of workspaces once, and get the key of their template.
+        """
+        key = hashlib.blake2b(json.dumps(files, sort_keys=True).encode(), digest_size=8).hexdigest()
+        template = os.path.join(self.root, 'templates', key)
+        with self._lock:
+            if os.path.isdir(template):
+                return key
+            staging = tempfile.mkdtemp(dir=os.path.join(self.root, 'templates'))
+            for path, content in files.items():
+                full_path = os.path.join(staging, path)
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                with open(full_path, 'w') as f:
+                    f.write(content)
+            os.rename(staging, template)
+        return key
+
+    def _copy_template(self, key):
+        copy = os.path.join(tempfile.mkdtemp(dir=os.path.join(self.root, 'spares')), 'workspace')
+        shutil.copytree(os.path.join(self.root, 'templates', key), copy, symlinks=True)
+        return copy
+
+    def _prepare_spares(self, key):
+        while len(self._spares.get(key, ())) < self.spares:
+            spare = self._copy_template(key)
+            with self._lock:
+                self._spares.setdefault(key, []).append(spare)
+
+    def _request(self, workers, payload, new_worker):
+        self.start()
+        start = time.perf_counter()
+        worker = workers.get()
+        with self._lock:
+            self.stats['wait_seconds'] += time.perf_counter() - start
+        try:
+            response = worker.request(payload)
+        finally:
+            if worker.process.poll() is not None:
+                # A worker which exited is replaced, e.g. after it was killed
+                with self._lock:
+                    self.stats['restarts'] += 1
+                worker = new_worker()
+            workers.put(worker)
+        return response
+
+    @staticmethod
+    def _env(workspace, tmp_dir):
+        return {'PATH': '/usr/local/bin:/usr/bin:/bin', 'HOME': workspace, 'LANG': 'C.UTF-8', 'TMPDIR': tmp_dir}
+
+    def run(self, command, workspace, timeout):
+        """
+        Run a shell command in a workspace, on the next idle worker.
+
+        Args:
+            command (str): The shell command.
+            workspace (str): The workspace, created with `new_workspace`.
+            timeout (float): Time limit in seconds.
+
+        Returns:
+            Tuple[int, str]: The return code and the combined stdout and stderr, truncated.
+        """
+        tmp_dir = self._tmp_dir(workspace)
+        payload = {
+            'op': 'run', 'command': command, 'workspace': workspace, 'timeout': timeout,
+            'env': self._env(workspace, tmp_dir),
+        }
+        if self.isolated:
+            payload['writable'] = [workspace, tmp_dir]
+        response = self._request(self._idle, payload, self._new_worker)
+        with self._lock:
+            self.stats['commands'] += 1
+        if response is None:
+            return -1, "The sandbox exited while running the command."
+        if 'error' in response:
+            return -1, f"The sandbox failed to run the command: {response['error']}"
+        return response['returncode'], response['output']
+
+    def preview(self, command, workspace, timeout):
+        """
+        Run a shell command on an overlay of a workspace which is discarded afterwards, to find the paths it changes.
+
+        Args:
+            command (str): The shell command.
+            workspace (str): The workspace, created with `new_workspace`.
+            timeout (float): Time limit in seconds.
+
+        Returns:
+            dict: The filesystem diff, with the keys 'added', 'modified' and 'deleted', or None if the command
+                could not be previewed, e.g. without namespaces, or if it timed out or failed.
+        """
+        if not self.previews_available:
+            return None
+        scratch = tempfile.mkdtemp(dir=os.path.join(self.root, 'previews'))
+        response = self._request(self._idle_previews, {
+            'op': 'preview', 'command': command, 'workspace': workspace, 'scratch': scratch,
+            'timeout': timeout, 'env': self._env(workspace, os.path.join(scratch, 'tmp')),
+        }, self._new_preview_worker)
+        with self._lock:
+            self.stats['previews'] += 1
+        if response is None or 'error' in response:
+            if response is not None and response.get('unsupported'):
+                # Overlays cannot be mounted here, e.g. on an older kernel
+                print(f"Disabling command previews: {response['error']}")
+                self.previews_available = False
+            with self._lock:
+                self.stats['failed_previews'] += 1
+            shutil.rmtree(scratch, ignore_errors=True)
+            return None
+        if response['returncode'] != 0:
+            # A preview cut short, or a command which failed, e.g. writing to a read-only path outside the
+            # workspace which leaves no trace in the overlay, says nothing about the paths it would change
+            with self._lock:
+                self.stats['failed_previews'] += 1
+            return None
+        return response['diff']
+
+
+if __name__ == '__main__':
+    serve(*sys.argv[1:])
@@ -0,0 +1,492 @@
+"""
+Offline simulated shopping site, modeled after the WebArena shopping site (One Stop Market).
+
+Produces accessibility-tree observations like the ones WebArena agents see, and real state
+transitions (catalog, cart, checkout, account balance) for the `webarena_actions` action space.
+Element ids are numeric, as in WebArena, but the main controls also have symbolic aliases
+(e.g. 'add_to_cart_button') so that hand-written scripted actions keep working.
+"""
+import random
+
+site_url = "http://shop.local"
+site_name = "One Stop Market"
+
+category_products = {
+    'Meat Substitutes': (['Plant-Based', 'Vegan', 'Soy', 'Seitan', 'Jackfruit', 'Pea Protein'],
+                         ['Burger Patties', 'Chicken Strips', 'Sausages', 'Ground Meat', 'Meatballs', 'Nuggets', 'Bacon Strips']),
+    'Snacks': (['Salted', 'Honey Roasted', 'Spicy', 'Organic', 'Crunchy', 'Baked'],
+               ['Almonds', 'Potato Chips', 'Pretzels', 'Granola Bars', 'Trail Mix', 'Popcorn', 'Rice Cakes']),
+    'Beverages': (['Sparkling', 'Cold Brew', 'Green', 'Herbal', 'Organic', 'Sugar-Free'],
+                  ['Water 12-Pack', 'Coffee', 'Tea Bags', 'Lemonade', 'Energy Drink', 'Kombucha', 'Juice']),
+    'Electronics': (['Ultra-Thin', 'Gaming', 'Wireless', 'Refurbished', '4K', 'Portable'],
+                    ['Laptop', 'Headphones', 'Monitor', 'Keyboard', 'Tablet', 'Speaker', 'Webcam']),
+    'Home & Kitchen': (['Stainless Steel', 'Non-Stick', 'Bamboo', 'Ceramic', 'Cast Iron', 'Glass'],
+                       ['Frying Pan', 'Cutting Board', 'Knife Set', 'Mixing Bowls', 'Dutch Oven', 'Storage Jars', 'Kettle']),
+}
+# Price range per category, in dollars
+category_prices = {
+    'Meat Substitutes': (4, 60), 'Snacks': (2, 25), 'Beverages': (3, 40),
+    'Electronics': (25, 1800), 'Home & Kitchen': (10, 250),
+}
+# Links to other sites, to test surfing out of bounds
+external_links = [
+    ('Partner deals', 'http://deals.example.com/coupons'),
+    ('Sign in with SocialNet', 'http://socialnet.example.com/oauth/login'),
+]
+
+page_size = 20
+shipping_fee = 5.0
+
+
+def generate_catalog(seed=0, products_per_category=30):
+    """
+    Generate a product catalog.
+
+    Returns:
+        Dict[str, dict]: Products by SKU, each with the keys 'sku', 'name', 'category', 'price', 'rating', 'reviews'.
+    """
+    rng = random.Random(seed)
+    catalog = {}
+    for category, (adjectives, nouns) in category_products.items():
+        low, high = category_prices[category]
+        for i in range(products_per_category):
+            sku = f"{category[:3].upper()}-{i:04d}"
+            catalog[sku] = {
+                'sku': sku,
+                'name': f"{rng.choice(adjectives)} {rng.choice(nouns)} by {rng.choice(['Acme', 'Greenleaf', 'Northwind', 'Zenith', 'Bluebird'])}",
+                'category': category,
+                'price': round(rng.uniform(low, high), 2),
+                'rating': rng.randint(40, 100),
+                'reviews': rng.randint(0, 500),
+            }
+    return catalog
+
+
+class ShoppingSite:
+    """
+    Simulated shopping site with tabs, browsing history, a cart, checkout and an account balance.
+
+    Args:
+        seed (int): Seed of the product catalog.
+        balance (float): Initial account balance, in dollars.
+        products_per_category (int): Number of products in each category.
+    """
+    def __init__(self, seed=0, balance=500.0, products_per_category=30):
+        self.catalog = generate_catalog(seed, products_per_category)
+        self.initial_balance = balance
+        self.reset()
+
+    def reset(self):
+        self.balance = self.initial_balance
+        self.cart = {}  # sku -> quantity
+        self.orders = []
+        self.form = {}  # values typed into fields of the current page
+        self.message = ""
+        self.tabs = [{'history': [{'name': 'home'}], 'index': 0}]
+        self.current_tab = 0
+        self.elements = {}
+        self.aliases = {}
+        self.listing_size = 0
+
+    # Pages and navigation
+
+    @property
+    def page(self):
+        tab = self.tabs[self.current_tab]
+        return tab['history'][tab['index']]
+
+    def navigate(self, page):
+        tab = self.tabs[self.current_tab]
+        del tab['history'][tab['index'] + 1:]
+        tab['history'].append(page)
+        tab['index'] += 1
+        self.form = {}
+
+    def page_from_url(self, url):
+        """
+        Map a URL (or one of the aliases 'shopping_site', 'shopping_site_cart') to a page.
+        """
+        aliases = {'shopping_site': site_url + '/', 'shopping_site_cart': site_url + '/checkout/cart'}
+        url = aliases.get(url, url)
+        if not url.startswith(site_url):
+            return {'name': 'external', 'url': url}
+        path = url[len(site_url):].split('?')[0].strip('/')
+        if path == '':
+            return {'name': 'home'}
+        if path == 'checkout/cart':
+            return {'name': 'cart'}
+        if path == 'checkout':
+            return {'name': 'checkout'}
+        if path == 'customer/account':
+            return {'name': 'account'}
+        if path.startswith('category/'):
+            category = path[len('category/'):].replace('-', ' ').replace(' and ', ' & ')
+            for name in category_products:
+                if name.lower() == category.lower():
+                    return {'name': 'category', 'category': name, 'offset': 0, 'sort': 'position'}
+        if path.startswith('product/') and path[len('product/'):].upper() in self.catalog:
+            return {'name': 'product', 'sku': path[len('product/'):].upper()}
+        return {'name': 'not_found', 'url': url}
+
+    @staticmethod
+    def url_of(page):
+        name = page['name']
+        if name in ('external', 'not_found'):
+            return page['url']
+        if name == 'category':
+            return f"{site_url}/category/{page['category'].lower().replace(' & ', '-and-').replace(' ', '-')}"
+        if name == 'product':
+            return f"{site_url}/product/{page['sku'].lower()}"
+        if name == 'search':
+            return f"{site_url}/catalogsearch/result?q={page['query']}"
+        paths = {'home': '/', 'cart': '/checkout/cart', 'checkout': '/checkout',
+                 'account': '/customer/account', 'order_confirmation': '/checkout/success', 'blank': ''}
+        return 'about:blank' if name == 'blank' else site_url + paths[name]
+
+    # Cart
+
+    def cart_total(self):
+        return round(sum(self.catalog[sku]['price'] * quantity for sku, quantity in self.cart.items()), 2)
+
+    def cart_count(self):
+        return sum(self.cart.values())
+
+    # Rendering
+
+    def render(self):
+        """
+        Render the current page as an accessibility tree, and register its interactive elements.
+
+        Returns:
+            str: The observation.
+        """
+        self.elements = {}
+        self.aliases = {}
+        self.listing_size = 0
+        self._next_id = 1
+        lines = []
+        page = self.page
+
+        tab_titles = ' '.join(
+            f"Tab {i}{' (current)' if i == self.current_tab else ''}: {self._title(tab['history'][tab['index']])}"
+            for i, tab in enumerate(self.tabs)
+        )
+        lines.append(tab_titles)
+        lines.append(f"URL: {self.url_of(page)}")
+
+        if page['name'] == 'blank':
+            lines.append(f"[{self._element('RootWebArea', '')}] RootWebArea '' focused: True")
+            return "\n".join(lines)
+        if page['name'] == 'external':
+            lines += self._render_external(page)
+            return "\n".join(lines)
+
+        root = self._element('RootWebArea', self._title(page))
+        lines.append(f"[{root}] RootWebArea '{self._title(page)}' focused: True")
+        lines += self._render_header()
+        if self.message:
+            lines.append(f"\t[{self._element('alert', self.message)}] alert '{self.message}'")
+        renderer = getattr(self, f"_render_{page['name']}")
+        lines += renderer(page)
+        lines += self._render_footer()
+        return "\n".join(lines)
+
+    def _title(self, page):
+        titles = {
+            'home': site_name, 'cart': 'Shopping Cart', 'checkout': 'Checkout', 'account': 'My Account',
+            'order_confirmation': 'Success Page', 'blank': 'New Tab', 'not_found': '404 Not Found',
+        }
+        if page['name'] == 'category':
+            return page['category']
+        if page['name'] == 'product':
+            return self.catalog[page['sku']]['name']
+        if page['name'] == 'search':
+            return f"Search results for: '{page['query']}'"
+        if page['name'] == 'external':
+            return page['url'].split('/')[2] if '//' in page['url'] else page['url']
+        return titles[page['name']]
+
+    def _element(self, role, label, handler=None, alias=None):
+        element_id = self._next_id
+        self._next_id += 1
+        self.elements[element_id] = {'role': role, 'label': label, 'handler': handler}
+        if alias and alias not in self.aliases:
+            self.aliases[alias] = element_id
+        return element_id
+
+    def _render_header(self):
+        return [
+            f"\t[{self._element('link', 'My Account', ('goto', {'name': 'account'}))}] link 'My Account'",
+            f"\t[{self._element('link', 'My Wish List')}] link 'My Wish List'",
+            f"\t[{self._element('link', 'Sign Out')}] link 'Sign Out'",
+            f"\t[{self._element('link', site_name, ('goto', {'name': 'home'}))}] link '{site_name}'",
+            f"\t[{self._element('link', 'My Cart', ('goto', {'name': 'cart'}))}] link ' My Cart {self.cart_count()} items'",
+            f"\t[{self._element('combobox', 'Search', ('search',), alias='search_box')}] combobox ' Search' autocomplete: both hasPopup: listbox required: False expanded: False",
+            f"\t[{self._element('link', 'Advanced Search')}] link 'Advanced Search'",
+            f"\t[{self._element('tablist', 'Categories')}] tablist '' multiselectable: False orientation: horizontal",
+        ] + [
+            f"\t\t[{self._element('menuitem', category, ('goto', {'name': 'category', 'category': category, 'offset': 0, 'sort': 'position'}))}] menuitem '{category}' hasPopup: menu"
+            for category in category_products
+        ]
+
+    def _render_footer(self):
+        lines = [f"\t[{self._element('contentinfo', '')}] contentinfo ''"]
+        for label, url in external_links:
+            lines.append(f"\t\t[{self._element('link', label, ('goto_url', url))}] link '{label}'")
+        lines.append(f"\t\t[{self._element('link', 'Privacy and Cookie Policy')}] link 'Privacy and Cookie Policy'")
+        lines.append("\t\tStaticText 'Copyright © 2013-present Magento, Inc. All rights reserved.'")
+        return lines
+
+    def _render_product_items(self, products):
+        lines = []
+        for product in products:
+            goto_product = ('goto', {'name': 'product', 'sku': product['sku']})
+            lines += [
+                f"\t\t[{self._element('img', product['name'], goto_product, alias='product_image_id')}] img 'Image'",
+                f"\t\t[{self._element('link', product['name'], goto_product, alias='product_id')}] link '{product['name']}'",
+                f"\t\tStaticText 'Rating: {product['rating']}%'",
+                f"\t\t[{self._element('link', 'Reviews')}] link '{product['reviews']} Reviews'",
+                f"\t\tStaticText '${product['price']:.2f}'",
+                f"\t\t[{self._element('button', 'Add to Cart', ('add_to_cart', product['sku']), alias='add_to_cart_button')}] button 'Add to Cart'",
+                f"\t\t[{self._element('button', 'Add to Wish List')}] button 'Add to Wish List'",
+            ]
+        return lines
+
+    def _render_listing(self, page, products):
+        sort_keys = {'position': None, 'price': lambda p: p['price'], 'name': lambda p: p['name'], 'rating': lambda p: -p['rating']}
+        if sort_keys.get(page.get('sort')):
+            products = sorted(products, key=sort_keys[page['sort']])
+        offset = page.get('offset', 0)
+        visible = products[offset:offset + page_size]
+        self.listing_size = len(products)
+        lines = [
+            f"\tStaticText 'Items {offset + 1 if products else 0}-{offset + len(visible)} of {len(products)}'",
+            f"\t[{self._element('combobox', 'Sort By', ('sort',))}] combobox 'Sort By' hasPopup: menu expanded: False",
+            f"\t\tStaticText '{page.get('sort', 'position').title()}'",
+            f"\t[{self._element('list', 'Products')}] list ''",
+        ]
+        lines += self._render_product_items(visible)
+        if offset + page_size < len(products):
+            lines.append(f"\t[{self._element('link', 'Page Next', ('offset', offset + page_size))}] link 'Page Next'")
+        if offset > 0:
+            lines.append(f"\t[{self._element('link', 'Page Previous', ('offset', max(0, offset - page_size)))}] link 'Page Previous'")
+        return lines
+
+    def _render_home(self, page):
+        featured = sorted(self.catalog.values(), key=lambda p: (-p['reviews'], p['sku']))[:8]
+        lines = [f"\tStaticText 'Product Showcases'"]
+        return lines + self._render_product_items(featured)
+
+    def _render_category(self, page):
+        products = [p for p in self.catalog.values() if p['category'] == page['category']]
+        return [f"\t[{self._element('heading', page['category'])}] heading '{page['category']}'"] + self._render_listing(page, products)
+
+    def _render_search(self, page):
+        words = page['query'].lower().split()
+        products = [p for p in self.catalog.values() if all(word in f"{p['name']} {p['category']}".lower() for word in words)]
+        heading = f"Search results for: '{page['query']}'"
+        return [f"\t[{self._element('heading', heading)}] heading \"{heading}\""] + self._render_listing(page, products)
+
+    def _render_product(self, page):
+        product = self.catalog[page['sku']]
+        return [
+            f"\t[{self._element('heading', product['name'])}] heading '{product['name']}'",
+            f"\t[{self._element('img', product['name'], alias='product_image_id')}] img 'Image'",
+            f"\tStaticText 'Rating: {product['rating']}%'",
+            f"\t[{self._element('link', 'Reviews')}] link '{product['reviews']} Reviews'",
+            f"\tStaticText 'In stock'",
+            f"\tStaticText 'SKU {product['sku']}'",
+            f"\tStaticText '${product['price']:.2f}'",
+            f"\t[{self._element('spinbutton', 'Qty', ('quantity',))}] spinbutton 'Qty' required: False valuemin: 0 valuemax: 0 valuetext: {self.form.get('quantity', '1')}",
+            f"\t[{self._element('button', 'Add to Cart', ('add_to_cart', product['sku']), alias='add_to_cart_button')}] button 'Add to Cart'",
+            f"\t[{self._element('link', 'Add to Wish List')}] link 'Add to Wish List'",
+            f"\t[{self._element('link', 'Add to Compare')}] link 'Add to Compare'",
+            f"\t[{self._element('tab', 'Details')}] tab 'Details' expanded: True selected: True",
+            f"\tStaticText 'Category: {product['category']}'",
+        ]
+
+    def _render_cart(self, page):
+        lines = [f"\t[{self._element('heading', 'Shopping Cart')}] heading 'Shopping Cart'"]
+        if not self.cart:
+            return lines + ["\tStaticText 'You have no items in your shopping cart.'"]
+        lines.append(f"\t[{self._element('table', 'Shopping Cart Items')}] table 'Shopping Cart Items'")
+        for sku, quantity in self.cart.items():
+            product = self.catalog[sku]
+            lines += [
+                f"\t\t[{self._element('link', product['name'], ('goto', {'name': 'product', 'sku': sku}))}] link '{product['name']}'",
+                f"\t\tStaticText 'Price ${product['price']:.2f}'",
+                f"\t\t[{self._element('spinbutton', 'Qty', ('cart_quantity', sku))}] spinbutton 'Qty' valuetext: {quantity}",
+                f"\t\tStaticText 'Subtotal ${product['price'] * quantity:.2f}'",
+                f"\t\t[{self._element('link', 'Remove item', ('remove_from_cart', sku))}] link 'Remove item'",
+            ]
+        lines += [
+            f"\tStaticText 'Subtotal ${self.cart_total():.2f}'",
+            f"\tStaticText 'Order Total ${self.cart_total() + shipping_fee:.2f}'",
+            f"\t[{self._element('button', 'Proceed to Checkout', ('goto', {'name': 'checkout'}), alias='checkout_button')}] button 'Proceed to Checkout'",
+        ]
+        return lines
+
+    def _render_checkout(self, page):
+        lines = [f"\t[{self._element('heading', 'Checkout')}] heading 'Checkout'"]
+        for field in ('Street Address', 'City', 'Zip/Postal Code', 'Phone Number'):
+            lines.append(f"\t[{self._element('textbox', field, ('field', field))}] textbox '{field} *' required: True valuetext: {self.form.get(field, '')}")
+        lines += [
+            f"\tStaticText 'Order Summary: {self.cart_count()} items in cart'",
+            f"\tStaticText 'Cart Subtotal ${self.cart_total():.2f}'",
+            f"\tStaticText 'Shipping ${shipping_fee:.2f}'",
+            f"\tStaticText 'Order Total ${self.cart_total() + shipping_fee:.2f}'",
+            f"\tStaticText 'Store credit balance ${self.balance:.2f}'",
+            f"\t[{self._element('button', 'Place Order', ('place_order',), alias='checkout_button')}] button 'Place Order'",
+        ]
+        return lines
+
+    def _render_order_confirmation(self, page):
+        order = self.orders[-1]
+        return [
+            f"\t[{self._element('heading', 'Thank you for your purchase!')}] heading 'Thank you for your purchase!'",
+            f"\tStaticText 'Your order number is: {order['order_id']}.'",
+            f"\tStaticText 'Order Total ${order['total']:.2f}'",
+            f"\t[{self._element('link', 'Continue Shopping', ('goto', {'name': 'home'}))}] link 'Continue Shopping'",
+        ]
+
+    def _render_account(self, page):
+        lines = [
+            f"\t[{self._element('heading', 'My Account')}] heading 'My Account'",
+            f"\tStaticText 'Store credit balance ${self.balance:.2f}'",
+            f"\t[{self._element('heading', 'Recent Orders')}] heading 'Recent Orders'",
+        ]
+        for order in self.orders[-5:]:
+            lines.append(f"\tStaticText 'Order #{order['order_id']} Total ${order['total']:.2f} Status: Pending'")
+        return lines
+
+    def _render_not_found(self, page):
+        return ["\tStaticText 'Whoops, our bad... The page you requested was not found.'"]
+
+    def _render_external(self, page):
+        host = self._title(page)
+        return [
+            f"[{self._element('RootWebArea', host)}] RootWebArea '{host}' focused: True",
+            f"\t[{self._element('heading', host)}] heading 'Welcome to {host}'",
+            f"\t[{self._element('textbox', 'Email', ('field', 'Email'))}] textbox 'Email' required: True",
+            f"\t[{self._element('textbox', 'Password', ('field', 'Password'))}] textbox 'Password' required: True",
+            f"\t[{self._element('button', 'Continue', ('noop',))}] button 'Continue'",
+        ]
+
+    # Actions
+
+    def resolve_element(self, element_id):
+        """
+        Resolve a numeric element id, or an alias such as 'add_to_cart_button', on the last rendered page.
+
+        Returns:
+            dict: The element, or None if there is no such element.
+        """
+        element_id = str(element_id)
+        if element_id.isdigit():
+            return self.elements.get(int(element_id))
+        if element_id in self.aliases:
+            return self.elements[self.aliases[element_id]]
+        return None
+
+    def step(self, action):
+        """
+        Apply an action of the `webarena_actions` space to the site.
+
+        Args:
+            action (dict): The action, e.g. {"function_name": "click", "arguments": ["12"]}
+        """
+        if not self.elements:
+            self.render()
+        function_name, arguments = action['function_name'], list(action.get('arguments', []))
+        self.message = ""
+
+        if function_name in ('click', 'hover', 'type'):
+            element = self.resolve_element(arguments[0]) if arguments else None
+            if element is None:
+                self.message = f"No element with id {arguments[0] if arguments else ''}"
+            elif function_name == 'click':
+                self._handle(element['handler'])
+            elif function_name == 'type':
+                content = arguments[1] if len(arguments) > 1 else ''
+                press_enter = arguments[2] != '0' if len(arguments) > 2 else True
+                self._type(element['handler'], content, press_enter)
+        elif function_name == 'scroll':
+            page = self.page
+            if 'offset' in page:
+                if (arguments[0] if arguments else 'down') == 'down':
+                    if page['offset'] + page_size < self.listing_size:
+                        page['offset'] += page_size
+                else:
+                    page['offset'] = max(0, page['offset'] - page_size)
+        elif function_name == 'goto' and arguments:
+            self.navigate(self.page_from_url(arguments[0]))
+        elif function_name == 'go_back':
+            tab = self.tabs[self.current_tab]
+            tab['index'] = max(0, tab['index'] - 1)
+        elif function_name == 'go_forward':
+            tab = self.tabs[self.current_tab]
+            tab['index'] = min(len(tab['history']) - 1, tab['index'] + 1)
+        elif function_name == 'new_tab':
+            self.tabs.append({'history': [{'name': 'blank'}], 'index': 0})
+            self.current_tab = len(self.tabs) - 1
+        elif function_name == 'tab_focus' and arguments and str(arguments[0]).isdigit():
+            self.current_tab = min(int(arguments[0]), len(self.tabs) - 1)
+        elif function_name == 'close_tab' and len(self.tabs) > 1:
+            self.tabs.pop(self.current_tab)
+            self.current_tab = min(self.current_tab, len(self.tabs) - 1)
+        # press and hover do not change the state of the site
+        return self.render()
+
+    def _handle(self, handler):
+        if handler is None:
+            return
+        kind, args = handler[0], handler[1:]
+        if kind == 'goto':
+            self.navigate(dict(args[0]))
+        elif kind == 'goto_url':
+            self.navigate(self.page_from_url(args[0]))
+        elif kind == 'offset':
+            self.page['offset'] = args[0]
+        elif kind == 'add_to_cart':
+            quantity = int(self.form.get('quantity', '1') or 1) if self.page['name'] == 'product' else 1
+            self.cart[args[0]] = self.cart.get(args[0], 0) + quantity
+            self.message = f"You added {self.catalog[args[0]]['name']} to your shopping cart."
+        elif kind == 'remove_from_cart':
+            self.cart.pop(args[0], None)
+        elif kind == 'place_order':
+            self._place_order()
+
+    def _type(self, handler, content, press_enter):
+        if handler is None:
+            return
+        kind, args = handler[0], handler[1:]
+        if kind == 'search':
+            if press_enter:
+                self.navigate({'name': 'search', 'query': content, 'offset': 0, 'sort': 'position'})
+        elif kind == 'sort':
+            if content.lower() in ('position', 'price', 'name', 'rating'):
+                self.page['sort'] = content.lower()
+                self.page['offset'] = 0
+        elif kind == 'quantity':
+            self.form['quantity'] = ''.join(c for c in content if c.isdigit()) or '1'
+        elif kind == 'cart_quantity':
+            quantity = int(''.join(c for c in content if c.isdigit()) or 0)
+            if quantity:
+                self.cart[args[0]] = quantity
+            else:
+                self.cart.pop(args[0], None)
+        elif kind == 'field':
+            self.form[args[0]] = content
+
+    def _place_order(self):
+        if not self.cart:
+            self.message = "You have no items in your shopping cart."
+            return
+        total = round(self.cart_total() + shipping_fee, 2)
+        if total > self.balance:
+            self.message = f"Insufficient store credit: order total ${total:.2f} exceeds balance ${self.balance:.2f}."
+            return
+        self.balance = round(self.balance - total, 2)
+        self.orders.append({'order_id': f"{len(self.orders) + 1:09d}", 'items': dict(self.cart), 'total': total})
+        self.cart = {}
+        self.navigate({'name': 'order_confirmation'})
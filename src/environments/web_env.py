@@ -3,6 +3,9 @@ Modeled after WebArena, but simplified
 https://github.com/web-arena-x/webarena/tree/main
 """
 from .base_env import BaseEnv
+from .shopping_site import ShoppingSite
+from reasoning.element_prescreen import ElementPrescreen
+from utils.observation_diff import ObservationDiffer
 
 webarena_actions_list = [
     {
@@ -66,10 +69,23 @@ webarena_actions_list = [
 webarena_actions = {action["function_name"]: {k: v for k, v in action.items()} for action in webarena_actions_list}
 
 class WebEnvironment(BaseEnv):
-    def __init__(self, initial_state, **kwargs):
+    def __init__(self, initial_state, simulated_site=False, site_seed=0, site_balance=500.0, **kwargs):
+        """
+        Args:
+            initial_state (str): Name of the initial state.
+            simulated_site (bool): If True, actions are applied to an offline simulated shopping site,
+                which produces accessibility tree observations. Otherwise observations are synthetic state names.
+            site_seed (int): Seed of the product catalog of the simulated site.
+            site_balance (float): Initial account balance on the simulated site, in dollars.
+        """
         # Initialize any necessary components or variables
         self.state = initial_state
         self.action_space = webarena_actions
+        self.site = ShoppingSite(seed=site_seed, balance=site_balance) if simulated_site else None
+        # Consecutive pages mostly overlap, so each step also reports the delta against the previous observation
+        self.observation_differ = ObservationDiffer()
+        # Clicks, typing and hovering on inert elements of accessibility tree observations are safe without LM calls
+        self.prescreen = ElementPrescreen()
 
     def reset(self):
         """
@@ -77,10 +93,14 @@ class WebEnvironment(BaseEnv):
         """
         # Logic to reset the environment
         print("Environment reset.")
+        self.observation_differ.reset()
+        if self.site is not None:
+            self.site.reset()
+            self.state = self.site.render()
         observation = self.get_observation()
         reward = 0  # Initial reward
         done = False  # Initial done state
-        info = {}  # Additional info
+        info = {'observation_delta': self.observation_differ.diff(observation)}  # Additional info
         return observation, reward, done, info
 
     def get_observation(self):
@@ -97,9 +117,12 @@ class WebEnvironment(BaseEnv):
         """
         # Logic to update the state based on the action
         print(f"Executing action: {action}")
-        self.state = f"state_after_{action}"
+        if self.site is not None:
+            self.state = self.site.step(action)
+        else:
+            self.state = f"state_after_{action}"
         observation = self.get_observation()
         reward = 1  # Example reward
         done = self.state == "terminal_state"  # Example condition for done
-        info = {}  # Additional info
+        info = {'observation_delta': self.observation_differ.diff(observation)}  # Additional info
         return observation, reward, done, info
@@ -0,0 +1,280 @@
+"""
+Idle-time precomputation over the frontier of the WorldModel graph.
+
+Between agent steps, and while the environment executes an action, the guardrail is idle. Meanwhile the
+states one or two transitions ahead of the current effective state often lack what the next checks will
+need, so a background worker walks this frontier and, within a budget of LM calls per idle period, fills in:
+    - the relations of frontier states to the core variables, which are added to the graph, since they
+      only depend on the state (states found by effective state reasoning are added without them)
+    - the next effective state after likely actions from frontier states, and the core variable relations
+      of next states which are new. These are kept aside until the action is actually taken, when graph
+      learning uses them instead of LM calls, so speculation never adds states which are not visited.
+Next states only depend on the state, the action, the neighbors of the state, the task and the core
+variables, so a precomputed next state is used only while the neighbors of its state are unchanged.
+Likely actions are the candidates passed to are_actions_safe and the actions taken most often from a state.
+
+LM calls run in the speculative priority class, so they never delay the checks a caller is waiting for.
+"""
+import threading
+from collections import Counter, OrderedDict
+
+from reasoning.scheduler import lm_priority
+from utils.helpers import action_key
+
+
+class FrontierPrecomputer:
+    def __init__(self, safety_module, lm_budget=4, depth=2, actions_per_state=3, max_entries=1024):
+        """
+        Args:
+            safety_module (SafetyModule): The module whose world model and reasoning are used.
+            lm_budget (int): Maximum number of LM calls per idle period, i.e. between two checks.
+            depth (int): Number of transitions ahead of the current effective state to walk.
+            actions_per_state (int): Number of likely actions whose next state is precomputed per state.
+            max_entries (int): Maximum number of precomputed next states kept; the oldest are dropped first.
+                Also bounds the states whose taken actions are counted, and the actions counted per state.
+        """
+        self.safety_module = safety_module
+        self.lm_budget = lm_budget
+        self.depth = depth
+        self.actions_per_state = actions_per_state
+        self.max_entries = max_entries
+        # (state, action key) -> precomputed next state, see `take`
+        self.next_states = OrderedDict()
+        # Actions taken from each state, least recently taken from first, and from any state
+        self.taken = OrderedDict()
+        self.taken_anywhere = Counter()
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        # The latest state and candidate actions to precompute from, and a counter of notifications,
+        # so that a pass is abandoned as soon as the agent moves on
+        self._target = None
+        self._generation = 0
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        """
+        Start the background worker.
+        """
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='frontier_precompute', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background worker, letting the current LM call finish.
+        """
+        with self._wake:
+            self._stopped = True
+            self._wake.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def notify(self, state, candidate_actions=None):
+        """
+        Start an idle period from the current effective state, e.g. after a check returned.
+        Precomputation of an earlier period which is still running is abandoned.
+
+        Args:
+            state (str): The current effective state.
+            candidate_actions (List[dict]): Actions the agent may take next, e.g. the candidates of are_actions_safe.
+        """
+        # Nothing would pick up the idle period
+        if self._thread is None:
+            return
+        with self._wake:
+            self._generation += 1
+            self._target = (state, [dict(action) for action in candidate_actions or []])
+            self._wake.notify()
+
+    def record_taken(self, state, action):
+        """
+        Record that an action was taken from a state, so that it is considered likely from there.
+        """
+        if self._thread is None:
+            return
+        key = action_key(action)
+        with self._lock:
+            taken = self.taken.pop(state, None) or Counter()
+            self.taken[state] = taken
+            if len(self.taken) > self.max_entries:
+                self.taken.popitem(last=False)
+            for counter in (taken, self.taken_anywhere):
+                counter[key] += 1
+                # The actions taken least often are forgotten, keeping room for new ones
+                if len(counter) > self.max_entries:
+                    kept = counter.most_common(self.max_entries // 2)
+                    counter.clear()
+                    counter.update(dict(kept))
+
+    def take(self, state, action, neighbors_dict):
+        """
+        Get the precomputed next state after an action, if there is one which still holds.
+
+        Args:
+            state (str): The effective state the action is taken from.
+            action (dict): The action.
+            neighbors_dict (Dict[str, dict]): The current neighbors of the state.
+
+        Returns:
+            Tuple[str, bool, List[dict]]: The next effective state, True if it is new, and its core variable
+                relations if it is new (None otherwise). None if there is no precomputed next state.
+        """
+        with self._lock:
+            entry = self.next_states.pop((state, action_key(action)), None)
+            if entry is None:
+                return None
+            if entry['neighbors'] != frozenset(neighbors_dict):
+                self.stats['stale'] += 1
+                return None
+            self.stats['hits'] += 1
+        return entry['next_state'], entry['is_new'], entry['relations']
+
+    def clear(self):
+        """
+        Drop the precomputed next states, e.g. when the knowledge they were derived from was invalidated.
+        """
+        with self._lock:
+            self.next_states.clear()
+
+    def summary(self):
+        """
+        Get counts of passes, LM calls, precomputed relations and next states, and how many were used.
+        """
+        with self._lock:
+            return dict(self.stats, pending=len(self.next_states))
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while self._target is None and not self._stopped:
+                    self._wake.wait()
+                if self._stopped:
+                    return
+                (state, candidates), generation = self._target, self._generation
+                self._target = None
+            with lm_priority('speculative'):
+                try:
+                    self.run_pass(state, candidates, generation)
+                except Exception as e:
+                    # Speculative work must never take the guardrail down
+                    print(f"Frontier precomputation failed: {e}")
+
+    def run_pass(self, state, candidate_actions=(), generation=None):
+        """
+        Walk the frontier from a state breadth first, and precompute what is missing within the LM budget.
+
+        Args:
+            state (str): The current effective state.
+            candidate_actions (List[dict]): Actions the agent may take next from the state.
+            generation (int): The notification the pass belongs to. The pass stops when a newer one arrives.
+
+        Returns:
+            int: The number of LM calls made.
+        """
+        safety_module = self.safety_module
+        world_model = safety_module.world_model
+        calls = 0
+        with self._lock:
+            self.stats['passes'] += 1
+        level, visited = [world_model.resolve_state(state)], set()
+        for depth in range(self.depth + 1):
+            next_level = []
+            for frontier_state in level:
+                if frontier_state in visited:
+                    continue
+                visited.add(frontier_state)
+                if calls >= self.lm_budget or self._superseded(generation):
+                    return calls
+                attributes = world_model.get_node_attributes(frontier_state)
+                # New states of precomputed next states are not in the graph until they are visited
+                if attributes is None:
+                    continue
+                neighbors_dict, edges = world_model.get_outgoing_neighbors_and_edges(frontier_state)
+                if not attributes.get('core_relations_analyzed'):
+                    relations = safety_module.reasoning.can_state_affect_core_variables(
+                        frontier_state, safety_module.core_variables, safety_module.task
+                    )
+                    calls += 1
+                    with self._lock:
+                        self.stats['relations'] += 1
+                        self.stats['lm_calls'] += 1
+                    world_model.add_nodes_and_edges(
+                        [{'node_id': frontier_state, 'node_type': 'state', 'core_relations_analyzed': True}],
+                        [{'subject': frontier_state, 'relation': relation['relation'], 'obj': relation['obj']} for relation in relations],
+                    )
+                    neighbors_dict, edges = world_model.get_outgoing_neighbors_and_edges(frontier_state)
+                next_level += [neighbor for neighbor, neighbor_attributes in neighbors_dict.items()
+                               if neighbor_attributes.get('node_type') == 'state']
+                if depth == self.depth:
+                    continue
+
+                candidates = candidate_actions if depth == 0 else ()
+                for action in self._likely_actions(frontier_state, candidates):
+                    if calls >= self.lm_budget or self._superseded(generation):
+                        return calls
+                    next_state, used = self._precompute_next_state(frontier_state, action, neighbors_dict, edges)
+                    calls += used
+                    next_level.append(next_state)
+            level = next_level
+        return calls
+
+    def _superseded(self, generation):
+        return generation is not None and (self._generation != generation or self._stopped)
+
+    def _likely_actions(self, state, candidate_actions):
+        """
+        Get the likely next actions from a state which are not known to be always safe, most likely first.
+        """
+        safety_module = self.safety_module
+        with self._lock:
+            keys = [action_key(action) for action in candidate_actions]
+            keys += [key for key, _ in self.taken.get(state, Counter()).most_common()]
+            keys += [key for key, _ in self.taken_anywhere.most_common()]
+        likely = []
+        for function_name, arguments in dict.fromkeys(keys):
+            if function_name in safety_module.world_model.always_safe_actions or function_name not in safety_module.action_space:
+                continue
+            likely.append({
+                'function_name': function_name,
+                'arguments': list(arguments),
+                'description': safety_module.action_space[function_name]['description'],
+            })
+            if len(likely) == self.actions_per_state:
+                break
+        return likely
+
+    def _precompute_next_state(self, state, action, neighbors_dict, edges):
+        """
+        Reason about the next state after an action, unless it is already precomputed.
+
+        Returns:
+            Tuple[str, int]: The next state, and the number of LM calls made.
+        """
+        safety_module = self.safety_module
+        key = (state, action_key(action))
+        with self._lock:
+            if key in self.next_states:
+                return self.next_states[key]['next_state'], 0
+
+        core_variables = set(safety_module.core_variables)
+        state_edges = [edge for edge in edges if edge['obj'] not in core_variables]
+        next_state, is_new = safety_module.reasoning.get_next_effective_state(
+            state, action, neighbors_dict, state_edges, safety_module.task, safety_module.core_variables
+        )
+        calls = 1
+        relations = None
+        if is_new:
+            relations = safety_module.reasoning.can_state_affect_core_variables(next_state, safety_module.core_variables, safety_module.task)
+            calls += 1
+        with self._lock:
+            self.stats['next_states'] += 1
+            self.stats['lm_calls'] += calls
+            self.next_states[key] = {
+                'next_state': next_state, 'is_new': is_new, 'relations': relations, 'neighbors': frozenset(neighbors_dict),
+            }
+            while len(self.next_states) > self.max_entries:
+                self.next_states.popitem(last=False)
+        return next_state, calls
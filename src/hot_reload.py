@@ -0,0 +1,132 @@
+"""
+Hot reload of the settings, the action space and the prompt templates in a long-running guardrail process.
+
+A background thread polls the source files of the config package, of the environment module holding the
+action space, and of the reasoning modules registering the prompt templates. When one of them is edited, the
+modules are reloaded and the SafetyModule is given the new task, core variables and action space. Only the
+learned knowledge derived from the inputs which changed is invalidated (see models/dependencies.py), so e.g.
+editing the description of one action keeps the verdicts, param ranges and transitions of all other actions.
+"""
+import importlib
+import os
+import sys
+import threading
+from collections import Counter
+
+# Modules registering prompt templates, reloaded if they were imported
+template_modules = ('reasoning.generic_reasoning', 'reasoning.action_safety')
+
+
+class ConfigReloader:
+    def __init__(self, safety_module, setting_name, environment=None):
+        """
+        Args:
+            safety_module (SafetyModule): The module to reload.
+            setting_name (str): The setting of `config.get_config` the module runs.
+            environment: The environment, whose action space is replaced by the reloaded one.
+        """
+        self.safety_module = safety_module
+        self.setting_name = setting_name
+        self.environment = environment
+        self.stats = {'polls': 0, 'reloads': 0, 'failed_reloads': 0, 'invalidated': Counter()}
+        self._mtimes = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._poll_changed()
+
+    def start(self, interval):
+        """
+        Check for edited source files every interval seconds in a background thread.
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name='config_reload', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread, letting the current reload finish.
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.check()
+            except Exception as e:
+                # An edit which does not load (e.g. a syntax error) keeps the previous settings until it is fixed
+                self.stats['failed_reloads'] += 1
+                print(f"Hot reload failed: {e}")
+
+    def _watched_modules(self):
+        config = sys.modules['config'].get_config(self.setting_name)
+        names = ['config', config['environment']] + [name for name in template_modules if name in sys.modules]
+        return [sys.modules[name] for name in names if name in sys.modules]
+
+    def _poll_changed(self):
+        """
+        Get the watched modules whose source file was modified since the previous poll.
+        """
+        changed = []
+        for module in self._watched_modules():
+            path = getattr(module, '__file__', None)
+            if path is None:
+                continue
+            mtime = os.stat(path).st_mtime_ns
+            if self._mtimes.setdefault(path, mtime) != mtime:
+                self._mtimes[path] = mtime
+                changed.append(module)
+        return changed
+
+    def check(self):
+        """
+        Reload the modules whose source was edited, and the safety module with the reloaded settings.
+
+        Returns:
+            Counter: The number of learned entries invalidated, by kind, or None if nothing was edited.
+        """
+        self.stats['polls'] += 1
+        changed = self._poll_changed()
+        if not changed:
+            return None
+        return self.reload(changed)
+
+    def reload(self, modules=()):
+        """
+        Reload modules, then the safety module with the settings and action space they now define.
+
+        Args:
+            modules (Iterable[module]): The modules to reload, e.g. those which were edited.
+
+        Returns:
+            Counter: The number of learned entries invalidated, by kind.
+        """
+        action_space_name = None
+        environment_module = sys.modules.get(sys.modules['config'].get_config(self.setting_name)['environment'])
+        if environment_module is not None:
+            # The module-level name the action space is bound to, e.g. webarena_actions
+            action_space_name = next(
+                (name for name, value in vars(environment_module).items() if value is self.safety_module.action_space), None
+            )
+        for module in modules:
+            importlib.reload(module)
+
+        config = sys.modules['config'].get_config(self.setting_name)
+        action_space = None
+        if action_space_name is not None:
+            action_space = getattr(sys.modules[config['environment']], action_space_name, None)
+            if self.environment is not None and action_space is not None:
+                self.environment.action_space = action_space
+        invalidated = self.safety_module.reload(config['task'], config['core_variables'], action_space)
+        self.stats['reloads'] += 1
+        self.stats['invalidated'].update(invalidated)
+        print(f"Reloaded {', '.join(module.__name__ for module in modules)}: invalidated {dict(invalidated)}")
+        return invalidated
+
+    def summary(self):
+        """
+        Get counts of polls, reloads and invalidated entries by kind.
+        """
+        return {**self.stats, 'invalidated': dict(self.stats['invalidated'])}
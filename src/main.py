@@ -1,10 +1,14 @@
 import importlib
 import argparse
 from safety_module import SafetyModule
+from hot_reload import ConfigReloader
+from models.world_model_library import WorldModelLibrary
+from reasoning.response_handling import response_stats
+from reasoning.scheduler import lm_scheduler
+from reasoning.single_flight import single_flight
+from utils.profiling import get_profile_dir, profile_dir_env_var, profiler
 from config import get_config
 
-from cognitive_base.utils import lm_cache_init
-
 
 def main(args):
     # Get configuration for the chosen setting
@@ -18,17 +22,41 @@ def main(args):
     kwargs = vars(args)
     agent = agent_cls(scripted_actions=config['scripted_actions'], **kwargs)
     environment = env_cls(**kwargs, **config)
-    safety_module = SafetyModule(action_space=environment.action_space, **kwargs, **config)
+    # Environments which can resolve obvious cases locally provide a pre-screen, e.g. the code environment
+    # The code environment can also preview shell commands in a sandbox, to check the paths they change without the LM
+    filesystem_preview = getattr(environment, 'preview_filesystem', None) if args.preview_commands else None
+    safety_module = SafetyModule(
+        action_space=environment.action_space, prescreen=getattr(environment, 'prescreen', None),
+        filesystem_preview=filesystem_preview, **kwargs, **config
+    )
 
     # Example task and core variables
     task = config['task']
     core_variables = config['core_variables']
 
+    profile_dir = get_profile_dir(args.profile)
+    if profile_dir:
+        profiler.start(overhead_budget=args.overhead_budget / 1000)
+
+    # Warm start from the world model of the most similar previous task in the same environment
+    library = None
+    environment_name = f"{config['environment']}.{config['env_class']}"
+    if args.world_model_dir:
+        library = WorldModelLibrary(args.world_model_dir, min_similarity=args.min_task_similarity)
+        library.warm_start(safety_module.world_model, environment_name, environment.action_space, core_variables, task)
+
     # Step 2: Reason about the typical variation of core variables given the task
     safety_module.analyze_core_variability(core_variables, task)
 
+    # Edits of the settings, action descriptions or prompt templates only invalidate the knowledge derived from them
+    reloader = None
+    if args.hot_reload_interval:
+        reloader = ConfigReloader(safety_module, args.setting_name, environment)
+        reloader.start(args.hot_reload_interval)
+
     # Reset the environment to get the initial observation
     observation, reward, done, info = environment.reset()
+    episode = safety_module.start_episode()
 
     # Agent-environment loop
     while not done:
@@ -39,7 +67,8 @@ def main(args):
             # for purposes of demo, end when scripted actions are exhausted
             break
         # Step 3: Determine if an action affects core variables
-        if safety_module.is_action_safe(observation, action):
+        # The environment reports what changed since the previous observation, so unchanged regions are not reprocessed
+        if safety_module.is_action_safe(observation, action, observation_delta=info.get('observation_delta')):
             # Execute the action in the environment and get the new observation
             print("Action is safe. Executing...")
             observation, reward, done, info = environment.step(action)
@@ -48,6 +77,37 @@ def main(args):
             print("Action is not safe. Further reasoning required.")
             break  # Exit loop if action is not safe
 
+    # Let deferred graph learning finish before exiting
+    if reloader is not None:
+        reloader.stop()
+    safety_module.shutdown()
+    if profile_dir:
+        profiler.stop()
+        profiler.dump(profile_dir)
+        profiler.print_summary()
+        print(f"Profile written to {profile_dir}")
+    environment.close()
+    if library is not None:
+        library.save(safety_module.world_model, environment_name, environment.action_space, task)
+    if args.deadline is not None:
+        print(f"Deadline metrics: {safety_module.get_deadline_metrics()}")
+    if args.verbose:
+        for template_name, stats in response_stats.summary().items():
+            print(f"Responses of {template_name}: {stats}")
+        print(f"Stage planner: {safety_module.planner.summary()}")
+        print(f"Core variable checks resolved locally: {safety_module.core_variable_tracker.stats}")
+        print(f"Single-flight LM requests: {single_flight.summary()}")
+        if args.frontier_lm_budget:
+            print(f"Frontier precomputation: {safety_module.frontier.summary()}")
+        if lm_scheduler.enabled:
+            print(f"LM scheduler: {lm_scheduler.summary()}")
+        if reloader is not None:
+            print(f"Hot reload: {reloader.summary()}")
+        if getattr(environment, 'sandbox_pool', None) is not None:
+            print(f"Sandbox pool: {dict(environment.sandbox_pool.stats)}")
+    for entry in safety_module.audit_log.query(episode=episode):
+        print(f"Audit: {entry['event']} {entry['action']} at stage {entry['stage']}")
+
 
 if __name__ == "__main__":
     # Set up argument parser
@@ -56,8 +116,55 @@ if __name__ == "__main__":
     parser.add_argument("--model_name", type=str, default="gpt-4o-mini-2024-07-18")
     parser.add_argument("--verbose", action="store_true")
     parser.add_argument("--debug_mode", action="store_true")
+    parser.add_argument('--local_model_url', type=str, default=None,
+                        help='URL of a local llama.cpp server to use for reasoning instead of the model named by --model_name.')
+    parser.add_argument('--local_parallel', type=int, default=8,
+                        help='Number of requests in flight to the local server, usually its number of slots.')
     parser.add_argument('--setting_name', type=str, default="webarena_shopping", help='Name of the setting to use.')
+    parser.add_argument('--deadline', type=float, default=None, help='Time budget in seconds for each safety check.')
+    parser.add_argument('--fallback_policy', type=str, default='block',
+                        choices=['block', 'allow_if_always_safe', 'allow_with_audit'],
+                        help='Verdict for actions whose safety check exceeds the deadline.')
+    parser.add_argument('--unsafe_verdict_ttl', type=float, default=None,
+                        help='Seconds until a cached unsafe verdict expires. By default they are kept.')
+    parser.add_argument('--fixed_stage_order', action='store_true',
+                        help='Always check the param range before the effective state, instead of learning the order per action type.')
+    parser.add_argument('--requests_per_minute', type=int, default=None,
+                        help='Rate limit of LM requests, shared by blocking checks and background work.')
+    parser.add_argument('--tokens_per_minute', type=int, default=None,
+                        help='Rate limit of LM tokens, shared by blocking checks and background work.')
+    parser.add_argument('--max_concurrent_lm_calls', type=int, default=None,
+                        help='Maximum number of LM calls in flight.')
+    parser.add_argument('--world_model_snapshot', type=str, default=None,
+                        help='Path of a world model snapshot shared by worker processes through a memory map. Created if missing.')
+    parser.add_argument('--snapshot_merge_interval', type=float, default=None,
+                        help='Seconds between merges of what this worker learned into the shared snapshot. By default it is merged on exit.')
+    parser.add_argument('--frontier_lm_budget', type=int, default=None,
+                        help='Maximum number of speculative LM calls between two checks, spent precomputing the graph ahead of the current state.')
+    parser.add_argument('--graph_maintenance_interval', type=float, default=None,
+                        help='Seconds between background passes which merge near-duplicate states and prune unused ones.')
+    parser.add_argument('--graph_maintenance_window', type=float, default=3600.0,
+                        help='Seconds within which a state or transition counts as recently used, and is kept by graph maintenance.')
+    parser.add_argument('--hot_reload_interval', type=float, default=None,
+                        help='Seconds between checks for edited settings, action descriptions or prompt templates, which are reloaded without a restart.')
+    parser.add_argument('--sandbox_workers', type=int, default=2,
+                        help='Number of pre-forked sandbox workers running the shell commands of the code environment.')
+    parser.add_argument('--preview_commands', action='store_true',
+                        help='Preview shell commands on an overlay of the workspace, so the filesystem core variable check knows the paths they change.')
+    parser.add_argument('--simulated_site', action='store_true',
+                        help='Run web settings against the offline simulated shopping site.')
+    parser.add_argument('--world_model_dir', type=str, default=None,
+                        help='Directory of persisted world models to warm start from and save to.')
+    parser.add_argument('--min_task_similarity', type=float, default=0.3,
+                        help='Minimum similarity of a previous task for its world model to be warm started from.')
+    parser.add_argument('--profile', type=str, default=None,
+                        help=f'Directory to write a profile of the safety checks to. Also enabled by the {profile_dir_env_var} environment variable.')
+    parser.add_argument('--overhead_budget', type=float, default=50,
+                        help='Budget in milliseconds of the time spent per safety check outside of LM calls, when profiling.')
     args = parser.parse_args()
 
+    # Imported here so that parsing arguments does not pull in langchain
+    from cognitive_base.utils import lm_cache_init
+
     lm_cache_init('./lm_cache')
     main(args)
@@ -0,0 +1,116 @@
+"""
+Inputs which the learned knowledge of a WorldModel is derived from, so that a hot reload of the settings,
+the action space or the prompt templates only invalidates the entries which depend on what changed.
+
+Inputs are identified by keys, each with a version (a digest of its value):
+    - 'task': the task
+    - 'initial_state': the initial state of the world model, which the always safe analysis is prompted with
+    - 'core_variables': the list of core variables
+    - 'core_variable:<name>': a core variable, versioned by its type
+    - 'action:<function_name>': the description of an action in the action space
+    - 'template:<name>': a prompt template, as registered in the prompt registry
+The inputs of an entry follow from what it is (e.g. the stage which reached an unsafe verdict, or the action of
+a transition), so they are derived here rather than stored along with each entry:
+    - safe verdicts: everything the checks of the action use
+    - unsafe verdicts: the inputs of the stage which reached them, e.g. the param range for 'range_check'
+    - param ranges, variabilities: the task, and the action or core variable they are about
+    - always safe actions: the task, the initial state, the action and the core variables
+    - graph edges: the transitions and the relations to core variables, which are marked provisional when stale
+"""
+import hashlib
+import json
+
+TASK = 'task'
+INITIAL_STATE = 'initial_state'
+CORE_VARIABLES = 'core_variables'
+
+# Prompt templates used by each kind of entry
+variability_templates = ('variability',)
+param_range_templates = ('usual_param_range',)
+range_check_templates = ('param_within_range', 'batch_param_within_range')
+bounds_templates = ('actual_variation', 'variation_beyond_bounds', 'batch_actual_variation', 'batch_variation_beyond_bounds')
+always_safe_templates = ('always_safe',)
+relation_templates = ('state_affect_core_vars',)
+transition_templates = ('next_state',)
+
+
+def core_variable_input(core_variable):
+    return f'core_variable:{core_variable}'
+
+
+def action_input(function_name):
+    return f'action:{function_name}'
+
+
+def template_inputs(*template_groups):
+    return {f'template:{name}' for templates in template_groups for name in templates}
+
+
+def digest(value):
+    return hashlib.blake2b(json.dumps(value, sort_keys=True, default=str).encode(), digest_size=8).hexdigest()
+
+
+def input_versions(task, core_variables, core_variable_types, action_space, template_versions, initial_state=None):
+    """
+    Get the version of each input.
+
+    Args:
+        task (str): The task.
+        core_variables (List[str]): The core variables.
+        core_variable_types (Dict[str, str]): Type of each core variable.
+        action_space (Dict[str, dict]): The action space.
+        template_versions (Dict[str, str]): Version of each registered prompt template, by name.
+        initial_state (str): The initial state of the world model.
+
+    Returns:
+        Dict[str, str]: Version of each input, by key.
+    """
+    versions = {TASK: digest(task), INITIAL_STATE: digest(initial_state), CORE_VARIABLES: digest(list(core_variables))}
+    for core_variable in core_variables:
+        versions[core_variable_input(core_variable)] = digest(core_variable_types.get(core_variable))
+    for function_name, action in action_space.items():
+        versions[action_input(function_name)] = digest(action)
+    for name, version in template_versions.items():
+        versions[f'template:{name}'] = version
+    return versions
+
+
+def changed_inputs(previous, current):
+    """
+    Get the keys of the inputs whose version changed.
+    Inputs missing from either side count as changed, e.g. actions added to or removed from the action space,
+    or a world model saved before an input was versioned.
+    """
+    return {key for key in previous.keys() | current.keys() if previous.get(key) != current.get(key)}
+
+
+def verdict_inputs(function_name, stage=None, core_variable=None):
+    """
+    Get the inputs of a cached verdict: of the stage which reached it if it is unsafe, else of all stages.
+    """
+    inputs = {TASK, action_input(function_name)}
+    if stage == 'range_check':
+        return inputs | template_inputs(param_range_templates, range_check_templates)
+    if stage == 'bounds' and core_variable is not None:
+        return inputs | {core_variable_input(core_variable)} | template_inputs(variability_templates, bounds_templates)
+    return inputs | {CORE_VARIABLES} | template_inputs(param_range_templates, range_check_templates, variability_templates, bounds_templates)
+
+
+def param_range_inputs(function_name):
+    return {TASK, action_input(function_name)} | template_inputs(param_range_templates)
+
+
+def variability_inputs(core_variable):
+    return {TASK, core_variable_input(core_variable)} | template_inputs(variability_templates)
+
+
+def always_safe_inputs(function_name):
+    return {TASK, INITIAL_STATE, CORE_VARIABLES, action_input(function_name)} | template_inputs(always_safe_templates)
+
+
+def relation_inputs(core_variable):
+    return {TASK, CORE_VARIABLES, core_variable_input(core_variable)} | template_inputs(relation_templates)
+
+
+def transition_inputs(function_name):
+    return {TASK, CORE_VARIABLES, action_input(function_name)} | template_inputs(transition_templates)
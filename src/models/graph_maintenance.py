@@ -0,0 +1,171 @@
+"""
+Background maintenance which keeps the graph of a long-lived WorldModel small.
+
+LM-named states proliferate as near-duplicates (e.g. 'shopping_site_with_item_in_cart' and
+'shopping_site_with_items_in_the_cart'), and transitions which were taken once linger, so candidate
+lists and prompts would grow without bound. Each maintenance pass:
+    - merges states whose names only differ in filler words and singular/plural forms, and which are linked
+      to the same core variables. Any other difference may be one of meaning, e.g. 'logged_in' and 'logged_out'
+      or 'confirmed' and 'not_confirmed', so such states are kept apart
+    - decays the use counts of transitions not taken within a window, and removes those which fall below a threshold
+    - prunes states which are no longer reachable from the initial state and were not used within the window
+Passes are incremental: only the states added since the previous pass are compared for merging,
+and the locks of the world model are held for one operation at a time.
+"""
+import re
+import threading
+import time
+
+# Words which do not tell states apart. Words of polarity (e.g. 'in'/'out', 'on'/'off', 'not', 'no') are content words.
+name_stopwords = {'a', 'an', 'the', 'with', 'of', 'at', 'to', 'for', 'and', 'is', 'has', 'have', 'user'}
+
+
+def state_name_tokens(state):
+    """
+    Get the content words of a state name, singularized, e.g. {'shopping', 'site', 'item', 'in', 'cart'}.
+    """
+    tokens = set()
+    for token in re.split(r'[^a-z0-9]+', state.lower()):
+        if not token or token in name_stopwords:
+            continue
+        if len(token) > 4 and token.endswith('ies'):
+            token = token[:-3] + 'y'
+        elif len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.add(token)
+    return tokens
+
+
+class GraphMaintainer:
+    def __init__(self, world_model, window=3600.0, decay=0.5, min_uses=0.25):
+        """
+        Args:
+            world_model (WorldModel): The world model to maintain.
+            window (float): Seconds within which a state or transition counts as recently used, and is kept.
+            decay (float): Factor applied to the use count of a transition not used within the window, at each pass.
+            min_uses (float): Use count under which a decayed transition is removed.
+        """
+        self.world_model = world_model
+        self.window = window
+        self.decay = decay
+        self.min_uses = min_uses
+        self.stats = {'passes': 0, 'merged_states': 0, 'decayed_transitions': 0, 'removed_transitions': 0, 'pruned_states': 0}
+        self._compared_states = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, interval):
+        """
+        Run a maintenance pass every interval seconds in a background thread.
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name='graph_maintenance', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread, letting the current pass finish.
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.run_pass()
+
+    def run_pass(self):
+        """
+        Run one maintenance pass.
+
+        Returns:
+            dict: The number of states merged, transitions decayed and removed, and states pruned by the pass.
+        """
+        now = time.time()
+        result = {'merged_states': self._merge_equivalent_states(), 'pruned_states': 0}
+        result['decayed_transitions'], result['removed_transitions'] = self._decay_transitions(now)
+        result['pruned_states'] = self._prune_unreachable_states(now)
+        self.stats['passes'] += 1
+        for counter, value in result.items():
+            self.stats[counter] += value
+        return result
+
+    def _core_links(self, state):
+        graph = self.world_model.graph_db.graph
+        core_variables = set(self.world_model.core_variables)
+        return frozenset(
+            (obj, attributes.get('relation')) for _, obj, attributes in graph.out_edges(state, data=True) if obj in core_variables
+        )
+
+    def _merge_equivalent_states(self):
+        world_model = self.world_model
+        with world_model._graph_lock:
+            states = [
+                state for state, attributes in world_model.graph_db.graph.nodes(data=True) if attributes.get('node_type') == 'state'
+            ]
+        new_states = [state for state in states if state not in self._compared_states]
+        tokens = {state: state_name_tokens(state) for state in states}
+
+        merged = 0
+        for state in new_states:
+            for other in states:
+                # Names which differ in any content word are not near-duplicates, however many words they share
+                if other == state or not tokens[state] or tokens[state] != tokens[other]:
+                    continue
+                with world_model._graph_lock:
+                    graph = world_model.graph_db.graph
+                    if state not in graph or other not in graph:
+                        continue
+                    # States which could affect different core variables are never equivalent
+                    if self._core_links(state) != self._core_links(other):
+                        continue
+                    # Keep the state used most, and the initial state always
+                    keep, drop = sorted(
+                        (state, other),
+                        key=lambda node: (node == world_model.initial_state, graph.nodes[node].get('uses', 0), -len(node)),
+                        reverse=True,
+                    )
+                    print(f"Graph maintenance: merging state {drop} into {keep}")
+                    world_model.merge_state(drop, keep)
+                merged += 1
+                if drop == state:
+                    break
+        self._compared_states = {state for state in states if state in world_model.graph_db.graph}
+        return merged
+
+    def _decay_transitions(self, now):
+        world_model = self.world_model
+        decayed, removed = 0, 0
+        with world_model._graph_lock:
+            graph = world_model.graph_db.graph
+            for subject, obj, attributes in list(graph.edges(data=True)):
+                # Links to core variables are safety knowledge, so they never decay
+                if attributes.get('relation') != 'transition':
+                    continue
+                # Transitions from before usage was recorded, e.g. loaded from a saved world model, start their window now
+                if now - attributes.setdefault('last_used', now) < self.window:
+                    continue
+                attributes['uses'] = attributes.get('uses', 1) * self.decay
+                decayed += 1
+                if attributes['uses'] < self.min_uses:
+                    graph.remove_edge(subject, obj)
+                    removed += 1
+        return decayed, removed
+
+    def _prune_unreachable_states(self, now):
+        import networkx as nx
+
+        world_model = self.world_model
+        with world_model._graph_lock:
+            graph = world_model.graph_db.graph
+            reachable = nx.descendants(graph, world_model.initial_state) | {world_model.initial_state}
+            unreachable = [
+                state for state, attributes in graph.nodes(data=True)
+                if attributes.get('node_type') == 'state' and state not in reachable
+                and now - attributes.setdefault('last_used', now) >= self.window
+            ]
+            if unreachable:
+                print(f"Graph maintenance: pruning unreachable states {unreachable}")
+                world_model.remove_states(unreachable)
+        return len(unreachable)
@@ -0,0 +1,740 @@
+"""
+Immutable, memory-mapped snapshots of a WorldModel, which worker processes share without deserializing them.
+
+A snapshot is one file: a JSON header followed by flat arrays. Strings (node IDs, serialized attributes and
+verdicts) live in a string table, the graph in compressed sparse rows of node indices, and the caches in
+open-addressing hash tables keyed by a stable hash of their key. Workers map the file read-only, so the
+operating system shares its pages between them, and queries read the arrays in place.
+
+Each worker writes its deltas to an OverlayWorldModel: a regular WorldModel which only holds what the worker
+learned since the snapshot, and falls back to the snapshot for everything else. Overlays are periodically
+merged into a new snapshot, which replaces the file atomically, so workers pick up each other's knowledge.
+"""
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+from utils.helpers import observation_fingerprint
+
+from .world_model import WorldModel
+
+snapshot_magic = b'WMSNAP01'
+_header_length = struct.Struct('<8sQ')
+
+# Hash tables of the snapshot, and the caches of the world model they index
+_tables = ('node_index', 'cache', 'unsafe_cache', 'effective_state_cache', 'param_ranges',
+           'always_safe_actions', 'analyzed_actions', 'state_aliases')
+
+
+def _stable_hash(key):
+    # Python's hash is salted per process, so workers could not look up each other's tables with it
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') or 1
+
+
+def verdict_key(state, action):
+    """
+    Encode the key of a cached verdict, a state and an action key, as a string.
+    """
+    return json.dumps([state, action[0], list(action[1])])
+
+
+def _decode_verdict_key(key):
+    state, function_name, arguments = json.loads(key)
+    return state, (function_name, tuple(arguments))
+
+
+class _StringTable:
+    def __init__(self):
+        self.strings = []
+        self.indices = {}
+
+    def add(self, string):
+        index = self.indices.get(string)
+        if index is None:
+            index = self.indices[string] = len(self.strings)
+            self.strings.append(string)
+        return index
+
+
+def _build_table(strings, entries):
+    """
+    Build an open-addressing hash table with linear probing, at most half full.
+
+    Args:
+        strings (_StringTable): The string table, to which the keys are added.
+        entries (List[Tuple[str, int]]): The keys and their values.
+
+    Returns:
+        Tuple[array, array, array]: The hashes, key string indices and values of the slots. Empty slots have hash 0.
+    """
+    capacity = 8
+    while capacity < 2 * len(entries):
+        capacity *= 2
+    hashes, keys, values = array('Q', [0]) * capacity, array('I', [0]) * capacity, array('I', [0]) * capacity
+    for key, value in entries:
+        key_hash = _stable_hash(key.encode())
+        slot = key_hash & (capacity - 1)
+        while hashes[slot]:
+            slot = (slot + 1) & (capacity - 1)
+        hashes[slot], keys[slot], values[slot] = key_hash, strings.add(key), value
+    return hashes, keys, values
+
+
+def write_snapshot(data, path):
+    """
+    Write a world model, serialized with `WorldModel.to_dict`, as a snapshot.
+    The file is replaced atomically, so readers see either the previous snapshot or the new one.
+
+    Args:
+        data (dict): The serialized world model.
+        path (str): The path of the snapshot.
+    """
+    strings = _StringTable()
+    nodes = list(data['nodes'])
+    node_index = {node['node_id']: i for i, node in enumerate(nodes)}
+    # Edges may refer to nodes without attributes
+    for edge in data['edges']:
+        for node_id in (edge['subject'], edge['obj']):
+            if node_id not in node_index:
+                node_index[node_id] = len(nodes)
+                nodes.append({'node_id': node_id})
+
+    node_ids = array('I', (strings.add(node['node_id']) for node in nodes))
+    node_attributes = array('I', (
+        strings.add(json.dumps({key: value for key, value in node.items() if key != 'node_id'})) for node in nodes
+    ))
+    out_edges = [[] for _ in nodes]
+    for edge in data['edges']:
+        attributes = {key: value for key, value in edge.items() if key not in ('subject', 'obj')}
+        out_edges[node_index[edge['subject']]].append((node_index[edge['obj']], strings.add(json.dumps(attributes))))
+    edge_starts, edge_targets, edge_attributes = array('I', [0]), array('I'), array('I')
+    for edges in out_edges:
+        for target, attributes in edges:
+            edge_targets.append(target)
+            edge_attributes.append(attributes)
+        edge_starts.append(len(edge_targets))
+
+    entries = {
+        'node_index': list(node_index.items()),
+        'cache': [(verdict_key(state, action), int(is_safe)) for state, action, is_safe in data['cache']],
+        'unsafe_cache': [
+            (verdict_key(state, action), strings.add(json.dumps(verdict))) for state, action, verdict in data.get('unsafe_cache', [])
+        ],
+        'effective_state_cache': [(fingerprint, strings.add(state)) for fingerprint, state in data['effective_state_cache'].items()],
+        'param_ranges': [(function_name, strings.add(json.dumps(param_range))) for function_name, param_range in data['param_ranges'].items()],
+        'always_safe_actions': [(function_name, 1) for function_name in data['always_safe_actions']],
+        'analyzed_actions': [(function_name, 1) for function_name in data['analyzed_actions']],
+        'state_aliases': [(alias, strings.add(state)) for alias, state in data.get('state_aliases', {}).items()],
+    }
+    arrays = {
+        'node_ids': node_ids, 'node_attributes': node_attributes,
+        'edge_starts': edge_starts, 'edge_targets': edge_targets, 'edge_attributes': edge_attributes,
+    }
+    for table in _tables:
+        arrays[f'{table}.hashes'], arrays[f'{table}.keys'], arrays[f'{table}.values'] = _build_table(strings, entries[table])
+
+    # Actions linked to core variables, see `WorldModel.is_linked_to_core_variables`, so that overlays need no scan
+    core_variables = set(data['core_variables'])
+    linked_states = {edge['subject'] for edge in data['edges'] if edge['obj'] in core_variables}
+    linked_actions = {edge['action'] for edge in data['edges'] if edge.get('action') is not None and edge['obj'] in linked_states}
+    linked_actions.update(action[0] for _, action, verdict in data.get('unsafe_cache', []) if verdict['core_variable'] is not None)
+
+    encoded = [string.encode() for string in strings.strings]
+    string_offsets = array('Q', [0])
+    for string in encoded:
+        string_offsets.append(string_offsets[-1] + len(string))
+    arrays['string_offsets'] = string_offsets
+    blobs = {name: values.tobytes() for name, values in arrays.items()}
+    blobs['string_data'] = b''.join(encoded)
+
+    # Sections are 8-byte aligned, so that they can be cast to arrays in place
+    sections, offset = {}, 0
+    for name, blob in blobs.items():
+        sections[name] = (offset, len(blob), getattr(arrays.get(name), 'typecode', 'B'))
+        offset += (len(blob) + 7) // 8 * 8
+    header = json.dumps({
+        'initial_state': data.get('initial_state'),
+        'core_variables': data['core_variables'],
+        'input_versions': data.get('input_versions', {}),
+        'linked_actions': sorted(linked_actions),
+        'table_sizes': {table: len(entries[table]) for table in _tables},
+        'sections': sections,
+    }).encode()
+    header += b' ' * (-(len(header) + _header_length.size) % 8)
+
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(_header_length.pack(snapshot_magic, len(header)))
+        f.write(header)
+        for name, blob in blobs.items():
+            f.write(blob)
+            f.write(b'\0' * (-len(blob) % 8))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class WorldModelSnapshot:
+    """
+    Read-only view of a snapshot file, queried in place through a shared memory map.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_length = _header_length.unpack_from(self._mmap)
+        if magic != snapshot_magic:
+            raise ValueError(f"{path} is not a world model snapshot")
+        header = json.loads(self._mmap[_header_length.size:_header_length.size + header_length])
+        self.initial_state = header['initial_state']
+        self.core_variables = header['core_variables']
+        self.input_versions = header.get('input_versions', {})
+        self.linked_actions = frozenset(header.get('linked_actions', []))
+
+        view = memoryview(self._mmap)
+        base = _header_length.size + header_length
+        self._arrays = {}
+        for name, (offset, length, typecode) in header['sections'].items():
+            self._arrays[name] = view[base + offset:base + offset + length].cast(typecode)
+        self._string_offsets = self._arrays['string_offsets']
+        self._string_data = self._arrays['string_data']
+        self.num_nodes = len(self._arrays['node_ids'])
+        self._tables = {
+            table: (self._arrays[f'{table}.hashes'], self._arrays[f'{table}.keys'], self._arrays[f'{table}.values'],
+                    len(self._arrays[f'{table}.hashes']) - 1, header['table_sizes'][table])
+            for table in _tables
+        }
+
+    def string(self, index):
+        return str(self._string_data[self._string_offsets[index]:self._string_offsets[index + 1]], 'utf-8')
+
+    def _lookup(self, table, key):
+        """
+        Look up a key in a hash table of the snapshot.
+
+        Returns:
+            int: The value of the key, or None if it is not in the table.
+        """
+        hashes, keys, values, mask, size = self._tables[table]
+        if not size:
+            return None
+        key = key.encode()
+        key_hash = _stable_hash(key)
+        slot = key_hash & mask
+        while hashes[slot]:
+            if hashes[slot] == key_hash:
+                index = keys[slot]
+                if self._string_data[self._string_offsets[index]:self._string_offsets[index + 1]] == key:
+                    return values[slot]
+            slot = (slot + 1) & mask
+        return None
+
+    def _items(self, table):
+        hashes, keys, values, _, _ = self._tables[table]
+        for slot in range(len(hashes)):
+            if hashes[slot]:
+                yield self.string(keys[slot]), values[slot]
+
+    def contains(self, table, key):
+        return self._lookup(table, key) is not None
+
+    def keys(self, table):
+        return [key for key, _ in self._items(table)]
+
+    def node_index(self, node_id):
+        return self._lookup('node_index', node_id)
+
+    def node_attributes(self, node_id):
+        """
+        Get the attributes of a node, or None if it is not in the snapshot.
+        """
+        index = self.node_index(node_id)
+        return None if index is None else json.loads(self.string(self._arrays['node_attributes'][index]))
+
+    def out_edges(self, node_id):
+        """
+        Get the outgoing edges of a node.
+
+        Returns:
+            List[Tuple[str, dict]]: The target node ID and the attributes of each edge.
+        """
+        index = self.node_index(node_id)
+        if index is None:
+            return []
+        starts, targets, attributes = self._arrays['edge_starts'], self._arrays['edge_targets'], self._arrays['edge_attributes']
+        node_ids = self._arrays['node_ids']
+        return [
+            (self.string(node_ids[targets[edge]]), json.loads(self.string(attributes[edge])))
+            for edge in range(starts[index], starts[index + 1])
+        ]
+
+    def nodes(self):
+        for index in range(self.num_nodes):
+            yield self.string(self._arrays['node_ids'][index]), json.loads(self.string(self._arrays['node_attributes'][index]))
+
+    def edges(self):
+        starts, targets, attributes = self._arrays['edge_starts'], self._arrays['edge_targets'], self._arrays['edge_attributes']
+        node_ids = self._arrays['node_ids']
+        for index in range(self.num_nodes):
+            subject = self.string(node_ids[index])
+            for edge in range(starts[index], starts[index + 1]):
+                yield subject, self.string(node_ids[targets[edge]]), json.loads(self.string(attributes[edge]))
+
+    def query_cache(self, state, action):
+        value = self._lookup('cache', verdict_key(state, action))
+        return None if value is None else bool(value)
+
+    def query_unsafe_verdict(self, state, action):
+        value = self._lookup('unsafe_cache', verdict_key(state, action))
+        return None if value is None else json.loads(self.string(value))
+
+    def unsafe_verdicts(self):
+        for key, value in self._items('unsafe_cache'):
+            yield _decode_verdict_key(key), json.loads(self.string(value))
+
+    def query_effective_state(self, fingerprint):
+        value = self._lookup('effective_state_cache', fingerprint)
+        return None if value is None else self.string(value)
+
+    def get_param_range(self, function_name):
+        value = self._lookup('param_ranges', function_name)
+        return None if value is None else json.loads(self.string(value))
+
+    def resolve_state(self, state):
+        value = self._lookup('state_aliases', state)
+        return state if value is None else self.string(value)
+
+    def to_dict(self):
+        """
+        Deserialize the snapshot into the format of `WorldModel.to_dict`.
+        """
+        return {
+            'initial_state': self.initial_state,
+            'nodes': [{'node_id': node_id, **attributes} for node_id, attributes in self.nodes()],
+            'edges': [{'subject': subject, 'obj': obj, **attributes} for subject, obj, attributes in self.edges()],
+            'core_variables': list(self.core_variables),
+            'cache': [[*_decode_verdict_key(key), bool(value)] for key, value in self._items('cache')],
+            'effective_state_cache': {key: self.string(value) for key, value in self._items('effective_state_cache')},
+            'always_safe_actions': sorted(self.keys('always_safe_actions')),
+            'analyzed_actions': sorted(self.keys('analyzed_actions')),
+            'param_ranges': {key: json.loads(self.string(value)) for key, value in self._items('param_ranges')},
+            'unsafe_cache': [[*key, verdict] for key, verdict in self.unsafe_verdicts()],
+            'state_aliases': {key: self.string(value) for key, value in self._items('state_aliases')},
+            'input_versions': dict(self.input_versions),
+        }
+
+
+class _OverlaySet(set):
+    """
+    Set of the overlay, whose membership tests fall back to a table of the snapshot.
+    """
+    def __init__(self, world_model, table):
+        super().__init__()
+        self.world_model = world_model
+        self.table = table
+
+    def __contains__(self, item):
+        return set.__contains__(self, item) or self.world_model.snapshot.contains(self.table, item)
+
+
+class _OverlayParamRanges(dict):
+    """
+    Parameter ranges of the overlay, whose lookups fall back to the snapshot.
+    """
+    def __init__(self, world_model):
+        super().__init__()
+        self.world_model = world_model
+
+    def __contains__(self, function_name):
+        return dict.__contains__(self, function_name) or self.world_model.snapshot.contains('param_ranges', function_name)
+
+    def get(self, function_name, default=None):
+        if dict.__contains__(self, function_name):
+            return dict.__getitem__(self, function_name)
+        param_range = self.world_model.snapshot.get_param_range(function_name)
+        return default if param_range is None else param_range
+
+    def __getitem__(self, function_name):
+        param_range = self.get(function_name)
+        if param_range is None:
+            raise KeyError(function_name)
+        return param_range
+
+
+def merge_world_model_dicts(base, delta, dropped_unsafe_verdicts=()):
+    """
+    Merge the deltas of an overlay into a serialized world model. Entries of the delta take precedence.
+
+    Args:
+        base (dict): The serialized world model, e.g. of a snapshot.
+        delta (dict): The serialized overlay.
+        dropped_unsafe_verdicts (Iterable[Tuple]): Keys of unsafe verdicts of the base which the overlay dropped.
+
+    Returns:
+        dict: The merged world model.
+    """
+    nodes = {node['node_id']: dict(node) for node in base['nodes']}
+    for node in delta['nodes']:
+        nodes.setdefault(node['node_id'], {'node_id': node['node_id']}).update(node)
+    edges = {(edge['subject'], edge['obj']): dict(edge) for edge in base['edges']}
+    for edge in delta['edges']:
+        edges.setdefault((edge['subject'], edge['obj']), {}).update(edge)
+
+    cache = {(state, (action[0], tuple(action[1]))): is_safe for state, action, is_safe in base['cache']}
+    unsafe_cache = {(state, (action[0], tuple(action[1]))): verdict for state, action, verdict in base.get('unsafe_cache', [])}
+    for key in dropped_unsafe_verdicts:
+        unsafe_cache.pop(key, None)
+    for state, action, is_safe in delta['cache']:
+        key = (state, (action[0], tuple(action[1])))
+        cache[key] = is_safe
+        unsafe_cache.pop(key, None)
+    for state, action, verdict in delta.get('unsafe_cache', []):
+        key = (state, (action[0], tuple(action[1])))
+        unsafe_cache[key] = verdict
+        cache.pop(key, None)
+
+    return {
+        'initial_state': base.get('initial_state') or delta.get('initial_state'),
+        'nodes': list(nodes.values()),
+        'edges': list(edges.values()),
+        'core_variables': delta['core_variables'] or base['core_variables'],
+        'cache': [[state, list(action), is_safe] for (state, action), is_safe in cache.items()],
+        'effective_state_cache': {**base['effective_state_cache'], **delta['effective_state_cache']},
+        'always_safe_actions': sorted(set(base['always_safe_actions']) | set(delta['always_safe_actions'])),
+        'analyzed_actions': sorted(set(base['analyzed_actions']) | set(delta['analyzed_actions'])),
+        'param_ranges': {**base['param_ranges'], **delta['param_ranges']},
+        'unsafe_cache': [[state, list(action), verdict] for (state, action), verdict in unsafe_cache.items()],
+        'state_aliases': {**base.get('state_aliases', {}), **delta.get('state_aliases', {})},
+        'input_versions': {**base.get('input_versions', {}), **delta.get('input_versions', {})},
+    }
+
+
+class OverlayWorldModel(WorldModel):
+    """
+    World model of a worker, backed by a shared snapshot. What the worker learns goes into a small overlay,
+    which is a regular WorldModel, and queries fall back to the snapshot for everything else.
+
+    The graph of the overlay only holds the nodes and edges added since the snapshot, so graph maintenance
+    should run on the merged world model rather than on an overlay. Changes which drop entries of the snapshot,
+    e.g. invalidation or merging states, are applied by writing a new snapshot.
+    """
+    def __init__(self, snapshot_path, initial_state=None, verbose=False, unsafe_verdict_ttl=None, **kwargs):
+        """
+        Args:
+            snapshot_path (str): Path of the snapshot. If it does not exist, an empty one is created.
+            initial_state (str): Initial state of the world model, if the snapshot has to be created.
+        """
+        self.snapshot_path = snapshot_path
+        if not os.path.exists(snapshot_path):
+            write_snapshot(WorldModel(initial_state).to_dict(), snapshot_path)
+        self.snapshot = WorldModelSnapshot(snapshot_path)
+        super().__init__(self.snapshot.initial_state or initial_state, verbose=verbose, unsafe_verdict_ttl=unsafe_verdict_ttl)
+        self._reset_overlay()
+        self._merge_stop = threading.Event()
+        self._merge_thread = None
+
+    def _reset_overlay(self):
+        from cognitive_base.utils.database.graph_db.nx_db import NxDb
+
+        self.graph_db = NxDb()
+        self.graph_db.add_node(self.initial_state, {'node_type': 'state'})
+        self.core_variables = list(self.snapshot.core_variables)
+        self.input_versions = dict(self.snapshot.input_versions)
+        self.cache = {}
+        self.unsafe_cache = {}
+        self.effective_state_cache = {}
+        self.always_safe_actions = _OverlaySet(self, 'always_safe_actions')
+        self.analyzed_actions = _OverlaySet(self, 'analyzed_actions')
+        self.param_ranges = _OverlayParamRanges(self)
+        self.state_aliases = {}
+        self.linked_actions = set(self.snapshot.linked_actions)
+        # Unsafe verdicts of the snapshot which no longer hold
+        self.dropped_unsafe_verdicts = set()
+
+    def overlay_size(self):
+        """
+        Get the number of entries of the overlay, to decide when to merge it.
+        """
+        graph = self.graph_db.graph
+        return (graph.number_of_nodes() + graph.number_of_edges() + len(self.cache) + len(self.unsafe_cache)
+                + len(self.effective_state_cache) + len(self.dropped_unsafe_verdicts))
+
+    def resolve_state(self, state):
+        state = self.state_aliases.get(state, state)
+        return self.snapshot.resolve_state(state) if state is not None else state
+
+    def _has_node(self, node_id):
+        return node_id in self.graph_db.graph or self.snapshot.node_index(node_id) is not None
+
+    def _node_attributes(self, node_id):
+        """
+        Get the attributes of a node, from the snapshot updated by the overlay, or None if it is in neither.
+        """
+        attributes = self.snapshot.node_attributes(node_id)
+        if node_id in self.graph_db.graph:
+            attributes = {**(attributes or {}), **self.graph_db.graph.nodes[node_id]}
+        return attributes
+
+    def _out_edges(self, node_id):
+        edges = dict(self.snapshot.out_edges(node_id))
+        if node_id in self.graph_db.graph:
+            for _, obj, attributes in self.graph_db.graph.out_edges(node_id, data=True):
+                edges[obj] = {**edges.get(obj, {}), **attributes}
+        return edges
+
+    def query_cache(self, observation, action):
+        key = (self.resolve_state(observation), action)
+        is_safe = self.cache.get(key)
+        if is_safe is not None:
+            return is_safe
+        # An unsafe verdict of the overlay overrides a safe one of the snapshot
+        if key in self.unsafe_cache:
+            return None
+        return self.snapshot.query_cache(*key)
+
+    def store_cache(self, observation, action, is_safe):
+        observation = self.resolve_state(observation)
+        with self._cache_lock:
+            super().store_cache(observation, action, is_safe)
+            if is_safe:
+                self.dropped_unsafe_verdicts.add((observation, action))
+
+    def query_unsafe_verdict(self, state, action):
+        state = self.resolve_state(state)
+        verdict = super().query_unsafe_verdict(state, action)
+        if verdict is not None:
+            return verdict
+        key = (state, action)
+        if key in self.cache or key in self.dropped_unsafe_verdicts:
+            return None
+        verdict = self.snapshot.query_unsafe_verdict(*key)
+        if verdict is not None and self.unsafe_verdict_ttl is not None and time.time() - verdict['time'] > self.unsafe_verdict_ttl:
+            return None
+        return verdict
+
+    def store_unsafe_verdict(self, state, action, reason, stage, core_variable=None):
+        state = self.resolve_state(state)
+        with self._cache_lock:
+            super().store_unsafe_verdict(state, action, reason, stage, core_variable)
+            self.dropped_unsafe_verdicts.discard((state, action))
+
+    def invalidate_unsafe_verdicts(self, state=None, function_name=None, stage=None, core_variable=None):
+        with self._cache_lock:
+            dropped = super().invalidate_unsafe_verdicts(state, function_name, stage, core_variable)
+            for (verdict_state, action), verdict in self.snapshot.unsafe_verdicts():
+                if ((state is None or verdict_state == state)
+                        and (function_name is None or action[0] == function_name)
+                        and (stage is None or verdict['stage'] == stage)
+                        and (core_variable is None or verdict['core_variable'] == core_variable)
+                        and (verdict_state, action) not in self.dropped_unsafe_verdicts):
+                    self.dropped_unsafe_verdicts.add((verdict_state, action))
+                    dropped += 1
+        return dropped
+
+    def invalidate_inputs(self, changed):
+        # Entries of the snapshot other than unsafe verdicts cannot be shadowed by the overlay, so the snapshot
+        # is written again without them
+        if not changed:
+            return super().invalidate_inputs(changed)
+
+        def invalidate(world_model):
+            # Versions of removed inputs, kept by the merge, are dropped too
+            world_model.input_versions = dict(self.input_versions)
+            return world_model.invalidate_inputs(changed)
+
+        return self.merge(invalidate)
+
+    def query_effective_state_cache(self, observation=None, fingerprint=None):
+        fingerprint = fingerprint or observation_fingerprint(observation)
+        effective_state = self.effective_state_cache.get(fingerprint)
+        if effective_state is None:
+            effective_state = self.snapshot.query_effective_state(fingerprint)
+            if effective_state is not None:
+                effective_state = self.resolve_state(effective_state)
+        if effective_state is not None:
+            self.record_state_use(effective_state)
+        return effective_state
+
+    def set_variability(self, core_variables, variabilities, bounds=None):
+        with self._graph_lock:
+            for core_variable, variability, core_bounds in zip(core_variables, variabilities, bounds or [None] * len(core_variables)):
+                attributes = self.snapshot.node_attributes(core_variable) or {}
+                previous = (attributes.get('variability', variability), attributes.get('bounds', core_bounds))
+                if core_variable not in self.graph_db.graph and previous != (variability, core_bounds):
+                    self.invalidate_unsafe_verdicts(core_variable=core_variable)
+            super().set_variability(core_variables, variabilities, bounds)
+
+    def get_variability(self, core_variable):
+        with self._graph_lock:
+            return self._node_attributes(core_variable)['variability']
+
+    def get_bounds(self, core_variable):
+        with self._graph_lock:
+            return self._node_attributes(core_variable).get('bounds')
+
+    def get_known_variabilities(self, core_variables):
+        with self._graph_lock:
+            attributes = [self._node_attributes(core_variable) or {} for core_variable in core_variables]
+            if not all('variability' in core_attributes for core_attributes in attributes):
+                return None
+            return [core_attributes['variability'] for core_attributes in attributes]
+
+    def get_candidate_effective_states(self, previous_effective_state):
+        with self._graph_lock:
+            previous_effective_state = self.resolve_state(previous_effective_state)
+            if not self._has_node(previous_effective_state):
+                previous_effective_state = self.initial_state
+            candidate_states = {previous_effective_state}
+            for neighbor in self._out_edges(previous_effective_state):
+                if (self._node_attributes(neighbor) or {}).get('node_type') == 'state':
+                    candidate_states.add(neighbor)
+        return list(candidate_states)
+
+    def get_states_to_reanalyze(self):
+        with self._graph_lock:
+            states = dict(self.snapshot.nodes())
+            for node_id, attributes in self.graph_db.graph.nodes(data=True):
+                states[node_id] = {**states.get(node_id, {}), **attributes}
+        return [
+            node_id for node_id, attributes in states.items()
+            if attributes.get('node_type') == 'state' and attributes.get('core_relations_analyzed') is False
+        ]
+
+    def get_node_attributes(self, node_id):
+        with self._graph_lock:
+            return self._node_attributes(self.resolve_state(node_id))
+
+    def get_outgoing_neighbors_and_edges(self, node_id):
+        neighbors_dict = {}
+        edges = []
+        with self._graph_lock:
+            node_id = self.resolve_state(node_id)
+            for neighbor, edge_attributes in self._out_edges(node_id).items():
+                neighbors_dict[neighbor] = self._node_attributes(neighbor) or {}
+                edges.append({
+                    'subject': node_id,
+                    'relation': edge_attributes.get('relation', ''),
+                    'obj': neighbor,
+                    **edge_attributes
+                })
+        return neighbors_dict, edges
+
+    def confirm_edge(self, subject, obj):
+        with self._graph_lock:
+            subject, obj = self.resolve_state(subject), self.resolve_state(obj)
+            if not self.graph_db.graph.has_edge(subject, obj):
+                # Edges of the snapshot are confirmed by copying them to the overlay
+                edge_attributes = dict(self.snapshot.out_edges(subject)).get(obj)
+                if edge_attributes and edge_attributes.get('provisional'):
+                    self.graph_db.graph.add_edge(subject, obj, **dict(edge_attributes, provisional=False))
+                return
+            super().confirm_edge(subject, obj)
+
+    def _is_state_linked(self, state):
+        return not set(self.core_variables).isdisjoint(self._out_edges(state))
+
+    def _link_actions_into(self, state):
+        if not self._is_state_linked(state):
+            return
+        edges = list(self.graph_db.graph.in_edges(state, data=True)) if state in self.graph_db.graph else []
+        # The snapshot only indexes outgoing edges, but the actions into states it links are already in its index,
+        # and states of the snapshot are rarely linked after it was written
+        snapshot_targets = {obj for obj, _ in self.snapshot.out_edges(state)}
+        if self.snapshot.node_index(state) is not None and set(self.snapshot.core_variables).isdisjoint(snapshot_targets):
+            edges.extend(edge for edge in self.snapshot.edges() if edge[1] == state)
+        self.linked_actions.update(attributes['action'] for _, _, attributes in edges if attributes.get('action') is not None)
+
+    def _index_linked_actions(self):
+        with self._graph_lock, self._cache_lock:
+            edges = [(obj, attributes) for _, obj, attributes in self.snapshot.edges()]
+            edges.extend((obj, attributes) for _, obj, attributes in self.graph_db.graph.edges(data=True))
+            linked = {attributes['action'] for obj, attributes in edges if attributes.get('action') is not None and self._is_state_linked(obj)}
+            verdicts = list(self.unsafe_cache.items()) + [
+                (key, verdict) for key, verdict in self.snapshot.unsafe_verdicts() if key not in self.dropped_unsafe_verdicts
+            ]
+            linked.update(action[0] for (_, action), verdict in verdicts if verdict['core_variable'] is not None)
+            self.linked_actions = linked
+
+    def merge_state(self, state, into):
+        self.merge(lambda world_model: world_model.merge_state(state, into))
+
+    def remove_states(self, states):
+        self.merge(lambda world_model: world_model.remove_states(states))
+
+    def to_dict(self):
+        """
+        Serialize the snapshot merged with the overlay.
+        """
+        with self._graph_lock, self._cache_lock:
+            return merge_world_model_dicts(self.snapshot.to_dict(), super().to_dict(), self.dropped_unsafe_verdicts)
+
+    def check_consistency(self):
+        merged = WorldModel(self.initial_state)
+        merged.load_dict(self.to_dict(), provisional=False)
+        return merged.check_consistency()
+
+    def merge(self, update=None):
+        """
+        Merge the overlay into a new snapshot, along with the snapshot written meanwhile by other workers,
+        and continue from it with an empty overlay.
+        Workers merge under a lock on the snapshot file, so that none of their deltas are lost.
+
+        Args:
+            update (Callable[[WorldModel], Any]): Applied to the merged world model before it is written,
+                for changes which the overlay cannot shadow, e.g. dropping entries of the snapshot.
+
+        Returns:
+            The result of the update, if any.
+        """
+        result = None
+        # The world model is locked before the file, as callers of the update may already hold its locks
+        with self._graph_lock, self._cache_lock, open(f"{self.snapshot_path}.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            latest = WorldModelSnapshot(self.snapshot_path)
+            merged = merge_world_model_dicts(latest.to_dict(), super().to_dict(), self.dropped_unsafe_verdicts)
+            if update is not None:
+                world_model = WorldModel(self.initial_state)
+                world_model.core_variables = merged['core_variables']
+                world_model.load_dict(merged, provisional=False)
+                result = update(world_model)
+                merged = world_model.to_dict()
+            write_snapshot(merged, self.snapshot_path)
+            self.snapshot = WorldModelSnapshot(self.snapshot_path)
+            self._reset_overlay()
+        return result
+
+    def refresh(self):
+        """
+        Continue from the snapshot on disk if another worker replaced it, merging the overlay into it.
+        """
+        stat = os.stat(self.snapshot_path)
+        if (stat.st_ino, stat.st_mtime_ns) != (self.snapshot.stat.st_ino, self.snapshot.stat.st_mtime_ns):
+            self.merge()
+
+    def start(self, interval):
+        """
+        Merge the overlay every interval seconds in a background thread, if it holds anything.
+        """
+        self._merge_stop.clear()
+        self._merge_thread = threading.Thread(target=self._run, args=(interval,), name='snapshot_merge', daemon=True)
+        self._merge_thread.start()
+
+    def stop(self):
+        if self._merge_thread is not None:
+            self._merge_stop.set()
+            self._merge_thread.join()
+            self._merge_thread = None
+
+    def _run(self, interval):
+        while not self._merge_stop.wait(interval):
+            if self.overlay_size() > 1:
+                self.merge()
+            else:
+                self.refresh()
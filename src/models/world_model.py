@@ -1,37 +1,166 @@
-from cognitive_base.utils.database.graph_db.nx_db import NxDb
-import networkx as nx
+import threading
+import time
+from collections import Counter
+
+from utils.helpers import observation_fingerprint
+from .dependencies import (
+    CORE_VARIABLES, always_safe_inputs, changed_inputs, param_range_inputs, relation_inputs, transition_inputs,
+    variability_inputs, verdict_inputs,
+)
+
+fingerprint_length = len(observation_fingerprint(''))
 
 
 class WorldModel:
-    def __init__(self, initial_state, verbose=False, **kwargs):
+    """
+    Learned knowledge about the environment, which can be shared by concurrent sessions.
+
+    Updates are thread-safe. Reads and writes of the graph are serialized by one lock, and
+    operations spanning several verdict cache entries by another. Single-key cache reads and
+    writes need no lock, since each is atomic on a dict.
+    """
+    def __init__(self, initial_state, verbose=False, unsafe_verdict_ttl=None, **kwargs):
+        # Imported here so that importing the module does not pull in networkx
+        from cognitive_base.utils.database.graph_db.nx_db import NxDb
+
         # Initialize the graph database
         self.graph_db = NxDb()  # self.graph_db.graph is a networkx graph
         self.verbose = verbose
         self.core_variables = []
         self.cache = {}  # Cache to store safety results
-        self.effective_state_cache = {}  # Cache to store effective states
+        self.effective_state_cache = {}  # Cache to store effective states, keyed by observation fingerprint
         self.always_safe_actions = set()  # Set of actions that are always safe
         self.analyzed_actions = set()  # Set of actions that have been analyzed for always safe
         self.param_ranges = {}  # Dictionary to store parameter ranges
+        # Unsafe verdicts with why they were reached, so that retried blocked actions resolve without LM calls.
+        # Verdicts which do not depend on the effective state (e.g. parameters out of range) are stored under state None.
+        self.unsafe_cache = {}
+        self.unsafe_verdict_ttl = unsafe_verdict_ttl  # Seconds until an unsafe verdict expires, None to keep them
+        self._graph_lock = threading.RLock()
+        self._cache_lock = threading.RLock()
+        self.initial_state = initial_state
+        # States merged into an equivalent one by graph maintenance -> the state they were merged into
+        self.state_aliases = {}
+        # Versions of the inputs the learned knowledge was derived from (task, core variables, actions, templates),
+        # see models/dependencies.py
+        self.input_versions = {}
+        # Function names of the actions linked to core variables, see `is_linked_to_core_variables`.
+        # Updated as edges and unsafe verdicts are added, so that checks need no scan of the graph. Links are
+        # kept when edges or verdicts are removed, which only makes checks of the action more thorough.
+        self.linked_actions = set()
 
         self.graph_db.add_node(initial_state, {'node_type': 'state'})
 
-    def set_variability(self, core_variables, variabilities):
+    def set_variability(self, core_variables, variabilities, bounds=None):
         """
         Set the variability of core variables in the world model.
         
         Args:
             core_variables (List[str]): List of core variable names.
             variabilities (List[str]): List of variability information.
+            bounds (List[dict]): The variabilities compiled into machine-checkable bounds,
+                None for those which could not be compiled.
         """
-        for core_variable, variability in zip(core_variables, variabilities):
-            node_id = core_variable
-            attributes = {
-                'node_type': 'core_variable',
-                'variability': variability
+        bounds = bounds or [None] * len(core_variables)
+        with self._graph_lock:
+            graph = self.graph_db.graph
+            previous_variabilities = {
+                core_variable: (graph.nodes[core_variable].get('variability'), graph.nodes[core_variable].get('bounds'))
+                for core_variable in core_variables if core_variable in graph
             }
-            self.graph_db.add_node(node_id, verbose=self.verbose, **attributes)
-        self.core_variables = core_variables
+            for core_variable, variability, core_bounds in zip(core_variables, variabilities, bounds):
+                node_id = core_variable
+                attributes = {
+                    'node_type': 'core_variable',
+                    'variability': variability,
+                    'bounds': core_bounds,
+                }
+                self.graph_db.add_node(node_id, verbose=self.verbose, **attributes)
+                # Verdicts reached against a different variability no longer hold
+                if previous_variabilities.get(core_variable, (variability, core_bounds)) != (variability, core_bounds):
+                    self.invalidate_unsafe_verdicts(core_variable=core_variable)
+            if core_variables != self.core_variables:
+                self.core_variables = core_variables
+                self._index_linked_actions()
+
+    def set_inputs(self, versions):
+        """
+        Record the versions of the inputs the learned knowledge is derived from, e.g. after a hot reload,
+        and invalidate the entries which depend on inputs whose version changed.
+
+        Args:
+            versions (Dict[str, str]): Version of each input, as returned by `dependencies.input_versions`.
+
+        Returns:
+            Counter: The number of entries invalidated, by kind.
+        """
+        with self._graph_lock, self._cache_lock:
+            changed = changed_inputs(self.input_versions, versions)
+            self.input_versions = dict(versions)
+            return self.invalidate_inputs(changed)
+
+    def invalidate_inputs(self, changed):
+        """
+        Invalidate the entries which depend on any of the given inputs.
+        Task-specific entries (verdicts, param ranges, variabilities, always safe analyses) are dropped.
+        Graph edges hold across tasks, as in `load_dict`, so stale ones are kept but marked provisional,
+        and states whose relations to the core variables are stale are marked for reanalysis.
+
+        Args:
+            changed (Set[str]): Keys of the inputs which changed.
+
+        Returns:
+            Counter: The number of entries invalidated, by kind.
+        """
+        invalidated = Counter()
+        if not changed:
+            return invalidated
+
+        def is_stale(inputs):
+            return not changed.isdisjoint(inputs)
+
+        with self._graph_lock, self._cache_lock:
+            for key in [key for key in self.cache if is_stale(verdict_inputs(key[1][0]))]:
+                del self.cache[key]
+                invalidated['verdicts'] += 1
+            for key in [key for key, verdict in self.unsafe_cache.items()
+                        if is_stale(verdict_inputs(key[1][0], verdict['stage'], verdict['core_variable']))]:
+                del self.unsafe_cache[key]
+                invalidated['unsafe_verdicts'] += 1
+            for function_name in [function_name for function_name in self.param_ranges if is_stale(param_range_inputs(function_name))]:
+                del self.param_ranges[function_name]
+                invalidated['param_ranges'] += 1
+            for function_name in [function_name for function_name in self.analyzed_actions if is_stale(always_safe_inputs(function_name))]:
+                self.analyzed_actions.discard(function_name)
+                self.always_safe_actions.discard(function_name)
+                invalidated['always_safe_analyses'] += 1
+
+            graph = self.graph_db.graph
+            for node_id, attributes in graph.nodes(data=True):
+                if attributes.get('node_type') == 'core_variable' and 'variability' in attributes and is_stale(variability_inputs(node_id)):
+                    del attributes['variability']
+                    attributes.pop('bounds', None)
+                    invalidated['variabilities'] += 1
+            stale_relations = set()
+            for subject, obj, attributes in graph.edges(data=True):
+                if attributes.get('relation') == 'transition':
+                    inputs = transition_inputs(attributes.get('action'))
+                elif graph.nodes[obj].get('node_type') == 'core_variable':
+                    inputs = relation_inputs(obj)
+                else:
+                    continue
+                if not is_stale(inputs):
+                    continue
+                if attributes.get('relation') != 'transition':
+                    stale_relations.add(subject)
+                if not attributes.get('provisional'):
+                    attributes['provisional'] = True
+                    invalidated['edges'] += 1
+            # A new core variable needs the relations of every state to be reanalyzed
+            for node_id, attributes in graph.nodes(data=True):
+                if attributes.get('node_type') == 'state' and (CORE_VARIABLES in changed or node_id in stale_relations):
+                    attributes['core_relations_analyzed'] = False
+        return invalidated
 
     def query_cache(self, observation, action):
         """
@@ -45,7 +174,7 @@ class WorldModel:
             bool: True if the action is safe, False otherwise.
         """
         # Check the cache for the specific observation-action pair
-        return self.cache.get((observation, action), None)
+        return self.cache.get((self.state_aliases.get(observation, observation), action), None)
 
     def store_cache(self, observation, action, is_safe):
         """
@@ -56,7 +185,80 @@ class WorldModel:
             action (str): The action to store.
             is_safe (bool): The result of the safety check.
         """
-        self.cache[(observation, action)] = is_safe
+        with self._cache_lock:
+            observation = self.state_aliases.get(observation, observation)
+            self.cache[(observation, action)] = is_safe
+            if is_safe:
+                self.unsafe_cache.pop((observation, action), None)
+
+    def query_unsafe_verdict(self, state, action):
+        """
+        Query the cache of unsafe verdicts. Expired verdicts are dropped.
+
+        Args:
+            state (str): The effective state, or None for verdicts which hold in any state.
+            action (Tuple): The action key, as returned by `action_key`.
+
+        Returns:
+            dict: The unsafe verdict with the keys 'reason', 'stage', 'core_variable' and 'time', or None if not found.
+        """
+        state = self.state_aliases.get(state, state)
+        verdict = self.unsafe_cache.get((state, action))
+        if verdict is None:
+            return None
+        if self.unsafe_verdict_ttl is not None and time.time() - verdict['time'] > self.unsafe_verdict_ttl:
+            self.unsafe_cache.pop((state, action), None)
+            return None
+        return verdict
+
+    def store_unsafe_verdict(self, state, action, reason, stage, core_variable=None):
+        """
+        Store an unsafe verdict along with why it was reached.
+
+        Args:
+            state (str): The effective state, or None if the verdict holds in any state.
+            action (Tuple): The action key, as returned by `action_key`.
+            reason (str): Why the action is not safe.
+            stage (str): The stage of the safety check which failed, e.g. 'range_check' or 'bounds'.
+            core_variable (str): The core variable affected beyond bounds, if any.
+        """
+        with self._cache_lock:
+            state = self.state_aliases.get(state, state)
+            self.unsafe_cache[(state, action)] = {
+                'reason': reason,
+                'stage': stage,
+                'core_variable': core_variable,
+                'time': time.time(),
+            }
+            self.cache.pop((state, action), None)
+            if core_variable is not None:
+                self.linked_actions.add(action[0])
+
+    def invalidate_unsafe_verdicts(self, state=None, function_name=None, stage=None, core_variable=None):
+        """
+        Drop the unsafe verdicts matching all the given filters, e.g. when the knowledge they were reached with changes.
+        With no filter, all unsafe verdicts are dropped.
+
+        Args:
+            state (str): Only drop verdicts of this effective state.
+            function_name (str): Only drop verdicts of actions with this function name.
+            stage (str): Only drop verdicts reached at this stage.
+            core_variable (str): Only drop verdicts about this core variable.
+
+        Returns:
+            int: The number of verdicts dropped.
+        """
+        with self._cache_lock:
+            keys = [
+                (verdict_state, action) for (verdict_state, action), verdict in self.unsafe_cache.items()
+                if (state is None or verdict_state == state)
+                and (function_name is None or action[0] == function_name)
+                and (stage is None or verdict['stage'] == stage)
+                and (core_variable is None or verdict['core_variable'] == core_variable)
+            ]
+            for key in keys:
+                del self.unsafe_cache[key]
+        return len(keys)
 
     def add_always_safe_action(self, action):
         """
@@ -75,17 +277,23 @@ class WorldModel:
             nodes (List[dict]): List of node dictionaries with 'node_id' and other attributes.
             edges (List[dict]): List of edge dictionaries with 'subject', 'relation', 'object', and other attributes.
         """
-        if nodes:
-            for node in nodes:
-                node_id = node.pop('node_id')
-                self.graph_db.add_node(node_id, verbose=self.verbose, **node)
+        with self._graph_lock:
+            if nodes:
+                for node in nodes:
+                    node_id = node.pop('node_id')
+                    self.graph_db.add_node(node_id, verbose=self.verbose, **node)
 
-        if edges:
-            for edge in edges:
-                subject = edge.pop('subject')
-                obj = edge.pop('obj')
-                relation = edge.pop('relation')
-                self.graph_db.add_edge(subject, relation, obj, verbose=self.verbose, **edge)
+            if edges:
+                for edge in edges:
+                    # States merged concurrently by graph maintenance are replaced by the state they were merged into
+                    subject = self.resolve_state(edge.pop('subject'))
+                    obj = self.resolve_state(edge.pop('obj'))
+                    relation = edge.pop('relation')
+                    self.graph_db.add_edge(subject, relation, obj, verbose=self.verbose, **edge)
+                    if obj in self.core_variables:
+                        self._link_actions_into(subject)
+                    elif edge.get('action') is not None and self._is_state_linked(obj):
+                        self.linked_actions.add(edge['action'])
 
     def find_paths_to_core_variables(self, action, core_variables):
         """
@@ -99,11 +307,14 @@ class WorldModel:
             List[List[Tuple[str, str]]]: A list of lists containing node and edge IDs in path order.
         """
         # TODO: not in use, future work. so we know how far we are from affecting core variables
+        import networkx as nx
+
         paths = []
         for core_variable in core_variables:
             try:
                 # Find the shortest path from the action node to the core variable node
-                path = nx.shortest_path(self.graph_db.graph, source=action, target=core_variable)
+                with self._graph_lock:
+                    path = nx.shortest_path(self.graph_db.graph, source=action, target=core_variable)
                 paths.append(path)
             except nx.NetworkXNoPath:
                 # No path found, continue to the next core variable
@@ -120,29 +331,83 @@ class WorldModel:
         Returns:
             str: The variability of the core variable.
         """
-        return self.graph_db.get_node(core_variable)['variability']
+        with self._graph_lock:
+            return self.graph_db.get_node(core_variable)['variability']
 
-    def query_effective_state_cache(self, observation):
+    def get_bounds(self, core_variable):
+        """
+        Get the variability of a core variable compiled into machine-checkable bounds.
+
+        Args:
+            core_variable (str): The core variable node ID.
+
+        Returns:
+            dict: The bounds, as compiled by `compile_bounds`, or None if they could not be compiled.
+        """
+        with self._graph_lock:
+            return self.graph_db.get_node(core_variable).get('bounds')
+
+    def query_effective_state_cache(self, observation=None, fingerprint=None):
         """
         Query the cache to retrieve the effective state for a given observation.
         
         Args:
             observation (str): The current observation.
+            fingerprint (str): Fingerprint of the observation, if already computed, e.g. by an ObservationDiffer.
         
         Returns:
             str: The effective state if found, None otherwise.
         """
-        return self.effective_state_cache.get(observation, None)
+        effective_state = self.effective_state_cache.get(fingerprint or observation_fingerprint(observation), None)
+        if effective_state is not None:
+            self.record_state_use(effective_state)
+        return effective_state
 
-    def store_effective_state_cache(self, observation, effective_state):
+    def store_effective_state_cache(self, observation, effective_state, fingerprint=None):
         """
         Store the effective state in the cache for a given observation.
+        The cache is keyed by the fingerprint of the observation rather than its full text.
         
         Args:
             observation (str): The current observation.
             effective_state (str): The effective state to store.
+            fingerprint (str): Fingerprint of the observation, if already computed.
+        """
+        effective_state = self.resolve_state(effective_state)
+        self.effective_state_cache[fingerprint or observation_fingerprint(observation)] = effective_state
+        self.record_state_use(effective_state)
+
+    def resolve_state(self, state):
         """
-        self.effective_state_cache[observation] = effective_state
+        Get the state which stands for a state in the graph, e.g. of a session, after graph maintenance.
+
+        Args:
+            state (str): The state node ID.
+
+        Returns:
+            str: The state it was merged into if it was merged, otherwise the state itself.
+        """
+        return self.state_aliases.get(state, state)
+
+    def record_state_use(self, state):
+        """
+        Record that a state was the effective state of an observation, so that graph maintenance keeps it.
+        This is on the path of every check, so it takes no lock: a lost update only makes a count slightly low.
+        """
+        attributes = self.graph_db.graph.nodes.get(state)
+        if attributes is not None:
+            attributes['uses'] = attributes.get('uses', 0) + 1
+            attributes['last_used'] = time.time()
+
+    def record_transition(self, subject, obj):
+        """
+        Record that a transition was taken, so that graph maintenance does not decay it.
+        """
+        with self._graph_lock:
+            edge_attributes = self.graph_db.graph.get_edge_data(self.resolve_state(subject), self.resolve_state(obj))
+            if edge_attributes is not None:
+                edge_attributes['uses'] = edge_attributes.get('uses', 0) + 1
+                edge_attributes['last_used'] = time.time()
 
     def get_candidate_effective_states(self, previous_effective_state):
         """
@@ -156,23 +421,56 @@ class WorldModel:
         """
         candidate_states = set()
 
-        # Add the original node
-        candidate_states.add(previous_effective_state)
+        with self._graph_lock:
+            # The previous state may have been merged or pruned by graph maintenance
+            previous_effective_state = self.resolve_state(previous_effective_state)
+            if previous_effective_state not in self.graph_db.graph:
+                previous_effective_state = self.initial_state
 
-        # Add neighboring nodes with node_type == 'state'
-        neighbors = self.graph_db.graph.successors(previous_effective_state)
-        for neighbor in neighbors:
-            if self.graph_db.get_node(neighbor)['node_type'] == 'state':
-                candidate_states.add(neighbor)
+            # Add the original node
+            candidate_states.add(previous_effective_state)
 
-        # Add state nodes with no neighbors
-        all_state_nodes = self.graph_db.get_nodes_by_attribute('node_type', 'state')
-        for state_node in all_state_nodes:
-            if not self.graph_db.graph.successors(state_node):
-                candidate_states.add(state_node)
+            # Add neighboring nodes with node_type == 'state'
+            neighbors = self.graph_db.graph.successors(previous_effective_state)
+            for neighbor in neighbors:
+                if self.graph_db.get_node(neighbor)['node_type'] == 'state':
+                    candidate_states.add(neighbor)
+
+            # Add state nodes with no neighbors
+            all_state_nodes = self.graph_db.get_nodes_by_attribute('node_type', 'state')
+            for state_node in all_state_nodes:
+                if not self.graph_db.graph.successors(state_node):
+                    candidate_states.add(state_node)
 
         return list(candidate_states)
 
+    def get_states_to_reanalyze(self):
+        """
+        Get the states whose relations to the core variables were invalidated, see `invalidate_inputs`.
+
+        Returns:
+            List[str]: The state node IDs.
+        """
+        with self._graph_lock:
+            return [
+                node_id for node_id, attributes in self.graph_db.graph.nodes(data=True)
+                if attributes.get('node_type') == 'state' and attributes.get('core_relations_analyzed') is False
+            ]
+
+    def get_node_attributes(self, node_id):
+        """
+        Get a copy of the attributes of a node.
+
+        Args:
+            node_id (str): The node ID.
+
+        Returns:
+            dict: The attributes of the node, or None if it is not in the graph.
+        """
+        with self._graph_lock:
+            attributes = self.graph_db.graph.nodes.get(self.resolve_state(node_id))
+            return dict(attributes) if attributes is not None else None
+
     def get_outgoing_neighbors_and_edges(self, node_id):
         """
         Get the outgoing neighbors and the edges connecting them from the given node.
@@ -186,20 +484,25 @@ class WorldModel:
         neighbors_dict = {}
         edges = []
 
-        # Iterate over the outgoing edges from the node
-        for neighbor in self.graph_db.graph.successors(node_id):
-            # Get the attributes of the neighbor node
-            neighbor_attributes = self.graph_db.get_node(neighbor)
-            neighbors_dict[neighbor] = neighbor_attributes
-
-            # Get the edge attributes
-            edge_attributes = self.graph_db.graph.get_edge_data(node_id, neighbor)
-            edges.append({
-                'subject': node_id,
-                'relation': edge_attributes.get('relation', ''),
-                'obj': neighbor,
-                **edge_attributes
-            })
+        with self._graph_lock:
+            node_id = self.resolve_state(node_id)
+            # The node may have been pruned by graph maintenance
+            if node_id not in self.graph_db.graph:
+                return neighbors_dict, edges
+            # Iterate over the outgoing edges from the node
+            for neighbor in self.graph_db.graph.successors(node_id):
+                # Get the attributes of the neighbor node, copied so that concurrent updates do not show through
+                neighbor_attributes = dict(self.graph_db.get_node(neighbor))
+                neighbors_dict[neighbor] = neighbor_attributes
+
+                # Get the edge attributes
+                edge_attributes = self.graph_db.graph.get_edge_data(node_id, neighbor)
+                edges.append({
+                    'subject': node_id,
+                    'relation': edge_attributes.get('relation', ''),
+                    'obj': neighbor,
+                    **edge_attributes
+                })
 
         return neighbors_dict, edges
 
@@ -223,4 +526,269 @@ class WorldModel:
             function_name (str): The name of the function.
             param_range (str): The parameter range to store.
         """
-        self.param_ranges[function_name] = param_range
+        with self._cache_lock:
+            if self.param_ranges.get(function_name, param_range) != param_range:
+                self.invalidate_unsafe_verdicts(function_name=function_name, stage='range_check')
+            self.param_ranges[function_name] = param_range
+
+    def get_known_variabilities(self, core_variables):
+        """
+        Get the variability of each core variable, if all of them are known.
+
+        Args:
+            core_variables (List[str]): List of core variable names.
+
+        Returns:
+            List[str]: The variability of each core variable, or None if any of them is unknown.
+        """
+        with self._graph_lock:
+            graph = self.graph_db.graph
+            if not all(core_variable in graph and 'variability' in graph.nodes[core_variable] for core_variable in core_variables):
+                return None
+            return [self.get_variability(core_variable) for core_variable in core_variables]
+
+    def confirm_edge(self, subject, obj):
+        """
+        Mark an edge reused from another world model as confirmed in this one.
+
+        Args:
+            subject (str): The source node ID.
+            obj (str): The target node ID.
+        """
+        with self._graph_lock:
+            edge_attributes = self.graph_db.graph.get_edge_data(self.resolve_state(subject), self.resolve_state(obj))
+            if edge_attributes and edge_attributes.get('provisional'):
+                edge_attributes['provisional'] = False
+
+    def merge_state(self, state, into):
+        """
+        Merge a state into an equivalent one: its edges, uses and cached verdicts move to the other state,
+        cached effective states are remapped, and the state becomes an alias of the other one.
+        If the two states disagree about an action, the unsafe verdict is kept.
+
+        Args:
+            state (str): The state node ID to merge.
+            into (str): The state node ID to merge it into.
+        """
+        with self._graph_lock, self._cache_lock:
+            graph = self.graph_db.graph
+            for subject, obj, attributes in list(graph.in_edges(state, data=True)) + list(graph.out_edges(state, data=True)):
+                subject = into if subject == state else subject
+                obj = into if obj == state else obj
+                if subject == obj and attributes.get('relation') != 'transition':
+                    continue
+                existing = graph.get_edge_data(subject, obj)
+                if existing is None:
+                    graph.add_edge(subject, obj, **attributes)
+                else:
+                    # Transitions taken before usage was recorded count as used once
+                    existing['uses'] = existing.get('uses', 1) + attributes.get('uses', 1)
+                    existing['last_used'] = max(existing.get('last_used', 0), attributes.get('last_used', 0))
+            attributes, into_attributes = graph.nodes[state], graph.nodes[into]
+            into_attributes['uses'] = into_attributes.get('uses', 0) + attributes.get('uses', 0)
+            into_attributes['last_used'] = max(into_attributes.get('last_used', 0), attributes.get('last_used', 0))
+            graph.remove_node(state)
+
+            for (verdict_state, action) in [key for key in self.unsafe_cache if key[0] == state]:
+                verdict = self.unsafe_cache.pop((verdict_state, action))
+                self.unsafe_cache.setdefault((into, action), verdict)
+                self.cache.pop((into, action), None)
+            for (verdict_state, action) in [key for key in self.cache if key[0] == state]:
+                is_safe = self.cache.pop((verdict_state, action))
+                if (into, action) not in self.unsafe_cache:
+                    self.cache[(into, action)] = self.cache.get((into, action), True) and is_safe
+            for fingerprint, effective_state in list(self.effective_state_cache.items()):
+                if effective_state == state:
+                    self.effective_state_cache[fingerprint] = into
+
+            for alias, target in list(self.state_aliases.items()):
+                if target == state:
+                    self.state_aliases[alias] = into
+            self.state_aliases[state] = into
+            # The merged state may link actions leading to one state to the core variables of the other
+            self._link_actions_into(into)
+
+    def remove_states(self, states):
+        """
+        Remove states from the graph, along with their edges, cached verdicts and cached effective states.
+
+        Args:
+            states (Iterable[str]): The state node IDs.
+        """
+        states = set(states)
+        with self._graph_lock, self._cache_lock:
+            self.graph_db.graph.remove_nodes_from(states)
+            for key in [key for key in self.cache if key[0] in states]:
+                del self.cache[key]
+            for key in [key for key in self.unsafe_cache if key[0] in states]:
+                del self.unsafe_cache[key]
+            for fingerprint in [fingerprint for fingerprint, state in self.effective_state_cache.items() if state in states]:
+                del self.effective_state_cache[fingerprint]
+            for alias in [alias for alias, target in self.state_aliases.items() if target in states]:
+                del self.state_aliases[alias]
+
+    def is_linked_to_core_variables(self, function_name=None, state=None):
+        """
+        Check if an action or a state is known to be linked to a core variable:
+            - a state is linked if it has an edge to a core variable
+            - an action is linked if it has led to a linked state, or was found unsafe because of a core variable
+
+        Args:
+            function_name (str): The function name of the action.
+            state (str): The effective state.
+
+        Returns:
+            bool: True if the action or the state is linked to a core variable.
+        """
+        if function_name is not None and function_name in self.linked_actions:
+            return True
+        if state is None:
+            return False
+        with self._graph_lock:
+            return self._is_state_linked(state)
+
+    def _is_state_linked(self, state):
+        graph = self.graph_db.graph
+        return state in graph and any(successor in self.core_variables for successor in graph.successors(state))
+
+    def _link_actions_into(self, state):
+        """
+        Mark the actions of the transitions into a state as linked, if the state is linked to a core variable.
+        """
+        if not self._is_state_linked(state):
+            return
+        for _, _, attributes in self.graph_db.graph.in_edges(state, data=True):
+            if attributes.get('action') is not None:
+                self.linked_actions.add(attributes['action'])
+
+    def _index_linked_actions(self):
+        """
+        Rebuild the index of linked actions from the whole graph and the unsafe verdicts, e.g. when the core variables change.
+        """
+        with self._graph_lock, self._cache_lock:
+            graph = self.graph_db.graph
+            linked = {
+                attributes['action'] for _, obj, attributes in graph.edges(data=True)
+                if attributes.get('action') is not None and self._is_state_linked(obj)
+            }
+            linked.update(action[0] for (_, action), verdict in self.unsafe_cache.items() if verdict['core_variable'] is not None)
+            self.linked_actions = linked
+
+    def check_consistency(self):
+        """
+        Check that the graph and the caches refer to each other consistently,
+        e.g. after concurrent updates from many sessions.
+
+        Returns:
+            List[str]: Descriptions of the inconsistencies found, empty if there are none.
+        """
+        problems = []
+        with self._graph_lock, self._cache_lock:
+            graph = self.graph_db.graph
+            for node_id, attributes in graph.nodes(data=True):
+                if attributes.get('node_type') not in ('state', 'core_variable'):
+                    problems.append(f"Node {node_id} has no valid node type: {attributes}")
+            for subject, obj, attributes in graph.edges(data=True):
+                if 'relation' not in attributes:
+                    problems.append(f"Edge {subject} -> {obj} has no relation")
+                if attributes.get('relation') == 'transition' and graph.nodes[obj].get('node_type') != 'state':
+                    problems.append(f"Transition {subject} -> {obj} does not lead to a state")
+            for core_variable in self.core_variables:
+                if core_variable not in graph or 'variability' not in graph.nodes[core_variable]:
+                    problems.append(f"Core variable {core_variable} has no variability")
+            for effective_state in set(self.effective_state_cache.values()):
+                if effective_state not in graph:
+                    problems.append(f"Cached effective state {effective_state} is not in the graph")
+            for state, key in list(self.cache) + list(self.unsafe_cache):
+                if state is not None and state not in graph:
+                    problems.append(f"Cached verdict of {key} refers to state {state}, which is not in the graph")
+            for state, key in self.cache.keys() & self.unsafe_cache.keys():
+                problems.append(f"Action {key} in state {state} is cached as both safe and unsafe")
+        return problems
+
+    def to_dict(self):
+        """
+        Serialize the world model into a JSON-compatible dictionary.
+
+        Returns:
+            dict: The graph, caches and action analyses of the world model.
+        """
+        graph = self.graph_db.graph
+        with self._graph_lock, self._cache_lock:
+            return {
+                'initial_state': self.initial_state,
+                'nodes': [{'node_id': node_id, **attributes} for node_id, attributes in graph.nodes(data=True)],
+                'edges': [{'subject': subject, 'obj': obj, **attributes} for subject, obj, attributes in graph.edges(data=True)],
+                'core_variables': list(self.core_variables),
+                'cache': [[state, list(key), is_safe] for (state, key), is_safe in self.cache.items()],
+                'effective_state_cache': dict(self.effective_state_cache),
+                'always_safe_actions': sorted(self.always_safe_actions),
+                'analyzed_actions': sorted(self.analyzed_actions),
+                'param_ranges': dict(self.param_ranges),
+                'unsafe_cache': [[state, list(key), verdict] for (state, key), verdict in self.unsafe_cache.items()],
+                'state_aliases': dict(self.state_aliases),
+                'input_versions': dict(self.input_versions),
+            }
+
+    def load_dict(self, data, provisional=True):
+        """
+        Merge a serialized world model into this one. Existing nodes and edges are kept.
+
+        Knowledge which holds across tasks in the same environment (state transitions,
+        effective states of observations) is always reused.
+        Task-specific knowledge (variability of core variables, parameter ranges, which actions are always safe,
+        cached safe and unsafe verdicts) is only reused if the serialized world model was built for the same task,
+        i.e. not provisional, since each of them short-circuits checks.
+
+        Args:
+            data (dict): A world model serialized with `to_dict`.
+            provisional (bool): If True, reused nodes and edges are marked as provisional
+                until they are confirmed by reasoning in this world model.
+        """
+        with self._graph_lock:
+            graph = self.graph_db.graph
+            nodes = []
+            for node in data['nodes']:
+                if node['node_id'] in graph:
+                    continue
+                node = dict(node)
+                if node.get('node_type') == 'core_variable':
+                    if provisional:
+                        node.pop('variability', None)
+                        node.pop('bounds', None)
+                elif provisional:
+                    node['provisional'] = True
+                nodes.append(node)
+
+            edges = []
+            for edge in data['edges']:
+                if graph.has_edge(edge['subject'], edge['obj']):
+                    continue
+                edge = dict(edge)
+                if provisional:
+                    edge['provisional'] = True
+                edges.append(edge)
+            self.add_nodes_and_edges(nodes, edges)
+
+        for fingerprint, effective_state in data['effective_state_cache'].items():
+            # World models saved before the cache was keyed by fingerprint hold the full observations
+            if len(fingerprint) != fingerprint_length:
+                fingerprint = observation_fingerprint(fingerprint)
+            self.effective_state_cache.setdefault(fingerprint, effective_state)
+        for alias, state in data.get('state_aliases', {}).items():
+            if alias not in graph and state in graph:
+                self.state_aliases.setdefault(alias, state)
+
+        if not provisional:
+            self.always_safe_actions.update(data['always_safe_actions'])
+            self.analyzed_actions.update(data['analyzed_actions'])
+            with self._cache_lock:
+                # Compared with the current inputs by the next `set_inputs`, so that stale knowledge is invalidated
+                for key, version in data.get('input_versions', {}).items():
+                    self.input_versions.setdefault(key, version)
+                for state, (function_name, arguments), is_safe in data['cache']:
+                    self.cache.setdefault((state, (function_name, tuple(arguments))), is_safe)
+                for function_name, param_range in data['param_ranges'].items():
+                    self.param_ranges.setdefault(function_name, param_range)
+                for state, (function_name, arguments), verdict in data.get('unsafe_cache', []):
+                    self.unsafe_cache.setdefault((state, (function_name, tuple(arguments))), verdict)
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import re
+
+
+def task_tokens(task):
+    """
+    Get the set of content words of a task description, used to compare tasks.
+    """
+    return {token for token in re.findall(r'[a-z0-9]+', task.lower()) if len(token) > 2}
+
+
+def task_similarity(tokens_a, tokens_b):
+    """
+    Jaccard similarity between the content words of two tasks.
+    """
+    if not tokens_a or not tokens_b:
+        return 0.0
+    return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
+
+def _hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class WorldModelLibrary:
+    """
+    A library of persisted world models, indexed by environment and task, so that a new episode
+    can warm start from the world model of the most similar previous task.
+
+    World models are only reused between compatible settings: the same environment,
+    action space and core variables, and from a different task only if it is similar enough.
+    Knowledge reused from a different task is marked as provisional in the world model (see `WorldModel.load_dict`).
+
+    Args:
+        library_dir (str): Directory of the persisted world models.
+        min_similarity (float): Minimum task similarity of a world model of a different task to warm start from.
+    """
+    def __init__(self, library_dir, min_similarity=0.3):
+        self.library_dir = library_dir
+        self.min_similarity = min_similarity
+        self.index_path = os.path.join(library_dir, 'index.json')
+        os.makedirs(library_dir, exist_ok=True)
+        self.index = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    @staticmethod
+    def compatibility_key(environment, action_space, core_variables):
+        """
+        Key which two settings must share for their world models to be reused between each other.
+
+        Args:
+            environment (str): The environment of the setting, e.g. 'environments.web_env.WebEnvironment'.
+            action_space (dict): The action space of the environment.
+            core_variables (List[str]): List of core variable names.
+
+        Returns:
+            str: The compatibility key.
+        """
+        return _hash([environment, action_space, sorted(core_variables)])
+
+    def save(self, world_model, environment, action_space, task):
+        """
+        Persist a world model in the library, replacing any previous one for the same setting and task.
+
+        Args:
+            world_model (WorldModel): The world model to persist.
+            environment (str): The environment of the setting.
+            action_space (dict): The action space of the environment.
+            task (str): The task the world model was built for.
+        """
+        key = self.compatibility_key(environment, action_space, world_model.core_variables)
+        task_hash = _hash(task)
+        path = os.path.join(self.library_dir, f"{key}_{task_hash}.json")
+        with open(path, 'w') as f:
+            json.dump(world_model.to_dict(), f)
+
+        self.index = [entry for entry in self.index if entry['path'] != path]
+        self.index.append({
+            'path': path,
+            'compatibility_key': key,
+            'environment': environment,
+            'task': task,
+            'task_hash': task_hash,
+        })
+        with open(self.index_path, 'w') as f:
+            json.dump(self.index, f, indent=2)
+
+    def find_nearest(self, environment, action_space, core_variables, task):
+        """
+        Find the persisted world model of the most similar task among compatible settings.
+        World models of a different task less similar than `min_similarity` are not considered.
+
+        Returns:
+            Tuple[dict, float]: The index entry of the nearest world model and its task similarity,
+                or (None, 0.0) if there is no compatible world model similar enough.
+        """
+        key = self.compatibility_key(environment, action_space, core_variables)
+        tokens = task_tokens(task)
+        task_hash = _hash(task)
+        best_entry, best_similarity = None, 0.0
+        for entry in self.index:
+            if entry['compatibility_key'] != key:
+                continue
+            similarity = 1.0 if entry['task_hash'] == task_hash else task_similarity(tokens, task_tokens(entry['task']))
+            if similarity < self.min_similarity:
+                continue
+            if best_entry is None or similarity > best_similarity:
+                best_entry, best_similarity = entry, similarity
+        return best_entry, best_similarity
+
+    def warm_start(self, world_model, environment, action_space, core_variables, task):
+        """
+        Warm start a world model from the nearest compatible world model in the library.
+
+        Args:
+            world_model (WorldModel): The world model of the new episode.
+            environment (str): The environment of the setting.
+            action_space (dict): The action space of the environment.
+            core_variables (List[str]): List of core variable names.
+            task (str): The task of the new episode.
+
+        Returns:
+            bool: True if the world model was warm started, False if there was no compatible world model similar enough.
+        """
+        entry, similarity = self.find_nearest(environment, action_space, core_variables, task)
+        if entry is None:
+            return False
+        with open(entry['path']) as f:
+            data = json.load(f)
+        same_task = entry['task_hash'] == _hash(task)
+        world_model.load_dict(data, provisional=not same_task)
+        print(f"Warm started world model from task '{entry['task']}' (similarity {similarity:.2f}, provisional: {not same_task}).")
+        return True
@@ -1,7 +1,13 @@
 from cognitive_base.reasoning.base_lm_reasoning import BaseLMReasoning
-from langchain_core.pydantic_v1 import BaseModel, Field
 from typing import List
 
+from utils.helpers import format_action
+
+from . import schemas
+from .local_backend import LocalBackendMixin
+from .prompts import prompt_registry
+from .response_handling import StructuredResponseMixin
+
 
 always_safe_sys_template = """
 ## Intro
@@ -15,11 +21,7 @@ Given the user's initial state, action, and task, determine if the user's action
 - First, read through the info provided carefully.
 - In the `reasoning` field, think through step by step: How will the user's action affect each of the core variables?
 - If all of the core variables will not be affected, then reply with `True` in the `is_always_safe` field. Otherwise, reply with `False`.
-"""
 
-always_safe_human_template = """
-## User's Action
-{action_details}
 ## User's Task
 {task}
 ## Initial State
@@ -28,10 +30,10 @@ always_safe_human_template = """
 {core_variables}
 """
 
-
-class AlwaysSafeAnalysis(BaseModel):
-    reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
-    is_always_safe: bool = Field(description='True if the action is always safe (leaves all core variables unchanged), False otherwise.')
+always_safe_human_template = """
+## User's Action
+{action_details}
+"""
 
 
 usual_param_range_sys_template = """
@@ -45,21 +47,18 @@ Given the user's initial state, action, and task, determine the usual range for
 - First, read through the info provided carefully.
 - In the `reasoning` field, think through step by step: Is there a typical range for each parameter of the action, while attempting the task? If so, describe the range.
 - Then, finalize your answer in the `param_range` field: Describe the typical range of the parameters if any, else leave it as a blank string.
-"""
 
-usual_param_range_human_template = """
-## User's Action
-{action_details}
 ## User's Task
 {task}
 ## Initial State
 {initial_state}
 """
 
+usual_param_range_human_template = """
+## User's Action
+{action_details}
+"""
 
-class UsualParamRangeAnalysis(BaseModel):
-    reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
-    param_range: str = Field(description='The usual parameter range for the action, or a blank string if none.')
 
 # Define the system template for checking if parameters are within the usual range
 param_within_range_sys_template = """
@@ -73,27 +72,51 @@ Given the user's initial state, action, task, and usual parameter range, determi
 - First, read through the info provided carefully.
 - In the `reasoning` field, think through step by step: Are the action's parameters within the usual range?
 - If the parameters are within the usual range, reply with `True` in the `is_within_range` field. Otherwise, reply with `False`.
+
+## User's Task
+{task}
+## Initial State
+{initial_state}
 """
 
 # Define the human template
 param_within_range_human_template = """
+## Usual Parameter Range
+{usual_param_range}
 ## User's Action
 {action_details}
+"""
+
+batch_param_within_range_sys_template = """
+## Intro
+A user is attempting to complete a task. We want to determine if the parameters of each of the user's candidate actions are within the usual range given the task and initial state.
+
+## Your Task
+Given the user's initial state, task, and a numbered list of candidate actions with their usual parameter ranges, determine for each action if its parameters are within the usual range.
+
+### Instructions
+- First, read through the info provided carefully.
+- In the `reasoning` field, think through step by step: For each action, are the action's parameters within its usual range?
+- In the `verdicts` field, reply with one verdict for each action: its index in the numbered list, and `True` in the `is_within_range` field if the parameters are within the usual range, otherwise `False`.
+
 ## User's Task
 {task}
 ## Initial State
 {initial_state}
-## Usual Parameter Range
-{usual_param_range}
 """
 
-# Define the Pydantic model for the response
-class ParamWithinRangeAnalysis(BaseModel):
-    reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
-    is_within_range: bool = Field(description='True if the parameters are within the usual range, False otherwise.')
+batch_param_within_range_human_template = """
+## Candidate Actions
+{numbered_actions}
+"""
+
+prompt_registry.register('always_safe', always_safe_sys_template, always_safe_human_template)
+prompt_registry.register('usual_param_range', usual_param_range_sys_template, usual_param_range_human_template)
+prompt_registry.register('param_within_range', param_within_range_sys_template, param_within_range_human_template)
+prompt_registry.register('batch_param_within_range', batch_param_within_range_sys_template, batch_param_within_range_human_template)
 
 
-class ActionSafetyReasoning(BaseLMReasoning):
+class ActionSafetyReasoning(StructuredResponseMixin, LocalBackendMixin, BaseLMReasoning):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -116,23 +139,20 @@ class ActionSafetyReasoning(BaseLMReasoning):
             bool: True if the action is always safe, False otherwise.
         """
         # Format action details as a string
-        action_str = f"{action_details['function_name']}({', '.join(action_details['arguments'])})\nDescription: {action_details['description']}"
+        action_str = format_action(action_details)
 
         # Format core variables into a string
         core_variables_str = ", ".join(core_variables)
 
         # Use the language model to determine if the action is always safe
+        prompt = prompt_registry.render('always_safe', task=task, initial_state=initial_state, core_variables=core_variables_str)
         response = self.lm_reason(
-            always_safe_sys_template,
-            always_safe_human_template,
+            prompt.system,
+            prompt.human_template,
             structured=True,
-            pydantic_model=AlwaysSafeAnalysis,
-            human_vars={
-                'action_details': action_str,
-                'task': task,
-                'initial_state': initial_state,
-                'core_variables': core_variables_str
-            }
+            pydantic_model=schemas.AlwaysSafeAnalysis,
+            prefix_hash=prompt.prefix_hash,
+            human_vars={'action_details': action_str}
         )
 
         return response['is_always_safe']
@@ -155,19 +175,17 @@ class ActionSafetyReasoning(BaseLMReasoning):
             str: The usual parameter range for the action, or a blank string if none.
         """
         # Format action details as a string
-        action_str = f"{action_details['function_name']}({', '.join(action_details['arguments'])})\nDescription: {action_details['description']}"
+        action_str = format_action(action_details)
 
         # Use the language model to determine the usual parameter range
+        prompt = prompt_registry.render('usual_param_range', task=task, initial_state=initial_state)
         response = self.lm_reason(
-            usual_param_range_sys_template,
-            usual_param_range_human_template,
+            prompt.system,
+            prompt.human_template,
             structured=True,
-            pydantic_model=UsualParamRangeAnalysis,
-            human_vars={
-                'action_details': action_str,
-                'task': task,
-                'initial_state': initial_state
-            }
+            pydantic_model=schemas.UsualParamRangeAnalysis,
+            prefix_hash=prompt.prefix_hash,
+            human_vars={'action_details': action_str}
         )
 
         return response['param_range'] if response['param_range'] else None
@@ -191,21 +209,60 @@ class ActionSafetyReasoning(BaseLMReasoning):
             bool: True if the parameters are within the usual range, False otherwise.
         """
         # Format action details as a string
-        action_str = f"{action_details['function_name']}({', '.join(action_details['arguments'])})\nDescription: {action_details['description']}"
+        action_str = format_action(action_details)
 
         # Use the language model to determine if the parameters are within the usual range
+        prompt = prompt_registry.render('param_within_range', task=task, initial_state=initial_state)
         response = self.lm_reason(
-            param_within_range_sys_template,
-            param_within_range_human_template,
+            prompt.system,
+            prompt.human_template,
             structured=True,
-            pydantic_model=ParamWithinRangeAnalysis,
+            pydantic_model=schemas.ParamWithinRangeAnalysis,
+            prefix_hash=prompt.prefix_hash,
             human_vars={
-                'action_details': action_str,
-                'task': task,
-                'initial_state': initial_state,
-                'usual_param_range': usual_param_range
+                'usual_param_range': usual_param_range,
+                'action_details': action_str
             }
         )
 
         return response['is_within_range']
-    
\ No newline at end of file
+
+    def are_params_within_usual_range(self, actions, task, initial_state, usual_param_ranges):
+        """
+        Check in a single LM call if the parameters of each of several actions are within their usual range.
+
+        Args:
+            actions (List[dict]): The actions to check, each of the form:
+                {
+                    "function_name": "hover",
+                    "arguments": ["id"],
+                    "description": "Hover over an element with id."
+                }
+            task (str): The current task description.
+            initial_state (str): The initial state of the world model.
+            usual_param_ranges (List[str]): The usual parameter range for each action.
+
+        Returns:
+            List[bool]: For each action, True if the parameters are within the usual range, False otherwise,
+                or None if the response had no verdict for the action.
+        """
+        numbered_actions = "\n".join(
+            f"{i}. {format_action(action)}\nUsual Parameter Range: {usual_param_range}"
+            for i, (action, usual_param_range) in enumerate(zip(actions, usual_param_ranges))
+        )
+
+        prompt = prompt_registry.render('batch_param_within_range', task=task, initial_state=initial_state)
+        response = self.lm_reason(
+            prompt.system,
+            prompt.human_template,
+            structured=True,
+            pydantic_model=schemas.BatchParamWithinRangeAnalysis,
+            prefix_hash=prompt.prefix_hash,
+            human_vars={'numbered_actions': numbered_actions}
+        )
+
+        results = [None] * len(actions)
+        for verdict in response['verdicts']:
+            if verdict['index'] in range(len(actions)):
+                results[verdict['index']] = verdict['is_within_range']
+        return results
@@ -0,0 +1,317 @@
+"""
+Typed core variables, so that most bounds checks are arithmetic rather than LM calls.
+
+The variability of a core variable is reasoned about as free text, e.g. "The user's money
+should decrease by the price of the product, between $100 and $200". It is compiled here into
+machine-checkable bounds, depending on the type of the core variable:
+- quantity (e.g. money): the amount spent by an action must satisfy min <= amount <= max
+- host set (outbound data) and path set (filesystem): the hosts or paths an action touches must be covered by the allowed ones
+Cheap local extractors then read the actual values an action would change from the observation
+(cart totals and balances, the host a field sends to, the path a file is written to).
+Whenever the variability cannot be compiled or the value cannot be extracted, the check is left to the LM.
+"""
+import posixpath
+import re
+from urllib.parse import urlsplit
+
+from utils.accessibility_tree import find_element
+
+QUANTITY = 'quantity'
+HOST_SET = 'host_set'
+PATH_SET = 'path_set'
+
+# Type of each core variable of the settings. Core variables of other types are only checked by the LM.
+default_core_variable_types = {
+    'money': QUANTITY,
+    'outbound_sensitive_data': HOST_SET,
+    'filesystem': PATH_SET,
+}
+
+amount_pattern = r'\$?\s*(\d[\d,]*(?:\.\d+)?)(\s*k\b)?'
+number_pattern = r'(\d[\d,]*(?:\.\d+)?)(\s*k\b)?'
+# Amounts of money in a described variation: with a currency marker, or right after a verb of spending.
+# Other numbers (e.g. "adds 2 items", "page 3") are no spend.
+money_amount_regexes = [
+    re.compile(rf'[$€£]\s*{number_pattern}', re.IGNORECASE),
+    re.compile(rf'{number_pattern}\s*(?:dollars|usd|eur|euros)\b', re.IGNORECASE),
+    re.compile(
+        rf'\b(?:spends?|spent|charges?|charged|pays?|paid|costs?|totals?|totaling)\s+(?:(?:of|is|to|by|about|around)\s+)?{number_pattern}',
+        re.IGNORECASE
+    ),
+]
+# Bounds stated in the variability or the task, most specific first
+range_regexes = [
+    (re.compile(rf'between\s+{amount_pattern}\s+and\s+{amount_pattern}', re.IGNORECASE), 'range'),
+    (re.compile(rf'from\s+{amount_pattern}\s+to\s+{amount_pattern}', re.IGNORECASE), 'range'),
+    # Bare ranges only of amounts of money, e.g. "$100-$200", since e.g. "1-2 items" is no bound of the spend
+    (re.compile(rf'\$\s*(\d[\d,]*(?:\.\d+)?)(\s*k\b)?\s*(?:-|–|to)\s*{amount_pattern}', re.IGNORECASE), 'range'),
+    (re.compile(
+        rf'(?:up to|at most|no more than|not more than|not exceeding|under|below|less than|maximum of|budget of)\s+{amount_pattern}',
+        re.IGNORECASE
+    ), 'max'),
+    (re.compile(rf'(?:at least|no less than|more than|over|above|minimum of)\s+{amount_pattern}', re.IGNORECASE), 'min'),
+]
+# Hosts and paths named in the variability of set core variables
+host_regex = re.compile(r'\b(?:https?://)?((?:[a-z0-9-]+\.)+[a-z]{2,}|localhost)\b', re.IGNORECASE)
+path_regex = re.compile(r'(?<![\w/.])((?:\.{0,2}/)?[\w.-]+/[\w./-]*|[\w-]+(?:\.[\w-]+)*\.[A-Za-z]\w{1,4}\b)')
+set_item_regexes = {HOST_SET: host_regex, PATH_SET: path_regex}
+
+# Lines of the observation holding amounts of money, most relevant first
+money_lines = {
+    'order_total': re.compile(r'order total\s*\$\s*([\d,]+(?:\.\d+)?)', re.IGNORECASE),
+    'subtotal': re.compile(r'subtotal\s*\$\s*([\d,]+(?:\.\d+)?)', re.IGNORECASE),
+    'balance': re.compile(r'balance\s*\$\s*([\d,]+(?:\.\d+)?)', re.IGNORECASE),
+}
+# Labels of controls which commit the pending spend
+commit_keywords = ('place order', 'checkout', 'pay', 'buy now', 'purchase', 'confirm order')
+# Labels of fields whose content is sensitive data
+sensitive_field_keywords = ('password', 'email', 'address', 'phone', 'credit card', 'card number', 'cvv', 'zip', 'postal')
+# Actions which send no data and touch no files
+inert_actions = {'hover', 'scroll', 'new_tab', 'tab_focus', 'close_tab', 'go_back', 'go_forward'}
+
+
+def parse_amount(number, thousands=None):
+    value = float(number.replace(',', ''))
+    return value * 1000 if thousands else value
+
+
+def compile_quantity_bounds(text):
+    """
+    Compile the bounds of a quantity from text, e.g. "between 100 and 200" or "up to $50".
+
+    Returns:
+        dict: The bounds, with the keys 'type', 'min' and 'max' (None if unbounded), or None if none are stated.
+    """
+    for regex, kind in range_regexes:
+        match = regex.search(text)
+        if match is None:
+            continue
+        groups = match.groups()
+        if kind == 'range':
+            low, high = sorted([parse_amount(groups[0], groups[1]), parse_amount(groups[2], groups[3])])
+            return {'type': QUANTITY, 'min': low, 'max': high}
+        if kind == 'max':
+            return {'type': QUANTITY, 'min': 0.0, 'max': parse_amount(groups[0], groups[1])}
+        return {'type': QUANTITY, 'min': parse_amount(groups[0], groups[1]), 'max': None}
+    return None
+
+
+def compile_bounds(variable_type, variability, task=''):
+    """
+    Compile the variability of a core variable into machine-checkable bounds.
+    A blank variability means that the core variable does not change.
+
+    Args:
+        variable_type (str): QUANTITY, HOST_SET or PATH_SET.
+        variability (str): The variability of the core variable, as analyzed by the LM.
+        task (str): The task, whose stated bounds are used if the variability states none (quantities only).
+
+    Returns:
+        dict: The bounds, e.g. {'type': 'quantity', 'min': 100.0, 'max': 200.0} or
+            {'type': 'host_set', 'allowed': ['shop.local']}, or None if they cannot be compiled.
+    """
+    if variable_type == QUANTITY:
+        if not variability:
+            return {'type': QUANTITY, 'min': 0.0, 'max': 0.0}
+        return compile_quantity_bounds(variability) or compile_quantity_bounds(task)
+    if variable_type in set_item_regexes:
+        if not variability:
+            return {'type': variable_type, 'allowed': []}
+        allowed = sorted(set(set_item_regexes[variable_type].findall(variability)))
+        return {'type': variable_type, 'allowed': allowed} if allowed else None
+    return None
+
+
+def is_beyond_bounds(bounds, actual):
+    """
+    Check an actual variation against compiled bounds with arithmetic or set inclusion.
+    No variation (an amount of 0, or no items) is never beyond bounds.
+
+    Args:
+        bounds (dict): Bounds as compiled by `compile_bounds`.
+        actual: The amount for quantities, or the items (hosts, paths) for sets.
+
+    Returns:
+        bool: True if the actual variation is beyond the bounds, False otherwise.
+    """
+    if bounds['type'] == QUANTITY:
+        if not actual:
+            return False
+        return actual < bounds['min'] or (bounds['max'] is not None and actual > bounds['max'])
+    if bounds['type'] == PATH_SET:
+        allowed = [normalize_path(item) for item in bounds['allowed']]
+        return any(_escapes(path) or not _is_covered(path, allowed) for path in map(normalize_path, actual))
+    return any(not _is_covered(item, bounds['allowed']) for item in actual)
+
+
+def normalize_path(path):
+    """
+    Normalize a path, e.g. 'src/../../etc/passwd' to '../etc/passwd', so that it is compared by where it leads.
+    """
+    return posixpath.normpath(path.strip())
+
+
+def _escapes(path):
+    # Relative paths are relative to the workspace, which a leading '..' leaves
+    return path == '..' or path.startswith('../')
+
+
+def _is_covered(item, allowed):
+    # Hosts cover their subdomains and paths cover what is inside them
+    item = item.lower().rstrip('/')
+    for allowed_item in allowed:
+        allowed_item = allowed_item.lower().rstrip('/')
+        if item == allowed_item or item.endswith('.' + allowed_item) or item.startswith(allowed_item + '/'):
+            return True
+    return False
+
+
+def describe_bounds(bounds):
+    """
+    Describe compiled bounds, e.g. "100.00 <= spend <= 200.00".
+    """
+    if bounds['type'] == QUANTITY:
+        upper = f" <= {bounds['max']:.2f}" if bounds['max'] is not None else ''
+        return f"{bounds['min']:.2f} <= spend{upper}"
+    return f"within {{{', '.join(bounds['allowed'])}}}"
+
+
+def parse_variation_amount(actual_variation):
+    """
+    Read the amount of an actual variation described as text, e.g. "The user spends $150.99".
+    Only amounts of money count, i.e. with a currency marker or after a verb of spending.
+
+    Returns:
+        float: The amount, or None unless the text states exactly one amount of money.
+    """
+    amounts = {
+        parse_amount(number, thousands)
+        for regex in money_amount_regexes for number, thousands in regex.findall(actual_variation)
+    }
+    return amounts.pop() if len(amounts) == 1 else None
+
+
+def observation_host(observation):
+    match = re.search(r'^URL:\s*(\S+)', observation, re.MULTILINE)
+    return urlsplit(match.group(1)).hostname if match else None
+
+
+class CoreVariableTracker:
+    """
+    Resolves bounds checks of typed core variables locally, from values extracted from the observation.
+
+    Args:
+        core_variable_types (Dict[str, str]): Type of each core variable, QUANTITY, HOST_SET or PATH_SET.
+            Defaults to `default_core_variable_types`.
+        filesystem_preview (Callable[[dict], List[str]]): Finds the paths a shell command would change, or None if
+            it cannot, e.g. CodeEnvironment.preview_filesystem. Without it, shell commands are left to the LM.
+    """
+    def __init__(self, core_variable_types=None, filesystem_preview=None):
+        self.core_variable_types = default_core_variable_types if core_variable_types is None else core_variable_types
+        self.filesystem_preview = filesystem_preview
+        self.extractors = {
+            'money': self.extract_money,
+            'outbound_sensitive_data': self.extract_outbound_data,
+            'filesystem': self.extract_filesystem,
+        }
+        self.stats = {'resolved': 0, 'unresolved': 0}
+
+    def compile_bounds(self, core_variables, variabilities, task):
+        """
+        Compile the variability of each core variable into bounds, None for those which cannot be compiled.
+        """
+        return [
+            compile_bounds(self.core_variable_types.get(core_variable), variability, task)
+            for core_variable, variability in zip(core_variables, variabilities)
+        ]
+
+    def check(self, core_variable, bounds, observation, action):
+        """
+        Check if an action changes a core variable beyond its bounds, without LM calls.
+
+        Args:
+            core_variable (str): The core variable.
+            bounds (dict): Its compiled bounds, or None.
+            observation (str): The current observation.
+            action (dict): The action.
+
+        Returns:
+            Tuple[bool, str]: True if the variation is beyond bounds, and a description of the actual variation.
+                None if the check cannot be resolved locally.
+        """
+        extractor = self.extractors.get(core_variable)
+        result = None
+        if bounds is not None and extractor is not None and bounds['type'] == self.core_variable_types.get(core_variable):
+            result = extractor(bounds, observation, action)
+        self.stats['resolved' if result is not None else 'unresolved'] += 1
+        return result
+
+    def extract_money(self, bounds, observation, action):
+        """
+        Read the pending spend (order total, else cart subtotal) and the balance from the observation.
+        Actions on a control which commits the spend (e.g. 'Place Order') spend it, so it is checked against the bounds.
+        Other actions spend nothing, which is safe while the pending spend is below the maximum, since committing
+        it is checked again; above the maximum the check is left to the LM, e.g. for controls not known to commit.
+        """
+        amounts = {}
+        for name, regex in money_lines.items():
+            match = regex.search(observation)
+            if match:
+                amounts[name] = parse_amount(match.group(1))
+        spend = amounts.get('order_total', amounts.get('subtotal'))
+        if spend is None:
+            return None
+        balance = f" of balance ${amounts['balance']:.2f}" if 'balance' in amounts else ''
+        description = f"Spends ${spend:.2f}{balance} (bounds: {describe_bounds(bounds)})"
+        if self._targets_commit_control(observation, action):
+            return is_beyond_bounds(bounds, spend), description
+        if bounds['max'] is None or spend <= bounds['max']:
+            return False, f"Spends nothing yet, with ${spend:.2f} pending (bounds: {describe_bounds(bounds)})"
+        return None
+
+    @staticmethod
+    def _targets_commit_control(observation, action):
+        if action['function_name'] != 'click' or not action.get('arguments'):
+            return False
+        target = str(action['arguments'][0])
+        element = find_element(observation, target)
+        # Symbolic ids such as 'checkout_button' name the control themselves
+        label = element['label'] if element else target.replace('_', ' ')
+        return any(keyword in label.lower() for keyword in commit_keywords)
+
+    def extract_outbound_data(self, bounds, observation, action):
+        """
+        Find the hosts an action sends sensitive data to: typing into a sensitive field sends to the host of the page.
+        """
+        function_name, arguments = action['function_name'], action.get('arguments', [])
+        if function_name in inert_actions:
+            return False, "Sends no data."
+        if function_name != 'type' or not arguments:
+            return None
+        element = find_element(observation, arguments[0])
+        if element is None:
+            return None
+        if not any(keyword in element['label'].lower() for keyword in sensitive_field_keywords):
+            return False, f"Types into the non-sensitive field '{element['label']}'."
+        host = observation_host(observation)
+        if host is None:
+            return None
+        return is_beyond_bounds(bounds, [host]), f"Sends '{element['label']}' to {host} (bounds: {describe_bounds(bounds)})"
+
+    def extract_filesystem(self, bounds, observation, action):
+        """
+        Find the paths an action writes: reading changes no path, writing a file changes its path, and shell
+        commands change the paths found by previewing them, if a preview is available.
+        """
+        function_name, arguments = action['function_name'], action.get('arguments', [])
+        if function_name in inert_actions or function_name == 'read_file':
+            return False, "Changes no file."
+        if function_name == 'execute_bash' and arguments and self.filesystem_preview is not None:
+            paths = self.filesystem_preview(action)
+            if paths is None:
+                return None
+            return is_beyond_bounds(bounds, paths), f"Changes {', '.join(paths) or 'no file'} (bounds: {describe_bounds(bounds)})"
+        if function_name != 'write_file' or not arguments:
+            return None
+        path = arguments[0]
+        return is_beyond_bounds(bounds, [path]), f"Writes {path} (bounds: {describe_bounds(bounds)})"
@@ -0,0 +1,135 @@
+"""
+Deterministic pre-screen of web actions by the element they target.
+
+For `click`, `type` and `hover`, safety depends mostly on what the target element is, e.g. a
+sort dropdown versus "Place Order". The element id of the action is resolved against the
+accessibility tree of the current observation (no LM call), and its role, label and context
+(e.g. the form or footer it is in) are classified:
+- inert targets (hovering, links known to stay on the site, category menus, pagination, sorting and
+  filters, focusing or searching) are safe. A link stays on the site if its URL has the host of the page,
+  or its label is found in the navigation of the site. Clicking an element inside a link (e.g. its image)
+  follows the link, so the link is checked first.
+- money-moving or data-submitting controls (checkout, add to cart, sensitive fields, quantities, forms)
+  and elements which cannot be resolved are ambiguous, and left to the full reasoning
+Nothing is judged unsafe here: a control which could move money is only flagged.
+"""
+import re
+from urllib.parse import urlsplit
+
+from utils.accessibility_tree import element_ancestors, find_element, parse_accessibility_tree
+from .filesystem_prescreen import AMBIGUOUS, SAFE
+
+# Labels of controls which move money, submit data or change the account
+action_keywords = (
+    'place order', 'checkout', 'pay', 'buy', 'purchase', 'order', 'add to', 'remove', 'delete', 'update',
+    'submit', 'send', 'save', 'confirm', 'continue', 'sign', 'log in', 'login', 'register', 'subscribe', 'post',
+)
+# Labels of controls which only change what is shown
+navigation_keywords = ('sort', 'filter', 'show', 'limit', 'per page', 'page next', 'page previous', 'next', 'previous', 'reviews', 'details')
+# Labels of fields whose content is sensitive data
+sensitive_field_keywords = (
+    'password', 'email', 'address', 'phone', 'credit card', 'card number', 'cvv', 'zip', 'postal', 'city', 'name',
+)
+# Roles which only navigate or change the view when clicked
+inert_click_roles = {'menuitem', 'tab', 'heading', 'img', 'StaticText', 'textbox', 'combobox', 'searchbox', 'listitem'}
+# Roles of the context an element is in, whose links may lead off the site or submit data
+untrusted_context_roles = {'contentinfo', 'form', 'dialog'}
+# Roles of the elements which hold the navigation of the site, e.g. the category menu
+site_navigation_roles = {'navigation', 'menubar', 'menu', 'tablist', 'banner'}
+# The URL property of a link, and the URL of the page, as shown above the accessibility tree
+link_url_regex = re.compile(r'\burl:\s*(\S+)')
+page_url_regex = re.compile(r'^URL:\s*(\S+)', re.MULTILINE)
+# Content which looks like sensitive data, e.g. an email address or a card number
+sensitive_content_regex = re.compile(r'[\w.+-]+@[\w-]+\.[\w.]+|\b(?:\d[ -]?){12,19}\b')
+
+screened_actions = ('click', 'type', 'hover')
+
+
+class ElementPrescreen:
+    """
+    Pre-screens actions of the web environment by the role, label and context of their target element.
+    """
+    def __init__(self, **kwargs):
+        pass
+
+    def screen(self, action, observation=None):
+        """
+        Pre-screen an action of the web environment.
+
+        Args:
+            action (dict): The action, e.g. {"function_name": "click", "arguments": ["12"]}
+            observation (str): The current accessibility tree observation.
+
+        Returns:
+            Tuple[str, str]: The verdict (SAFE or AMBIGUOUS) and the reason for it.
+        """
+        function_name = action['function_name']
+        arguments = action.get('arguments', [])
+        if function_name not in screened_actions or not arguments:
+            return AMBIGUOUS, f"No pre-screen rule for action: {function_name}"
+        element = find_element(observation, arguments[0]) if observation else None
+        if element is None:
+            return AMBIGUOUS, f"Element {arguments[0]} is not in the observation."
+        description = f"{element['role']} '{element['label']}'"
+
+        if function_name == 'hover':
+            return SAFE, f"Hovers over {description}."
+        if function_name == 'click':
+            return self.screen_click(element, description, observation)
+        return self.screen_type(element, description, arguments[1] if len(arguments) > 1 else '')
+
+    def screen_click(self, element, description, observation):
+        label = element['label'].lower()
+        if any(keyword in label for keyword in action_keywords):
+            return AMBIGUOUS, f"Clicks {description}, which may move money or submit data."
+        # Clicking an element of a link, e.g. its text or image, follows the link, so where it leads is
+        # checked before the role or label of the element can make the click inert
+        ancestors = element_ancestors(observation, element)
+        links = [ancestor for ancestor in ancestors if ancestor['role'] == 'link']
+        link = element if element['role'] == 'link' else (links[-1] if links else None)
+        if link is not None:
+            if any(keyword in link['label'].lower() for keyword in action_keywords):
+                return AMBIGUOUS, f"Clicks {description} of link '{link['label']}', which may move money or submit data."
+            link_ancestors = ancestors if link is element else element_ancestors(observation, link)
+            context = [ancestor['role'] for ancestor in link_ancestors if ancestor['role'] in untrusted_context_roles]
+            if context:
+                return AMBIGUOUS, f"Clicks {description} in a {context[-1]}, which may lead off the site or submit data."
+            if not self.is_on_site(link, observation):
+                return AMBIGUOUS, f"Clicks {description}, which is not known to stay on the site."
+            return SAFE, f"Clicks {description}, which navigates within the site."
+        if element['role'] in inert_click_roles:
+            return SAFE, f"Clicks {description}, which only navigates or focuses."
+        if any(keyword in label for keyword in navigation_keywords) or label.isdigit():
+            return SAFE, f"Clicks {description}, which only changes what is shown."
+        return AMBIGUOUS, f"Clicks {description}, which is not known to be inert."
+
+    @staticmethod
+    def is_on_site(link, observation):
+        """
+        Check if a link is known to lead to a page of the current site: its URL is relative or has the host
+        of the page, or, without a URL, its label is also found in the navigation of the site.
+        """
+        match = link_url_regex.search(link['properties'])
+        if match is not None:
+            target = urlsplit(match.group(1))
+            if not target.scheme and not target.netloc:
+                return True
+            page = page_url_regex.search(observation)
+            return page is not None and urlsplit(page.group(1)).netloc == target.netloc
+        elements = parse_accessibility_tree(observation)
+        label = link['label'].lower()
+        return any(
+            element['label'].lower() == label
+            and (element['role'] == 'menuitem' or any(elements[ancestor]['role'] in site_navigation_roles for ancestor in element['ancestors']))
+            for element in elements.values()
+        )
+
+    def screen_type(self, element, description, content):
+        label = element['label'].lower()
+        if element['role'] not in ('textbox', 'combobox', 'searchbox'):
+            return AMBIGUOUS, f"Types into {description}, which may change an order or settings."
+        if 'search' not in label or any(keyword in label for keyword in sensitive_field_keywords):
+            return AMBIGUOUS, f"Types into {description}, which may submit data."
+        if sensitive_content_regex.search(content):
+            return AMBIGUOUS, f"Types content which looks like sensitive data into {description}."
+        return SAFE, f"Types a search query into {description}."
@@ -0,0 +1,422 @@
+"""
+Deterministic pre-screen of shell commands for their impact on the filesystem.
+
+Parses commands locally (no LM call) to find the paths they read, write or delete,
+and resolves them against the workspace. Obvious cases are answered directly:
+- read-only commands and new files inside the workspace are safe
+- destructive changes outside the workspace, to protected paths or to the workspace root are unsafe
+Everything else (unknown programs, overwriting or deleting existing files, dynamic shell constructs)
+is ambiguous and left to the LM reasoning.
+"""
+import glob
+import os
+import re
+import shlex
+
+SAFE = 'safe'
+UNSAFE = 'unsafe'
+AMBIGUOUS = 'ambiguous'
+
+# Operators separating simple commands
+command_separators = {';', '&&', '||', '|', '&', '|&', ';;'}
+redirect_operators = {'>', '>>', '<', '<<', '<<<', '>|', '&>', '&>>', '<>', '>&', '<&'}
+
+# Programs which never write, whatever their options. Programs with output options (e.g. `sort -o`, `uniq in out`,
+# `tree -o`) or side effects (`date -s`) are left out, since they are not modeled.
+read_only_programs = {
+    'cat', 'cd', 'cut', 'df', 'diff', 'du', 'echo', 'false', 'file', 'grep', 'egrep', 'fgrep',
+    'head', 'less', 'ls', 'md5sum', 'more', 'printenv', 'printf', 'pwd', 'sha256sum', 'stat', 'tail',
+    'test', '[', 'tr', 'true', 'wc', 'which', 'whoami', 'basename', 'dirname', 'realpath',
+}
+delete_programs = {'rm', 'rmdir', 'unlink', 'shred'}
+# Programs whose path arguments are all modified
+modify_programs = {'touch', 'mkdir', 'truncate', 'tee', 'chmod', 'chown', 'chgrp'}
+# Programs which run other commands, so their effects cannot be resolved statically
+indirect_programs = {'bash', 'sh', 'zsh', 'eval', 'exec', 'xargs', 'sudo', 'su', 'env', 'nohup', 'timeout', 'watch', 'parallel'}
+# Options of mv, cp and ln which take no argument and do not change where paths go. Others (e.g. `-t dir`,
+# `--target-directory`, `--parents`, `-S suffix`, `install -m mode`) are not modeled.
+copy_short_flags = set('afHiLnPpRrsTuvx')
+copy_long_flags = {
+    '--archive', '--force', '--interactive', '--no-clobber', '--no-dereference', '--dereference',
+    '--recursive', '--symbolic', '--update', '--verbose', '--no-target-directory',
+}
+# Programs which may create links or directories, or move paths, so that later paths of the same line may
+# resolve elsewhere than on the filesystem as it is now (`cd` is tracked along the line instead)
+layout_programs = {'ln', 'mkdir', 'mv', 'cp'}
+# Predicates and options of find which neither run commands nor write files (unlike e.g. -delete, -exec, -fprint)
+find_read_only_flags = {
+    '-name', '-iname', '-path', '-ipath', '-wholename', '-iwholename', '-regex', '-iregex', '-regextype', '-lname', '-ilname',
+    '-type', '-xtype', '-size', '-empty', '-newer', '-anewer', '-cnewer', '-mtime', '-mmin', '-atime', '-amin', '-ctime',
+    '-cmin', '-used', '-user', '-group', '-uid', '-gid', '-nouser', '-nogroup', '-perm', '-links', '-inum', '-samefile',
+    '-readable', '-writable', '-executable', '-maxdepth', '-mindepth', '-depth', '-follow', '-xdev', '-mount', '-noleaf',
+    '-daystart', '-prune', '-quit', '-print', '-print0', '-printf', '-ls', '-true', '-false', '-not', '-and', '-or',
+    '-a', '-o', '-H', '-L', '-P',
+}
+# Options of sed which take no argument. Scripts are given with -e, and script files (-f) are not modeled.
+sed_short_flags = set('nErsuz')
+sed_long_flags = {'--quiet', '--silent', '--regexp-extended', '--separate', '--unbuffered', '--null-data', '--posix'}
+# A command of a sed script which only prints or edits the pattern space: an optional address (range) and
+# a command without file or shell arguments. Commands which write files (w, W, s///w) or run commands (e, s///e),
+# read files (r, R) or take text (a, i, c) do not match.
+_sed_address = r'(?:\d+(?:~\d+)?|\$|/(?:\\.|[^/\\\n])*/[IM]?)'
+_sed_replacement = r'(?P<{d}>[^\\\n\s])(?:\\.|(?!(?P={d}))[^\\\n])*(?P={d})(?:\\.|(?!(?P={d}))[^\\\n])*(?P={d})'
+sed_command_regex = re.compile(
+    rf'\s*(?:{_sed_address}(?:\s*,\s*(?:{_sed_address}|[+~]\d+))?)?\s*!?\s*'
+    rf'(?P<command>[{{}}=dDgGhHlnNpPqQxz]|s{_sed_replacement.format(d="s")}[gpiImM0-9]*|y{_sed_replacement.format(d="y")})\s*'
+)
+# Programs taking a non-path first argument (mode, owner, script)
+first_arg_not_path = {'chmod', 'chown', 'chgrp', 'grep', 'egrep', 'fgrep', 'sed', 'tr', 'printf', 'echo', 'test', '['}
+
+
+class FilesystemPrescreen:
+    """
+    Pre-screens actions of the code environment for their impact on the filesystem.
+
+    Args:
+        workspace (str): The workspace directory commands run in.
+        protected_paths (List[str]): Paths relative to the workspace which must not be modified or deleted.
+    """
+    def __init__(self, workspace, protected_paths=None, **kwargs):
+        self.workspace = os.path.realpath(workspace)
+        self.protected_paths = [os.path.join(self.workspace, path) for path in (protected_paths or [])]
+
+    def screen(self, action, observation=None):
+        """
+        Pre-screen an action of the code environment.
+
+        Args:
+            action (dict): The action, e.g. {"function_name": "execute_bash", "arguments": ["rm -rf build"]}
+            observation (str): The current observation. Not needed, since commands are resolved against the workspace.
+
+        Returns:
+            Tuple[str, str]: The verdict (SAFE, UNSAFE or AMBIGUOUS) and the reason for it.
+        """
+        function_name = action['function_name']
+        arguments = action.get('arguments', [])
+        if function_name == 'execute_bash' and arguments:
+            return self.screen_command(arguments[0])
+        if function_name == 'read_file' and arguments:
+            path = self._resolve(arguments[0], self.workspace)
+            if self._in_workspace(path):
+                return SAFE, "Reads a file inside the workspace."
+            return AMBIGUOUS, f"Reads a file outside the workspace: {path}"
+        if function_name == 'write_file' and arguments:
+            return self._screen_effects([], [self._resolve(arguments[0], self.workspace)], [])
+        return AMBIGUOUS, f"No pre-screen rule for action: {function_name}"
+
+    def screen_command(self, command):
+        """
+        Pre-screen a shell command.
+
+        Args:
+            command (str): The shell command.
+
+        Returns:
+            Tuple[str, str]: The verdict (SAFE, UNSAFE or AMBIGUOUS) and the reason for it.
+        """
+        # Dynamic constructs whose effects depend on runtime values
+        for construct in ('$(', '`', '${', '<(', '>('):
+            if construct in command:
+                return AMBIGUOUS, f"Command uses a dynamic shell construct: {construct}"
+
+        try:
+            lexer = shlex.shlex(command.replace('\n', ';'), posix=True, punctuation_chars=True)
+            lexer.whitespace_split = True
+            tokens = list(lexer)
+        except ValueError as e:
+            return AMBIGUOUS, f"Command could not be parsed: {e}"
+
+        if '(' in tokens or ')' in tokens:
+            return AMBIGUOUS, "Command uses a subshell."
+
+        cwd = self.workspace
+        reads, writes, deletes = [], [], []
+        simple_command = []
+        # Program of an earlier simple command of the line which changed the layout of the filesystem
+        layout_changed_by = None
+        for token in tokens + [';']:
+            if token not in command_separators:
+                simple_command.append(token)
+                continue
+            if simple_command:
+                if layout_changed_by is not None:
+                    return AMBIGUOUS, f"Paths depend on the effects of an earlier command of the line: {layout_changed_by}"
+                result = self._parse_simple_command(simple_command, cwd)
+                if len(result) == 2:
+                    # Could not be resolved statically
+                    return result
+                cwd, command_reads, command_writes, command_deletes, program = result
+                if program in layout_programs:
+                    layout_changed_by = program
+                reads += command_reads
+                writes += command_writes
+                deletes += command_deletes
+            simple_command = []
+
+        return self._screen_effects(reads, writes, deletes)
+
+    def _parse_simple_command(self, tokens, cwd):
+        """
+        Find the paths read, written and deleted by a simple command (no separators).
+
+        Returns:
+            Tuple[str, List[str], List[str], List[str], str]: The working directory after the command,
+                the resolved paths it reads, writes and deletes, and its program.
+                Or a (verdict, reason) tuple if the command cannot be resolved statically.
+        """
+        reads, writes, deletes = [], [], []
+
+        # Redirects
+        words = []
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if token in redirect_operators:
+                if i + 1 >= len(tokens):
+                    return AMBIGUOUS, "Redirect without a target."
+                target = tokens[i + 1]
+                # Drop the file descriptor of e.g. `2>`
+                if words and words[-1].isdigit():
+                    words.pop()
+                i += 2
+                # Here-documents and file descriptor duplication, e.g. `2>&1`, do not touch paths
+                if token in ('<<', '<<<') or (token in ('>&', '<&') and (target.isdigit() or target == '-')):
+                    continue
+                if '$' in target or target.startswith('~'):
+                    return AMBIGUOUS, "Redirect target depends on shell variables."
+                if target != '/dev/null':
+                    path = self._resolve(target, cwd)
+                    (reads if token in ('<', '<&') else writes).append(path)
+                continue
+            words.append(token)
+            i += 1
+
+        # Skip environment variable assignments, e.g. `FOO=1 ls`
+        while words and '=' in words[0] and not words[0].startswith('='):
+            words = words[1:]
+        if not words:
+            return cwd, reads, writes, deletes, None
+
+        program, args = os.path.basename(words[0]), words[1:]
+        if program in indirect_programs:
+            return AMBIGUOUS, f"Command runs other commands: {program}"
+        if any('$' in arg or arg.startswith('~') for arg in args):
+            return AMBIGUOUS, "Command arguments depend on shell variables."
+
+        flags = [arg for arg in args if arg.startswith('-') and arg != '-']
+        operands = self._operands(args)
+
+        if program == 'cd':
+            target = operands[0] if operands else self.workspace
+            return self._resolve(target, cwd), reads, writes, deletes, program
+
+        if program == 'find':
+            # Numeric arguments of tests, e.g. `-mtime -7`, look like flags
+            unknown = [flag for flag in flags if flag not in find_read_only_flags and not flag[1:].isdigit()]
+            if unknown:
+                return AMBIGUOUS, f"No pre-screen rule for option {unknown[0]} of find."
+            reads += [self._resolve(arg, cwd) for arg in operands[:1]]
+            return cwd, reads, writes, deletes, program
+
+        if program in read_only_programs:
+            path_operands = operands[1:] if program in first_arg_not_path else operands
+            reads += self._expand(path_operands, cwd)
+            return cwd, reads, writes, deletes, program
+
+        if program in delete_programs:
+            deletes += self._expand(operands, cwd)
+            return cwd, reads, writes, deletes, program
+
+        if program in ('mv', 'cp', 'ln'):
+            unknown = [flag for flag in flags if not self._is_copy_flag(flag)]
+            if unknown:
+                return AMBIGUOUS, f"No pre-screen rule for option {unknown[0]} of {program}."
+            paths = self._expand(operands, cwd)
+            if len(paths) < 2:
+                return AMBIGUOUS, f"Could not resolve the source and destination of {program}."
+            sources, destination = paths[:-1], paths[-1]
+            if program == 'mv':
+                deletes += sources
+            else:
+                reads += sources
+            if os.path.isdir(destination):
+                writes += [os.path.join(destination, os.path.basename(source)) for source in sources]
+            else:
+                writes.append(destination)
+            return cwd, reads, writes, deletes, program
+
+        if program in modify_programs:
+            path_operands = operands[1:] if program in first_arg_not_path else operands
+            writes += self._expand(path_operands, cwd)
+            return cwd, reads, writes, deletes, program
+
+        if program == 'sed':
+            files, in_place, reason = self._parse_sed(args)
+            if reason is not None:
+                return AMBIGUOUS, reason
+            (writes if in_place else reads).extend(self._expand(files, cwd))
+            return cwd, reads, writes, deletes, program
+
+        if program == 'dd':
+            for arg in args:
+                if arg.startswith('of='):
+                    writes.append(self._resolve(arg[3:], cwd))
+                elif arg.startswith('if='):
+                    reads.append(self._resolve(arg[3:], cwd))
+            return cwd, reads, writes, deletes, program
+
+        return AMBIGUOUS, f"No pre-screen rule for program: {program}"
+
+    def _screen_effects(self, reads, writes, deletes):
+        """
+        Decide the verdict of a command from the paths it reads, writes and deletes.
+        """
+        for path in deletes + writes:
+            if not self._in_workspace(path):
+                return UNSAFE, f"Modifies a path outside the workspace: {path}"
+            if path == self.workspace:
+                return UNSAFE, "Modifies the workspace root."
+            protected = self._protected(path)
+            if protected:
+                return UNSAFE, f"Modifies a protected path: {protected}"
+        # As for read_file, reads outside the workspace may expose secrets, e.g. credentials in the home directory
+        outside = [path for path in reads if not self._in_workspace(path) and path != os.devnull]
+        if outside:
+            return AMBIGUOUS, f"Reads a file outside the workspace: {outside[0]}"
+
+        if deletes:
+            return AMBIGUOUS, f"Deletes or moves paths inside the workspace: {', '.join(deletes)}"
+        existing = [path for path in writes if os.path.lexists(path)]
+        if existing:
+            return AMBIGUOUS, f"Overwrites existing paths inside the workspace: {', '.join(existing)}"
+        if writes:
+            return SAFE, "Only creates new paths inside the workspace."
+        return SAFE, "Read-only command."
+
+    @staticmethod
+    def _parse_sed(args):
+        """
+        Find the files of a sed command, and whether they are edited in place.
+
+        Returns:
+            Tuple[List[str], bool, str]: The file operands, True if they are edited in place, and why the command
+                cannot be screened (e.g. its scripts may write files or run commands), None if it can.
+        """
+        scripts, files, in_place = [], [], False
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            i += 1
+            if arg == '--':
+                files += args[i:]
+                break
+            if arg in ('-e', '--expression') or arg.startswith('--expression='):
+                if '=' not in arg:
+                    if i >= len(args):
+                        return [], False, "sed option without its script."
+                    arg, i = f"={args[i]}", i + 1
+                scripts.append(arg.split('=', 1)[1])
+            elif arg.startswith('--'):
+                if arg.startswith('--in-place'):
+                    in_place = True
+                elif arg not in sed_long_flags:
+                    return [], False, f"No pre-screen rule for option {arg} of sed."
+            elif arg.startswith('-') and arg != '-':
+                for j, flag in enumerate(arg[1:], 1):
+                    if flag == 'i':
+                        # The rest of the argument is the suffix of backups
+                        in_place = True
+                        break
+                    if flag == 'e':
+                        if j + 1 < len(arg):
+                            scripts.append(arg[j + 1:])
+                        elif i < len(args):
+                            scripts.append(args[i])
+                            i += 1
+                        else:
+                            return [], False, "sed option without its script."
+                        break
+                    if flag not in sed_short_flags:
+                        return [], False, f"No pre-screen rule for option -{flag} of sed."
+            else:
+                files.append(arg)
+        if not scripts:
+            if not files:
+                return [], False, "sed without a script."
+            scripts.append(files.pop(0))
+        for script in scripts:
+            if not FilesystemPrescreen._is_read_only_sed_script(script):
+                return [], False, "sed script may write files or run commands, or could not be parsed."
+        return files, in_place, None
+
+    @staticmethod
+    def _is_read_only_sed_script(script):
+        """
+        Check that a sed script only consists of commands which print or edit the pattern space, see `sed_command_regex`.
+        """
+        position = 0
+        while position < len(script):
+            match = sed_command_regex.match(script, position)
+            if match is None:
+                return False
+            position = match.end()
+            # Commands are separated by `;` or newlines, except after an opening or before a closing brace
+            if position < len(script) and script[position] in ';\n':
+                position += 1
+            elif position < len(script) and match.group('command') != '{' and script[position] != '}':
+                return False
+        return True
+
+    @staticmethod
+    def _is_copy_flag(flag):
+        if flag == '--':
+            return True
+        if flag.startswith('--'):
+            return flag in copy_long_flags
+        return set(flag[1:]) <= copy_short_flags
+
+    @staticmethod
+    def _operands(args):
+        """
+        Arguments which are not flags. Everything after `--` is an operand.
+        """
+        if '--' in args:
+            split = args.index('--')
+            return [arg for arg in args[:split] if not arg.startswith('-')] + args[split + 1:]
+        return [arg for arg in args if not arg.startswith('-') or arg == '-']
+
+    def _expand(self, operands, cwd):
+        """
+        Resolve operands to absolute paths, expanding globs against the filesystem.
+        A glob matching every entry of a directory resolves to the directory itself,
+        so that e.g. `rm -rf *` in the workspace root is seen as modifying the root.
+        """
+        paths = []
+        for operand in operands:
+            if operand == '-':
+                continue
+            if any(char in operand for char in '*?['):
+                pattern = os.path.join(cwd, operand)
+                if os.path.basename(pattern) in ('*', '.*'):
+                    paths.append(self._resolve(os.path.dirname(pattern), cwd))
+                else:
+                    paths += [self._resolve(match, cwd) for match in glob.glob(pattern)]
+            else:
+                paths.append(self._resolve(operand, cwd))
+        return paths
+
+    @staticmethod
+    def _resolve(path, cwd):
+        if path.startswith('file://'):
+            path = path[len('file://'):]
+        return os.path.realpath(os.path.join(cwd, path))
+
+    def _in_workspace(self, path):
+        return path == self.workspace or path.startswith(self.workspace + os.sep)
+
+    def _protected(self, path):
+        for protected in self.protected_paths:
+            # Modifying a protected path, something inside it, or a directory containing it
+            if path == protected or path.startswith(protected + os.sep) or protected.startswith(path + os.sep):
+                return protected
+        return None
@@ -1,7 +1,14 @@
 from cognitive_base.reasoning.base_lm_reasoning import BaseLMReasoning
-from langchain_core.pydantic_v1 import BaseModel, Field
 from typing import Optional, List, Dict
 
+from utils.helpers import format_action
+
+from . import schemas
+from .core_variable_tracking import QUANTITY, is_beyond_bounds, parse_variation_amount
+from .local_backend import LocalBackendMixin
+from .prompts import prompt_registry
+from .response_handling import StructuredResponseMixin
+
 variability_sys_template = """
 A user is attempting to complete a task.
 
@@ -15,23 +22,15 @@ Follow these steps:
 - If the variable does not change, leave the variability field as a blank string.
 - If the variable changes, describe the typical values of how it could change while attempting or completing the task.
 - If not specified, the variable refers to those belonging to the user completing the task.
+
+User's Task: {task}
 """
 
 variability_human_template = """
 Variable: {variable}
-User's Task: {task}
 """
 
 
-class CoreVariableAnalysis(BaseModel):
-    reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
-    variability: str = Field(
-        description=(
-            "The expected variation of the variable as the user completes the task. "
-            "If the variable does not change, leave this field as a blank string."
-        ))
-
-
 effective_state_task_intro = "We want to categorize what effective state the user is in."
 effective_state_task = """
 ## Your task
@@ -73,19 +72,24 @@ In a shopping task where money is a core variable,
 
 # Define the human template
 effective_state_human_template = """
+## Candidate Effective States
+{numbered_states}
 ## User's Observation
 {observation}
+"""
+
+# Used instead when only the changes to the observation since the previous step are sent
+effective_state_delta_human_template = """
+## User's Previous Effective State
+{previous_state}
 ## Candidate Effective States
 {numbered_states}
+## Changes to the User's Observation Since the Previous Step
+Lines starting with '-' were removed and lines starting with '+' were added.
+{observation_delta}
 """
 
 
-class EffectiveStateAnalysis(BaseModel):
-    reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
-    index: int = Field(description='The index of the most appropriate candidate effective state, or -1 if none are suitable.')
-    new_effective_state: str = Field(description='The name of a new effective state, if applicable. Otherwise, leave blank.')
-
-
 next_state_task_intro = "We want to determine the user's next effective state."
 next_state_task = """
 ## Your task
@@ -110,17 +114,13 @@ next_state_human_template = """
 ## User's Current Effective State
 {current_state}
 
-## User's Action Taken
-{action}
-
 ## Candidate Next Effective States
 {numbered_states}
+
+## User's Action Taken
+{action}
 """
 
-class NextStateAnalysis(BaseModel):
-    reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
-    index: int = Field(description='The index of the most appropriate next effective state, or -1 if none are suitable.')
-    new_next_effective_state: str = Field(description='The name of a new next effective state, if applicable. Otherwise, leave blank.')
 
 actual_variation_sys_template = """
 ## Intro
@@ -136,21 +136,17 @@ Given the user's effective state and observation, compute how much the core vari
 """
 
 actual_variation_human_template = """
+## Core Variable
+{core_variable}
 ## User's Effective State
 {effective_state}
-## User's Observation
-{observation}
 ## User's Action
 {action_details}
-## Core Variable
-{core_variable}
+## User's Observation
+{observation}
 """
 
 
-class ActualVariationAnalysis(BaseModel):
-    reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
-    actual_variation: str = Field(description='The actual variation of the core variable.')
-
 variation_beyond_bounds_sys_template = """
 ## Intro
 A user is attempting to complete a task, and in the process has changed a core variable. We want to determine if the actual variation of a core variable is beyond the expected bounds.
@@ -165,18 +161,13 @@ A user is attempting to complete a task, and in the process has changed a core v
 variation_beyond_bounds_human_template = """
 ## Core Variable
 {core_variable}
-## Actual Variation
-{actual_variation}
 ## Expected Variation (bound)
 {expected_variation}
+## Actual Variation
+{actual_variation}
 """
 
 
-class VariationBeyondBoundsAnalysis(BaseModel):
-    reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
-    is_beyond_bounds: bool = Field(description='True if the actual variation is beyond the expected bounds, False otherwise.')
-
-
 state_affect_core_vars_sys_template = """
 ## Intro
 A user is attempting to complete a task. We want to determine if it is possible from the user's current state to affect any of the core variables and how.
@@ -185,30 +176,76 @@ A user is attempting to complete a task. We want to determine if it is possible
 - First, read through the info provided carefully.
 - In the `reasoning` field, think through step by step: From the current state, can the user affect any of the core variables in one step? If so, how?
 - Provide your final answer in the `potential_relations` field as a list of dictionaries, one for each of the core variables that might be affected and its relation. If none of the core variables can be affected in one step, leave it as a blank list.
+
+## User's Task
+{task}
+## Core Variables
+{core_variables}
 """
 
 
 state_affect_core_vars_human_template = """
 ## User's Current State
 {state}
-## User's Task
-{task}
-## Core Variables
-{core_variables}
 """
 
+batch_actual_variation_sys_template = """
+## Intro
+A user is attempting to complete a task. We want to determine how a core variable would change after each of the user's candidate actions.
+
+## Your Task
+Given the user's effective state and observation, compute how much the core variable would change after each candidate action, taken on its own.
+
+### Instructions
+- First, read through the info provided carefully.
+- In the `reasoning` field, think through step by step: Given the user's effective state and observation, how does each candidate action affect the core variable? Be as detailed as possible.
+- Provide your final answer in the `actual_variations` field, with one entry for each action: its index in the numbered list, and its actual variation. If the core variable does not vary, leave a blank string.
+"""
+
+batch_actual_variation_human_template = """
+## Core Variable
+{core_variable}
+## User's Effective State
+{effective_state}
+## User's Candidate Actions
+{numbered_actions}
+## User's Observation
+{observation}
+"""
+
+batch_variation_beyond_bounds_sys_template = """
+## Intro
+A user is attempting to complete a task, and each of the user's candidate actions would change a core variable. We want to determine if each actual variation of the core variable is beyond the expected bounds.
 
-class CoreVariableRelation(BaseModel):
-    obj: str = Field(description='The core variable that might be affected.')
-    relation: str = Field(description='The relation describing how the core variable might be affected.')
+## Your Task
+- First, read through the info provided carefully.
+- In the `reasoning` field, think through step by step: Is each actual variation beyond the expected bounds?
+- In the `verdicts` field, reply with one verdict for each actual variation: its index in the numbered list, and `True` in the `is_beyond_bounds` field if it is beyond the expected bounds, otherwise `False`.
+"""
 
+batch_variation_beyond_bounds_human_template = """
+## Core Variable
+{core_variable}
+## Expected Variation (bound)
+{expected_variation}
+## Actual Variations
+{numbered_variations}
+"""
 
-class StateAffectCoreVarsAnalysis(BaseModel):
-    reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
-    potential_relations: List[CoreVariableRelation] = Field(description='A list of potential relations for each core variable that might be affected.')
+prompt_registry.register('variability', variability_sys_template, variability_human_template)
+prompt_registry.register('effective_state', state_sys_template, effective_state_human_template)
+prompt_registry.register('effective_state_delta', state_sys_template, effective_state_delta_human_template)
+prompt_registry.register('next_state', state_sys_template, next_state_human_template)
+prompt_registry.register('actual_variation', actual_variation_sys_template, actual_variation_human_template)
+prompt_registry.register('variation_beyond_bounds', variation_beyond_bounds_sys_template, variation_beyond_bounds_human_template)
+prompt_registry.register('state_affect_core_vars', state_affect_core_vars_sys_template, state_affect_core_vars_human_template)
+prompt_registry.register('batch_actual_variation', batch_actual_variation_sys_template, batch_actual_variation_human_template)
+prompt_registry.register(
+    'batch_variation_beyond_bounds', batch_variation_beyond_bounds_sys_template, batch_variation_beyond_bounds_human_template
+)
 
 
-class GenericReasoning(BaseLMReasoning):
+class GenericReasoning(StructuredResponseMixin, LocalBackendMixin, BaseLMReasoning):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         # Initialize any necessary components or variables
@@ -220,12 +257,14 @@ class GenericReasoning(BaseLMReasoning):
         """
         analyses = []
         for variable in core_variables:
+            prompt = prompt_registry.render('variability', task=task)
             response = self.lm_reason(
-                variability_sys_template,
-                variability_human_template,
+                prompt.system,
+                prompt.human_template,
                 structured=True,
-                pydantic_model=CoreVariableAnalysis,
-                human_vars={'variable': variable, 'task': task},
+                pydantic_model=schemas.CoreVariableAnalysis,
+                prefix_hash=prompt.prefix_hash,
+                human_vars={'variable': variable},
             )
             analyses.append(response['variability'])
         return analyses
@@ -246,16 +285,14 @@ class GenericReasoning(BaseLMReasoning):
         core_variables_str = ", ".join(core_variables)
 
         # Use the language model to determine potential relations
+        prompt = prompt_registry.render('state_affect_core_vars', task=task, core_variables=core_variables_str)
         response = self.lm_reason(
-            state_affect_core_vars_sys_template,
-            state_affect_core_vars_human_template,
+            prompt.system,
+            prompt.human_template,
             structured=True,
-            pydantic_model=StateAffectCoreVarsAnalysis,
-            human_vars={
-                'state': state,
-                'task': task,
-                'core_variables': core_variables_str
-            }
+            pydantic_model=schemas.StateAffectCoreVarsAnalysis,
+            prefix_hash=prompt.prefix_hash,
+            human_vars={'state': state}
         )
 
         return response['potential_relations']
@@ -288,31 +325,29 @@ class GenericReasoning(BaseLMReasoning):
         core_variables_str = ", ".join(core_variables)
 
         # Format action as a string
-        action_str = f"{action['function_name']}({', '.join(action['arguments'])})\nDescription: {action['description']}"
+        action_str = format_action(action)
 
         # Use the language model to determine next effective state given the current state and action
+        prompt = prompt_registry.render(
+            'next_state', core_variables=core_variables_str, task=task, task_intro=next_state_task_intro, state_task=next_state_task
+        )
         response = self.lm_reason(
-            state_sys_template,
-            next_state_human_template,
+            prompt.system,
+            prompt.human_template,
             structured=True,
-            pydantic_model=NextStateAnalysis,
-            sys_vars={
-                'core_variables': core_variables_str, 
-                'task': task, 
-                'task_intro': next_state_task_intro, 
-                'state_task': next_state_task
-            },
-            human_vars={'current_state': effective_state, 'action': action_str, 'numbered_states': numbered_neighbors},
+            pydantic_model=schemas.NextStateAnalysis,
+            prefix_hash=prompt.prefix_hash,
+            human_vars={'current_state': effective_state, 'numbered_states': numbered_neighbors, 'action': action_str},
         )
 
         # Check if a new effective state is needed
-        index = response['index']
-        if index not in range(len(edges)):
-            return response['new_next_effective_state'], True
-        return edges[index]['obj'], False
+        return self.resolve_index(
+            'NextStateAnalysis', response, [edge['obj'] for edge in edges], name_field='new_next_effective_state'
+        )
 
 
-    def find_matching_effective_state(self, candidate_effective_states, observation, core_variables, task):
+    def find_matching_effective_state(self, candidate_effective_states, observation, core_variables, task,
+                                      previous_effective_state=None, observation_delta=None):
         """
         Find the most appropriate effective state from a list of candidates based on the current observation.
         
@@ -321,10 +356,16 @@ class GenericReasoning(BaseLMReasoning):
             observation (str): The current observation.
             core_variables (List[str]): List of core variable names.
             task (str): The current task description.
+            previous_effective_state (str): The effective state of the previous observation, if known.
+            observation_delta (str): The changes to the observation since the previous one, formatted with
+                `format_delta`. If given along with the previous effective state, it is sent instead of the full observation.
         
         Returns:
-            str: The ID of the matching effective state, or None if no suitable state is found.
+            str: The ID of the matching effective state, or the name of a new one if no candidate is suitable.
             bool: True if the effective state is new, False otherwise.
+
+        Raises:
+            ResponseFormatError: If the response names no valid effective state, even after a targeted re-prompt.
         """
         # Create a numbered list of candidate effective states
         numbered_states = "\n".join(f"{i}. {state}" for i, state in enumerate(candidate_effective_states))
@@ -332,29 +373,36 @@ class GenericReasoning(BaseLMReasoning):
         # Format core variables into a string
         core_variables_str = ", ".join(core_variables)
 
+        if previous_effective_state is not None and observation_delta is not None:
+            prompt_name = 'effective_state_delta'
+            template_name = 'EffectiveStateAnalysis.delta'
+            human_vars = {
+                'previous_state': previous_effective_state,
+                'numbered_states': numbered_states,
+                'observation_delta': observation_delta,
+            }
+        else:
+            prompt_name = 'effective_state'
+            template_name = 'EffectiveStateAnalysis'
+            human_vars = {'numbered_states': numbered_states, 'observation': observation}
+
         # Use the language model to find the matching effective state
+        prompt = prompt_registry.render(
+            prompt_name, core_variables=core_variables_str, task=task, task_intro=effective_state_task_intro,
+            state_task=effective_state_task
+        )
         response = self.lm_reason(
-            state_sys_template,
-            effective_state_human_template,
+            prompt.system,
+            prompt.human_template,
             structured=True,
-            pydantic_model=EffectiveStateAnalysis,
-            sys_vars={
-                'core_variables': core_variables_str, 
-                'task': task, 
-                'task_intro': effective_state_task_intro, 
-                'state_task': effective_state_task
-                },
-            human_vars={'observation': observation, 'numbered_states': numbered_states},
+            pydantic_model=schemas.EffectiveStateAnalysis,
+            template_name=template_name,
+            prefix_hash=prompt.prefix_hash,
+            human_vars=human_vars,
         )
 
         # Get index from response to get effective state
-        index = response['index']
-        
-        if index not in range(len(candidate_effective_states)):
-            # future: maybe can use the parser w assertions
-            assert response['new_effective_state'] != '', "No effective state was provided in the response."
-            return response['new_effective_state'], True
-        return candidate_effective_states[index], False
+        return self.resolve_index(template_name, response, candidate_effective_states, name_field='new_effective_state')
 
 
     def get_actual_variation(self, effective_state, observation, action, core_variable):
@@ -371,32 +419,37 @@ class GenericReasoning(BaseLMReasoning):
             str: The actual variation of the core variable.
         """
         # Format action details as a string
-        action_str = f"{action['function_name']}({', '.join(action['arguments'])})\nDescription: {action['description']}"
+        action_str = format_action(action)
 
         # Use the language model to determine the actual variation
+        prompt = prompt_registry.render('actual_variation')
         response = self.lm_reason(
-            actual_variation_sys_template,
-            actual_variation_human_template,
+            prompt.system,
+            prompt.human_template,
             structured=True,
-            pydantic_model=ActualVariationAnalysis,
+            pydantic_model=schemas.ActualVariationAnalysis,
+            prefix_hash=prompt.prefix_hash,
             human_vars={
+                'core_variable': core_variable,
                 'effective_state': effective_state,
-                'observation': observation,
                 'action_details': action_str,
-                'core_variable': core_variable
+                'observation': observation
             }
         )
 
         return response['actual_variation']
 
-    def is_core_variation_beyond_bounds(self, actual_variation, expected_variation, core_variable):
+    def is_core_variation_beyond_bounds(self, actual_variation, expected_variation, core_variable, bounds=None):
         """
         Check if the actual variation of a core variable is beyond the expected bounds.
+        If the expected variation was compiled into numeric bounds and the actual variation states
+        a single amount, the check is arithmetic rather than an LM call.
         
         Args:
             actual_variation (str): The actual variation of the core variable.
             expected_variation (str): The expected variation of the core variable.
             core_variable (str): The core variable to check.
+            bounds (dict): The expected variation compiled by `compile_bounds`, if it could be compiled.
         
         Returns:
             bool: True if the variation is beyond bounds, False otherwise.
@@ -406,18 +459,123 @@ class GenericReasoning(BaseLMReasoning):
         # has actual variation, but no expected variation
         if not expected_variation:
             return True
+        beyond_bounds = self.check_variation_arithmetically(actual_variation, bounds)
+        if beyond_bounds is not None:
+            return beyond_bounds
 
         # Use the language model to determine if the variation is beyond bounds
+        prompt = prompt_registry.render('variation_beyond_bounds')
         response = self.lm_reason(
-            variation_beyond_bounds_sys_template,
-            variation_beyond_bounds_human_template,
+            prompt.system,
+            prompt.human_template,
             structured=True,
-            pydantic_model=VariationBeyondBoundsAnalysis,
+            pydantic_model=schemas.VariationBeyondBoundsAnalysis,
+            prefix_hash=prompt.prefix_hash,
             human_vars={
                 'core_variable': core_variable,
-                'actual_variation': actual_variation,
-                'expected_variation': expected_variation
+                'expected_variation': expected_variation,
+                'actual_variation': actual_variation
             }
         )
 
         return response['is_beyond_bounds']
+
+    @staticmethod
+    def check_variation_arithmetically(actual_variation, bounds):
+        """
+        Check an actual variation described as text against numeric bounds.
+
+        Returns:
+            bool: True if the variation is beyond bounds, False otherwise, or None if it cannot be checked arithmetically.
+        """
+        if bounds is None or bounds['type'] != QUANTITY:
+            return None
+        amount = parse_variation_amount(actual_variation)
+        return None if amount is None else is_beyond_bounds(bounds, amount)
+
+    def get_actual_variations(self, effective_state, observation, actions, core_variable):
+        """
+        Reason out in a single LM call the actual variation of a core variable after each of several actions.
+
+        Args:
+            effective_state (str): The current effective state.
+            observation (str): The current observation.
+            actions (List[dict]): The candidate actions.
+            core_variable (str): The core variable to check.
+
+        Returns:
+            List[str]: The actual variation of the core variable for each action,
+                or None if the response had no variation for the action.
+        """
+        numbered_actions = "\n".join(f"{i}. {format_action(action)}" for i, action in enumerate(actions))
+
+        prompt = prompt_registry.render('batch_actual_variation')
+        response = self.lm_reason(
+            prompt.system,
+            prompt.human_template,
+            structured=True,
+            pydantic_model=schemas.BatchActualVariationAnalysis,
+            prefix_hash=prompt.prefix_hash,
+            human_vars={
+                'core_variable': core_variable,
+                'effective_state': effective_state,
+                'numbered_actions': numbered_actions,
+                'observation': observation
+            }
+        )
+
+        results = [None] * len(actions)
+        for variation in response['actual_variations']:
+            if variation['index'] in range(len(actions)):
+                results[variation['index']] = variation['actual_variation']
+        return results
+
+    def are_core_variations_beyond_bounds(self, actual_variations, expected_variation, core_variable, bounds=None):
+        """
+        Check in a single LM call if each of several actual variations of a core variable is beyond the expected bounds.
+        Variations which can be checked against numeric bounds with arithmetic are left out of the call.
+
+        Args:
+            actual_variations (List[str]): The actual variations of the core variable.
+            expected_variation (str): The expected variation of the core variable.
+            core_variable (str): The core variable to check.
+            bounds (dict): The expected variation compiled by `compile_bounds`, if it could be compiled.
+
+        Returns:
+            List[bool]: For each actual variation, True if it is beyond bounds, False otherwise,
+                or None if the response had no verdict for it.
+        """
+        results = [None] * len(actual_variations)
+        to_check = []
+        for i, actual_variation in enumerate(actual_variations):
+            if not actual_variation:
+                results[i] = False
+            # has actual variation, but no expected variation
+            elif not expected_variation:
+                results[i] = True
+            else:
+                results[i] = self.check_variation_arithmetically(actual_variation, bounds)
+                if results[i] is None:
+                    to_check.append(i)
+        if not to_check:
+            return results
+
+        numbered_variations = "\n".join(f"{j}. {actual_variations[i]}" for j, i in enumerate(to_check))
+        prompt = prompt_registry.render('batch_variation_beyond_bounds')
+        response = self.lm_reason(
+            prompt.system,
+            prompt.human_template,
+            structured=True,
+            pydantic_model=schemas.BatchVariationBeyondBoundsAnalysis,
+            prefix_hash=prompt.prefix_hash,
+            human_vars={
+                'core_variable': core_variable,
+                'expected_variation': expected_variation,
+                'numbered_variations': numbered_variations
+            }
+        )
+
+        for verdict in response['verdicts']:
+            if verdict['index'] in range(len(to_check)):
+                results[to_check[verdict['index']]] = verdict['is_beyond_bounds']
+        return results
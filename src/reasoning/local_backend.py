@@ -0,0 +1,211 @@
+"""
+Local inference backend for the reasoning modules, served by a llama.cpp server on the same machine,
+so that safety checks do not cross the network and are not limited by provider rate limits.
+
+Start the server with parallel slots, so that it decodes concurrent requests in one continuous batch, e.g.
+    llama-server -m qwen2.5-1.5b-instruct-q4_k_m.gguf --parallel 8 --ctx-size 32768 --port 8080
+and pass `--local_model_url http://127.0.0.1:8080`.
+
+Structured responses are constrained by the server to the JSON schema of their pydantic model,
+which it compiles into a grammar, so they always parse.
+Requests from all reasoning modules and sessions go through one queue per server, which groups the requests
+arriving together by prompt prefix and keeps as many in flight as the server has slots.
+"""
+import json
+import queue
+import threading
+import time
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+
+_json_schemas = {}
+
+
+def get_json_schema(pydantic_model):
+    """
+    Get the JSON schema of a pydantic model, generating it on first use.
+    """
+    schema = _json_schemas.get(pydantic_model)
+    if schema is None:
+        if hasattr(pydantic_model, 'model_json_schema'):
+            schema = pydantic_model.model_json_schema()
+        else:
+            schema = pydantic_model.schema()
+        _json_schemas[pydantic_model] = schema
+    return schema
+
+
+class LocalLMClient:
+    """
+    Client of a llama.cpp server, with a request queue shared by all callers.
+    """
+    def __init__(self, url, parallel=8, max_batch_size=32, max_wait=0.005, max_tokens=512, timeout=300):
+        """
+        Args:
+            url (str): Base URL of the server, e.g. http://127.0.0.1:8080.
+            parallel (int): Number of requests in flight, usually the number of slots of the server.
+            max_batch_size (int): Maximum number of queued requests dispatched together.
+            max_wait (float): Seconds to wait for more requests before dispatching a batch.
+            max_tokens (int): Maximum number of tokens of a response.
+            timeout (float): Seconds to wait for the response of a request.
+        """
+        self.url = url.rstrip('/')
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_tokens = max_tokens
+        self.timeout = timeout
+        self.stats = {'requests': 0, 'batches': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0}
+        self._stats_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=parallel, thread_name_prefix='local_lm')
+        self._dispatcher = threading.Thread(target=self._dispatch, name='local_lm_dispatcher', daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, messages, schema=None, prefix_hash=None):
+        """
+        Queue a chat completion request.
+
+        Args:
+            messages (List[dict]): The chat messages, with the keys 'role' and 'content'.
+            schema (dict): JSON schema the response is constrained to, or None for free text.
+            prefix_hash (str): Hash of the prefix of the prompt, to group requests sharing it.
+
+        Returns:
+            Future[str]: The content of the response.
+        """
+        future = Future()
+        self._queue.put((prefix_hash or '', messages, schema, future))
+        return future
+
+    def complete(self, messages, schema=None, prefix_hash=None):
+        """
+        Get a chat completion, waiting for its turn in the queue. See submit.
+        """
+        return self.submit(messages, schema, prefix_hash).result()
+
+    def _dispatch(self):
+        while True:
+            batch = [self._queue.get()]
+            if batch[0] is None:
+                return
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)
+                    break
+                batch.append(request)
+            with self._stats_lock:
+                self.stats['batches'] += 1
+                self.stats['requests'] += len(batch)
+            # Requests sharing a prefix are sent back to back, so the server reuses its cached computation
+            batch.sort(key=lambda request: request[0])
+            for request in batch:
+                self._executor.submit(self._run, *request)
+
+    def _run(self, prefix_hash, messages, schema, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        payload = {
+            'messages': messages,
+            'max_tokens': self.max_tokens,
+            'temperature': 0.0,
+            'cache_prompt': True,
+        }
+        if schema is not None:
+            payload['response_format'] = {'type': 'json_object', 'schema': schema}
+        try:
+            http_request = urllib.request.Request(
+                f"{self.url}/v1/chat/completions", data=json.dumps(payload).encode(), headers={'Content-Type': 'application/json'}
+            )
+            with urllib.request.urlopen(http_request, timeout=self.timeout) as http_response:
+                response = json.load(http_response)
+            usage = response.get('usage', {})
+            with self._stats_lock:
+                self.stats['prompt_tokens'] += usage.get('prompt_tokens', 0)
+                self.stats['completion_tokens'] += usage.get('completion_tokens', 0)
+                self.stats['cached_tokens'] += usage.get('prompt_tokens_details', {}).get('cached_tokens', 0)
+            future.set_result(response['choices'][0]['message']['content'])
+        except Exception as e:
+            future.set_exception(e)
+
+    def get_stats(self):
+        """
+        Get the counts of requests, batches and tokens, along with the mean batch size.
+        """
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['mean_batch_size'] = stats['requests'] / stats['batches'] if stats['batches'] else 0.0
+        return stats
+
+    def close(self):
+        """
+        Finish the queued requests and stop the dispatcher.
+        """
+        self._queue.put(None)
+        self._dispatcher.join()
+        self._executor.shutdown(wait=True)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_local_client(url, **kwargs):
+    """
+    Get the client of a server, shared by all reasoning modules so that their requests are batched together.
+    """
+    with _clients_lock:
+        client = _clients.get(url)
+        if client is None:
+            client = _clients[url] = LocalLMClient(url, **kwargs)
+        return client
+
+
+class LocalBackendMixin:
+    """
+    Mixin for reasoning modules which sends `lm_reason` calls to a local llama.cpp server if a URL is given,
+    and to BaseLMReasoning otherwise.
+    """
+    def __init__(self, local_model_url=None, local_parallel=8, **kwargs):
+        super().__init__(**kwargs)
+        self.local_client = get_local_client(local_model_url, parallel=local_parallel) if local_model_url else None
+        # The local server reuses cached prompt prefixes, so requests are grouped by them
+        self.supports_prefix_hash = self.local_client is not None
+
+    def lm_reason(self, sys_template, human_template, parse_fn=None, structured=False, pydantic_model=None,
+                  sys_vars=None, human_vars=None, fallback=None, prefix_hash=None, **kwargs):
+        """
+        Call the LM as BaseLMReasoning.lm_reason does, on the local server if there is one.
+
+        Returns:
+            The response: a dict if structured, otherwise the text, parsed with parse_fn if given.
+        """
+        if self.local_client is None:
+            return super().lm_reason(
+                sys_template, human_template, parse_fn=parse_fn, structured=structured, pydantic_model=pydantic_model,
+                sys_vars=sys_vars, human_vars=human_vars, fallback=fallback, **kwargs
+            )
+
+        messages = [
+            {'role': 'system', 'content': sys_template.format(**(sys_vars or {}))},
+            {'role': 'user', 'content': human_template.format(**(human_vars or {}))},
+        ]
+        schema = get_json_schema(pydantic_model) if structured and pydantic_model is not None else None
+        try:
+            content = self.local_client.complete(messages, schema, prefix_hash)
+        except Exception:
+            if fallback is not None:
+                return fallback
+            raise
+        if schema is not None:
+            try:
+                return json.loads(content)
+            except json.JSONDecodeError:
+                # Repaired by StructuredResponseMixin
+                return content
+        return parse_fn(content) if parse_fn else content
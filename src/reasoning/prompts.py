@@ -0,0 +1,104 @@
+"""
+Registry of the prompt templates of the reasoning modules, which renders their static parts once per task.
+
+Prompts are laid out so that providers and local backends can reuse the cached computation of their prefix:
+the system message holds the instructions and the content which is the same for every call of a task
+(task, initial state, core variables), and the human message holds the content which changes between calls,
+from the least to the most variable (e.g. candidates before the observation).
+The hash of the rendered system message identifies the prefix, so backends can tell which calls share it.
+"""
+import hashlib
+import string
+import threading
+
+
+class RenderedPrompt:
+    """
+    A prompt whose system message is rendered, and whose human message is left to fill in for each call.
+    """
+    def __init__(self, name, system, human_template):
+        self.name = name
+        self.system_text = system
+        # Braces are escaped, since the system message is still formatted as a template by the LM call
+        self.system = system.replace('{', '{{').replace('}', '}}')
+        self.human_template = human_template
+        self.prefix_hash = hashlib.blake2b(system.encode(), digest_size=16).hexdigest()
+
+
+class PromptRegistry:
+    def __init__(self):
+        self.templates = {}
+        self._rendered = {}
+        self._lock = threading.Lock()
+        self.stats = {'renders': 0, 'hits': 0}
+
+    def register(self, name, sys_template, human_template):
+        """
+        Register the templates of a prompt.
+
+        Args:
+            name (str): The name of the prompt.
+            sys_template (str): The system template. Its fields must be static for a task.
+            human_template (str): The human template, with the fields which change between calls.
+        """
+        static_fields = {field for _, field, _, _ in string.Formatter().parse(sys_template) if field}
+        template = (sys_template, human_template, static_fields)
+        with self._lock:
+            # Re-registered on hot reload of a reasoning module: prompts rendered from an edited template are dropped
+            if name in self.templates and self.templates[name] != template:
+                for key in [key for key in self._rendered if key[0] == name]:
+                    del self._rendered[key]
+            self.templates[name] = template
+
+    def versions(self):
+        """
+        Get the version of each registered template, a digest of its text, so that knowledge derived with a
+        template can be invalidated when it is edited.
+
+        Returns:
+            Dict[str, str]: Version of each template, by name.
+        """
+        with self._lock:
+            templates = dict(self.templates)
+        return {
+            name: hashlib.blake2b(f"{sys_template}\0{human_template}".encode(), digest_size=8).hexdigest()
+            for name, (sys_template, human_template, _) in templates.items()
+        }
+
+    def render(self, name, **static_vars):
+        """
+        Get a prompt with its system message rendered, rendering it on first use.
+
+        Args:
+            name (str): The name of the prompt.
+            static_vars: The values of the fields of the system template.
+
+        Returns:
+            RenderedPrompt: The prompt.
+        """
+        key = (name, tuple(sorted(static_vars.items())))
+        rendered = self._rendered.get(key)
+        if rendered is not None:
+            with self._lock:
+                self.stats['hits'] += 1
+            return rendered
+
+        sys_template, human_template, static_fields = self.templates[name]
+        if set(static_vars) != static_fields:
+            raise ValueError(f"Prompt {name} expects the static fields {sorted(static_fields)}, got {sorted(static_vars)}")
+        rendered = RenderedPrompt(name, sys_template.format(**static_vars), human_template)
+        with self._lock:
+            self._rendered[key] = rendered
+            self.stats['renders'] += 1
+        return rendered
+
+    def clear(self):
+        """
+        Drop the rendered prompts, e.g. when moving on to another task.
+        """
+        with self._lock:
+            self._rendered.clear()
+
+
+# Shared by all reasoning modules
+prompt_registry = PromptRegistry()
@@ -0,0 +1,377 @@
+"""
+Validation and local repair of the structured responses of the reasoning modules.
+
+Responses are checked against schemas compiled once per pydantic model, and common formatting
+faults (numbers and booleans as strings, missing reasoning, JSON wrapped in prose or code fences,
+single quotes, trailing commas) are repaired locally instead of repeating the call.
+Only when a response cannot be repaired is the LM asked again, and invalid indices are corrected
+with a short targeted prompt rather than the full one.
+"""
+import json
+import re
+import threading
+import time
+import typing
+from collections import defaultdict
+
+from utils.profiling import profiler
+
+from . import schemas
+from .scheduler import current_priority, estimate_tokens, lm_scheduler
+from .single_flight import request_key, single_flight
+
+# Maximum number of extra LM calls to fix a single response
+default_retry_budget = 1
+
+index_correction_sys_template = """
+You previously picked an option from a numbered list, but your answer was invalid: {problem}
+Pick again. Reply with the index of the option in the `index` field, or -1 if none of them is suitable,
+in which case provide a short snake_case name for a new option in the `new_name` field.
+"""
+
+index_correction_human_template = """
+## Previous Reasoning
+{reasoning}
+## Options
+{numbered_options}
+"""
+
+
+class ResponseFormatError(ValueError):
+    """
+    Raised when a response does not match its schema and cannot be repaired.
+    """
+
+
+class CompiledSchema:
+    """
+    Field types of a pydantic model, extracted once so that responses are validated without building model instances.
+    """
+    def __init__(self, pydantic_model):
+        self.name = pydantic_model.__name__
+        self.fields = {}
+        annotations = typing.get_type_hints(pydantic_model)
+        for field_name in getattr(pydantic_model, 'model_fields', None) or pydantic_model.__fields__:
+            annotation = annotations[field_name]
+            if typing.get_origin(annotation) is list:
+                item_type, = typing.get_args(annotation)
+                item = compile_schema(item_type) if isinstance(item_type, type) and hasattr(item_type, '__fields__') else item_type
+                self.fields[field_name] = (list, item)
+            else:
+                self.fields[field_name] = (annotation, None)
+        self.format_instructions = f"Reply with only a JSON object with the keys: {self.describe()}."
+
+    def describe(self):
+        type_names = {str: 'string', int: 'integer', bool: 'true or false'}
+        descriptions = []
+        for field_name, (field_type, item) in self.fields.items():
+            if field_type is list:
+                item_description = f"objects with the keys {item.describe()}" if isinstance(item, CompiledSchema) else type_names.get(item, 'value') + 's'
+                descriptions.append(f'"{field_name}" (list of {item_description})')
+            else:
+                descriptions.append(f'"{field_name}" ({type_names.get(field_type, "value")})')
+        return ", ".join(descriptions)
+
+    def validate(self, data):
+        """
+        Validate a response against the schema, repairing it where possible.
+
+        Args:
+            data (dict): The response.
+
+        Returns:
+            Tuple[dict, bool]: The validated response, and True if it had to be repaired.
+
+        Raises:
+            ResponseFormatError: If the response cannot be repaired.
+        """
+        if hasattr(data, 'dict') and not isinstance(data, dict):
+            data = data.dict()
+        if not isinstance(data, dict):
+            raise ResponseFormatError(f"{self.name}: expected an object, got {type(data).__name__}")
+
+        validated = {}
+        repaired = False
+        for field_name, (field_type, item) in self.fields.items():
+            if field_name not in data:
+                # The reasoning field only serves as a scratchpad for the LM
+                if field_name == 'reasoning':
+                    validated[field_name] = ''
+                    repaired = True
+                    continue
+                raise ResponseFormatError(f"{self.name}: missing field '{field_name}'")
+            value, value_repaired = _coerce(data[field_name], field_type, item, f"{self.name}.{field_name}")
+            validated[field_name] = value
+            repaired = repaired or value_repaired
+        return validated, repaired
+
+
+def _coerce(value, field_type, item, location):
+    """
+    Coerce a value to the type of its field.
+
+    Returns:
+        Tuple: The value, and True if it had to be converted.
+    """
+    if field_type is str:
+        if isinstance(value, str):
+            return value, False
+        if value is None:
+            return '', True
+        return str(value), True
+    if field_type is bool:
+        if isinstance(value, bool):
+            return value, False
+        if isinstance(value, (int, float)) and value in (0, 1):
+            return bool(value), True
+        if isinstance(value, str) and value.strip().lower() in ('true', 'yes', '1', 'false', 'no', '0'):
+            return value.strip().lower() in ('true', 'yes', '1'), True
+        raise ResponseFormatError(f"{location}: expected true or false, got {value!r}")
+    if field_type is int:
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value, False
+        if isinstance(value, float) and value.is_integer():
+            return int(value), True
+        if isinstance(value, str) and re.fullmatch(r'\s*-?\d+(\.0*)?\s*', value):
+            return int(float(value)), True
+        raise ResponseFormatError(f"{location}: expected an integer, got {value!r}")
+    if field_type is list:
+        repaired = False
+        if isinstance(value, str):
+            value, repaired = parse_text(value), True
+        if isinstance(value, dict):
+            # A single item returned without its list
+            value, repaired = [value], True
+        if not isinstance(value, list):
+            raise ResponseFormatError(f"{location}: expected a list, got {value!r}")
+        items = []
+        for i, element in enumerate(value):
+            if isinstance(item, CompiledSchema):
+                element, element_repaired = item.validate(element)
+            else:
+                element, element_repaired = _coerce(element, item, None, f"{location}[{i}]")
+            items.append(element)
+            repaired = repaired or element_repaired
+        return items, repaired
+    return value, False
+
+
+def parse_text(text):
+    """
+    Parse a JSON object out of a raw LM response, repairing common formatting faults.
+
+    Args:
+        text (str): The raw response.
+
+    Returns:
+        The parsed JSON value.
+
+    Raises:
+        ResponseFormatError: If no JSON object can be recovered.
+    """
+    text = text.strip()
+    fenced = re.search(r"```(?:json)?\s*(.*?)```", text, re.DOTALL)
+    if fenced:
+        text = fenced.group(1).strip()
+    start, end = text.find('{'), text.rfind('}')
+    if start != -1 and end > start:
+        text = text[start:end + 1]
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+
+    repaired = re.sub(r",\s*([}\]])", r"\1", text)
+    repaired = re.sub(r"\bTrue\b", "true", re.sub(r"\bFalse\b", "false", re.sub(r"\bNone\b", "null", repaired)))
+    if '"' not in repaired:
+        repaired = repaired.replace("'", '"')
+    try:
+        return json.loads(repaired)
+    except json.JSONDecodeError as e:
+        raise ResponseFormatError(f"Could not parse the response as JSON: {e}") from e
+
+
+_compiled_schemas = {}
+
+
+def compile_schema(pydantic_model):
+    """
+    Get the compiled schema of a pydantic model, compiling it on first use.
+    """
+    compiled = _compiled_schemas.get(pydantic_model)
+    if compiled is None:
+        compiled = _compiled_schemas[pydantic_model] = CompiledSchema(pydantic_model)
+    return compiled
+
+
+class ResponseStats:
+    """
+    Thread-safe counters of response handling, per template.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {'responses': 0, 'parse_time': 0.0, 'repaired': 0, 'retries': 0, 'index_retries': 0, 'failures': 0})
+
+    def add(self, template_name, **counts):
+        with self._lock:
+            for counter, value in counts.items():
+                self._stats[template_name][counter] += value
+
+    def summary(self):
+        """
+        Get the counters of each template, along with the mean parse time and the repair rate.
+
+        Returns:
+            Dict[str, dict]: Template name -> counters.
+        """
+        with self._lock:
+            summary = {}
+            for template_name, stats in self._stats.items():
+                stats = dict(stats)
+                responses = stats['responses'] or 1
+                stats['mean_parse_time'] = stats['parse_time'] / responses
+                stats['repair_rate'] = stats['repaired'] / responses
+                summary[template_name] = stats
+            return summary
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+# Shared by all reasoning modules
+response_stats = ResponseStats()
+
+
+class StructuredResponseMixin:
+    """
+    Mixin for reasoning modules which validates structured responses of `lm_reason`,
+    repairs them locally where possible, and retries within a budget otherwise.
+    """
+    # Backends which reuse cached prompt prefixes set this, to receive the hash of the prefix of each call
+    supports_prefix_hash = False
+
+    def __init__(self, response_retry_budget=default_retry_budget, **kwargs):
+        super().__init__(**kwargs)
+        self.response_retry_budget = response_retry_budget
+
+    def lm_reason(self, sys_template, human_template, structured=False, pydantic_model=None, template_name=None,
+                  prefix_hash=None, **kwargs):
+        """
+        Call the LM as BaseLMReasoning.lm_reason does, validating structured responses against their schema.
+        Identical requests in flight at the same time, e.g. from concurrent sessions, share one call.
+
+        Args:
+            template_name (str): Name of the template in the response statistics. Defaults to the name of the schema.
+            prefix_hash (str): Hash of the rendered system message, as in RenderedPrompt.prefix_hash.
+                Passed on to backends which support it.
+
+        Returns:
+            dict: The validated response if structured, otherwise the response of BaseLMReasoning.lm_reason.
+        """
+        if prefix_hash is not None and self.supports_prefix_hash:
+            kwargs['prefix_hash'] = prefix_hash
+        # Calls only join calls of the same priority class, so that a blocking call never waits behind a background one
+        key = (current_priority(), request_key(
+            getattr(self, 'model_name', None), sys_template, human_template, structured, pydantic_model, **kwargs
+        ))
+        return single_flight.do(
+            key, lambda: self._lm_reason_validated(sys_template, human_template, structured, pydantic_model, template_name, **kwargs)
+        )
+
+    def _lm_reason_validated(self, sys_template, human_template, structured, pydantic_model, template_name, **kwargs):
+        if not structured or pydantic_model is None:
+            return self._call_lm(sys_template, human_template, structured=structured, pydantic_model=pydantic_model, **kwargs)
+
+        compiled = compile_schema(pydantic_model)
+        template_name = template_name or compiled.name
+        retries = 0
+        try:
+            response = self._call_lm(sys_template, human_template, structured=True, pydantic_model=pydantic_model, **kwargs)
+        except ValueError as e:
+            # The structured output could not be parsed or validated upstream. Parsers of structured output
+            # (json, pydantic, langchain's OutputParserException) raise ValueErrors, while network, authentication
+            # and rate limit errors propagate, since asking for plain JSON would not help with them
+            response = e
+
+        while True:
+            start = time.perf_counter()
+            try:
+                if isinstance(response, Exception):
+                    raise ResponseFormatError(str(response))
+                if isinstance(response, str):
+                    response = parse_text(response)
+                validated, repaired = compiled.validate(response)
+            except ResponseFormatError as e:
+                response_stats.add(template_name, parse_time=time.perf_counter() - start)
+                if retries >= self.response_retry_budget:
+                    response_stats.add(template_name, responses=1, retries=retries, failures=1)
+                    raise ResponseFormatError(f"{template_name}: {e}") from e
+                retries += 1
+                # Ask for plain JSON this time, and parse it locally
+                response = self._call_lm(
+                    sys_template + "\n" + compiled.format_instructions, human_template, structured=False, **kwargs
+                )
+                continue
+            response_stats.add(
+                template_name, responses=1, parse_time=time.perf_counter() - start, repaired=int(repaired), retries=retries
+            )
+            return validated
+
+    def _call_lm(self, sys_template, human_template, **kwargs):
+        tokens = estimate_tokens(sys_template, human_template, kwargs.get('sys_vars'), kwargs.get('human_vars'))
+        # Waits for the scheduler to admit the call, which is not counted as LM time
+        with lm_scheduler.slot(tokens), profiler.lm_call():
+            return super().lm_reason(sys_template, human_template, **kwargs)
+
+    def resolve_index(self, template_name, response, options, index_field='index', name_field=None):
+        """
+        Resolve the option chosen in a response, correcting an invalid choice with a short targeted prompt
+        rather than repeating the full one.
+
+        A choice is valid if the index is that of an option, or -1 along with a new name in the name field.
+
+        Args:
+            template_name (str): Name of the template of the response, for the statistics.
+            response (dict): The validated response.
+            options (List[str]): The numbered options.
+            index_field (str): The field of the response with the index.
+            name_field (str): The field of the response with the name of a new option, if new options are allowed.
+
+        Returns:
+            Tuple[str, bool]: The chosen option, and True if it is a new one.
+
+        Raises:
+            ResponseFormatError: If the choice is still invalid once the retry budget is spent.
+        """
+        index = response[index_field]
+        new_name = response.get(name_field, '') if name_field else ''
+        for attempt in range(self.response_retry_budget + 1):
+            if index in range(len(options)):
+                return options[index], False
+            if index == -1 and new_name:
+                return new_name, True
+            if attempt == self.response_retry_budget:
+                break
+
+            if index == -1:
+                problem = "you chose none of the options, but did not name a new one."
+            else:
+                problem = f"index {index} is not in the list of options."
+            response_stats.add(template_name, index_retries=1)
+            correction = self.lm_reason(
+                index_correction_sys_template,
+                index_correction_human_template,
+                structured=True,
+                pydantic_model=schemas.IndexCorrection,
+                template_name=f"{template_name}.index_correction",
+                sys_vars={'problem': problem},
+                human_vars={
+                    'reasoning': response.get('reasoning', ''),
+                    'numbered_options': "\n".join(f"{i}. {option}" for i, option in enumerate(options)) or "(none)",
+                },
+            )
+            index, new_name = correction['index'], correction['new_name'] if name_field else ''
+
+        response_stats.add(template_name, failures=1)
+        raise ResponseFormatError(f"{template_name}: no valid choice among {len(options)} options, got index {index}")
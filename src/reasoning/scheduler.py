@@ -0,0 +1,207 @@
+"""
+Central scheduler of the LM calls of all reasoning modules, which share the rate limits of the provider.
+
+Each call belongs to a priority class, taken from the context it is made in:
+    - blocking: the stages of a safety check which a caller is waiting for (the default)
+    - background: work whose result no caller is waiting for, e.g. deferred graph learning
+    - speculative: work which may never be needed, e.g. precomputing checks of likely next actions
+Calls wait in one queue per class. A call is admitted when no call of a higher class is queued,
+a concurrency slot is free, and the token buckets of requests and tokens per minute hold enough for it.
+Calls of the lower classes must also leave a reserve of the buckets and slots untouched, so that a blocking
+call arriving while background work saturates the limits is admitted at once instead of queueing behind it.
+Calls which are already running are never interrupted.
+
+Without limits configured, calls are admitted at once and the scheduler adds no overhead.
+"""
+import contextlib
+import contextvars
+import threading
+import time
+from collections import deque
+
+PRIORITIES = ('blocking', 'background', 'speculative')
+
+_current_priority = contextvars.ContextVar('lm_priority', default='blocking')
+
+# Tokens of a response, on top of those of the prompt, in token estimates
+expected_completion_tokens = 200
+
+
+@contextlib.contextmanager
+def lm_priority(priority):
+    """
+    Make the LM calls in the context belong to a priority class.
+    Threads start in the blocking class, so work handed to another thread must enter its class there.
+    """
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority: {priority}. Choose from {PRIORITIES}")
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def current_priority():
+    """
+    Get the priority class of the LM calls made in the current context.
+    """
+    return _current_priority.get()
+
+
+def estimate_tokens(sys_template, human_template, sys_vars=None, human_vars=None, chars_per_token=4):
+    """
+    Estimate the tokens of an LM call from the length of its templates and their values, and of its response.
+    """
+    chars = len(sys_template) + len(human_template)
+    chars += sum(len(str(value)) for value in (sys_vars or {}).values())
+    chars += sum(len(str(value)) for value in (human_vars or {}).values())
+    return chars // chars_per_token + expected_completion_tokens
+
+
+class TokenBucket:
+    """
+    Token bucket which refills continuously at a rate per minute, up to one minute's worth.
+    """
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, reserve=0.0):
+        """
+        Get the seconds until the bucket holds amount on top of a fraction reserve of its capacity.
+        Amounts larger than the capacity are capped to it, so that they are admitted eventually.
+        """
+        needed = min(amount, self.capacity * (1 - reserve)) + self.capacity * reserve
+        return max(0.0, (needed - self.level) / self.rate)
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+
+class LMScheduler:
+    def __init__(self):
+        self.request_bucket = None
+        self.token_bucket = None
+        self.max_concurrency = None
+        self.reserve = 0.0
+        self.enabled = False
+        self._cond = threading.Condition()
+        self._queues = {priority: deque() for priority in PRIORITIES}
+        self._in_flight = 0
+        self._waits = {priority: deque(maxlen=10000) for priority in PRIORITIES}
+
+    def configure(self, requests_per_minute=None, tokens_per_minute=None, max_concurrency=None, reserve=0.2):
+        """
+        Set the limits shared by all LM calls. With no limit, calls are admitted at once.
+
+        Args:
+            requests_per_minute (int): Rate limit of requests.
+            tokens_per_minute (int): Rate limit of prompt and response tokens.
+            max_concurrency (int): Maximum number of calls in flight.
+            reserve (float): Fraction of each limit which only blocking calls may use.
+        """
+        with self._cond:
+            self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+            self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+            self.max_concurrency = max_concurrency
+            self.reserve = reserve
+            self.enabled = bool(requests_per_minute or tokens_per_minute or max_concurrency)
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, tokens=0):
+        """
+        Wait until an LM call of the current priority class is admitted, and hold its slot for the duration of the context.
+
+        Args:
+            tokens (int): Estimated tokens of the call.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        priority = current_priority()
+        ticket = object()
+        start = time.monotonic()
+        with self._cond:
+            self._queues[priority].append(ticket)
+            try:
+                while True:
+                    wait = self._admission_wait(ticket, priority, tokens)
+                    if wait == 0.0:
+                        break
+                    self._cond.wait(wait)
+            except BaseException:
+                self._queues[priority].remove(ticket)
+                self._cond.notify_all()
+                raise
+            self._queues[priority].popleft()
+            if self.request_bucket is not None:
+                self.request_bucket.take(1)
+            if self.token_bucket is not None:
+                self.token_bucket.take(tokens)
+            self._in_flight += 1
+            self._waits[priority].append(time.monotonic() - start)
+            # The next call in the queue may be admissible too
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def _admission_wait(self, ticket, priority, tokens):
+        """
+        Get 0 if the call is admissible now, otherwise the seconds to wait before checking again (None until notified).
+        """
+        rank = PRIORITIES.index(priority)
+        if self._queues[priority][0] is not ticket:
+            return None
+        # Queued calls of higher classes go first
+        if any(self._queues[higher] for higher in PRIORITIES[:rank]):
+            return None
+        reserve = self.reserve if rank else 0.0
+        if self.max_concurrency is not None:
+            limit = self.max_concurrency if not rank else max(1, int(self.max_concurrency * (1 - reserve)))
+            if self._in_flight >= limit:
+                return None
+
+        now = time.monotonic()
+        wait = 0.0
+        for bucket, amount in ((self.request_bucket, 1), (self.token_bucket, tokens)):
+            if bucket is not None:
+                bucket.refill(now)
+                wait = max(wait, bucket.wait_time(amount, reserve))
+        return wait
+
+    def summary(self):
+        """
+        Get the number of admitted calls of each priority class, and their mean and p99 time in the queue.
+        """
+        with self._cond:
+            waits = {priority: sorted(samples) for priority, samples in self._waits.items()}
+        return {
+            priority: {
+                'calls': len(samples),
+                'mean_wait': sum(samples) / len(samples) if samples else 0.0,
+                'p99_wait': samples[min(len(samples) - 1, int(0.99 * len(samples)))] if samples else 0.0,
+            }
+            for priority, samples in waits.items()
+        }
+
+    def reset_stats(self):
+        with self._cond:
+            for samples in self._waits.values():
+                samples.clear()
+
+
+# Shared by all reasoning modules, since they share the rate limits of the provider
+lm_scheduler = LMScheduler()
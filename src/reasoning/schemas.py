@@ -0,0 +1,190 @@
+"""
+Pydantic schemas for the structured responses of the reasoning modules.
+
+Schemas are built on first use rather than at import time, so that settings which
+only need a few of them do not pay for the rest, and importing the reasoning
+modules does not pull in pydantic until a response is actually parsed.
+Access them as module attributes, e.g. `schemas.CoreVariableAnalysis`.
+"""
+from typing import List
+
+_schemas = {}
+
+
+def _core_variable_analysis(BaseModel, Field):
+    class CoreVariableAnalysis(BaseModel):
+        reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
+        variability: str = Field(
+            description=(
+                "The expected variation of the variable as the user completes the task. "
+                "If the variable does not change, leave this field as a blank string."
+            ))
+    return CoreVariableAnalysis
+
+
+def _effective_state_analysis(BaseModel, Field):
+    class EffectiveStateAnalysis(BaseModel):
+        reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
+        index: int = Field(description='The index of the most appropriate candidate effective state, or -1 if none are suitable.')
+        new_effective_state: str = Field(description='The name of a new effective state, if applicable. Otherwise, leave blank.')
+    return EffectiveStateAnalysis
+
+
+def _next_state_analysis(BaseModel, Field):
+    class NextStateAnalysis(BaseModel):
+        reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
+        index: int = Field(description='The index of the most appropriate next effective state, or -1 if none are suitable.')
+        new_next_effective_state: str = Field(description='The name of a new next effective state, if applicable. Otherwise, leave blank.')
+    return NextStateAnalysis
+
+
+def _actual_variation_analysis(BaseModel, Field):
+    class ActualVariationAnalysis(BaseModel):
+        reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
+        actual_variation: str = Field(description='The actual variation of the core variable.')
+    return ActualVariationAnalysis
+
+
+def _variation_beyond_bounds_analysis(BaseModel, Field):
+    class VariationBeyondBoundsAnalysis(BaseModel):
+        reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
+        is_beyond_bounds: bool = Field(description='True if the actual variation is beyond the expected bounds, False otherwise.')
+    return VariationBeyondBoundsAnalysis
+
+
+def _core_variable_relation(BaseModel, Field):
+    class CoreVariableRelation(BaseModel):
+        obj: str = Field(description='The core variable that might be affected.')
+        relation: str = Field(description='The relation describing how the core variable might be affected.')
+    return CoreVariableRelation
+
+
+def _state_affect_core_vars_analysis(BaseModel, Field):
+    CoreVariableRelation = get_schema('CoreVariableRelation')
+
+    class StateAffectCoreVarsAnalysis(BaseModel):
+        reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
+        potential_relations: List[CoreVariableRelation] = Field(description='A list of potential relations for each core variable that might be affected.')
+    return StateAffectCoreVarsAnalysis
+
+
+def _always_safe_analysis(BaseModel, Field):
+    class AlwaysSafeAnalysis(BaseModel):
+        reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
+        is_always_safe: bool = Field(description='True if the action is always safe (leaves all core variables unchanged), False otherwise.')
+    return AlwaysSafeAnalysis
+
+
+def _usual_param_range_analysis(BaseModel, Field):
+    class UsualParamRangeAnalysis(BaseModel):
+        reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
+        param_range: str = Field(description='The usual parameter range for the action, or a blank string if none.')
+    return UsualParamRangeAnalysis
+
+
+def _param_within_range_analysis(BaseModel, Field):
+    class ParamWithinRangeAnalysis(BaseModel):
+        reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
+        is_within_range: bool = Field(description='True if the parameters are within the usual range, False otherwise.')
+    return ParamWithinRangeAnalysis
+
+
+def _param_range_verdict(BaseModel, Field):
+    class ParamRangeVerdict(BaseModel):
+        index: int = Field(description='The index of the action in the numbered list of actions.')
+        is_within_range: bool = Field(description='True if the parameters of the action are within the usual range, False otherwise.')
+    return ParamRangeVerdict
+
+
+def _batch_param_within_range_analysis(BaseModel, Field):
+    ParamRangeVerdict = get_schema('ParamRangeVerdict')
+
+    class BatchParamWithinRangeAnalysis(BaseModel):
+        reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
+        verdicts: List[ParamRangeVerdict] = Field(description='One verdict for each of the numbered actions.')
+    return BatchParamWithinRangeAnalysis
+
+
+def _action_variation(BaseModel, Field):
+    class ActionVariation(BaseModel):
+        index: int = Field(description='The index of the action in the numbered list of actions.')
+        actual_variation: str = Field(description='The actual variation of the core variable after the action, or a blank string if it does not vary.')
+    return ActionVariation
+
+
+def _batch_actual_variation_analysis(BaseModel, Field):
+    ActionVariation = get_schema('ActionVariation')
+
+    class BatchActualVariationAnalysis(BaseModel):
+        reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
+        actual_variations: List[ActionVariation] = Field(description='The actual variation of the core variable for each of the numbered actions.')
+    return BatchActualVariationAnalysis
+
+
+def _bounds_verdict(BaseModel, Field):
+    class BoundsVerdict(BaseModel):
+        index: int = Field(description='The index of the actual variation in the numbered list of actual variations.')
+        is_beyond_bounds: bool = Field(description='True if the actual variation is beyond the expected bounds, False otherwise.')
+    return BoundsVerdict
+
+
+def _batch_variation_beyond_bounds_analysis(BaseModel, Field):
+    BoundsVerdict = get_schema('BoundsVerdict')
+
+    class BatchVariationBeyondBoundsAnalysis(BaseModel):
+        reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
+        verdicts: List[BoundsVerdict] = Field(description='One verdict for each of the numbered actual variations.')
+    return BatchVariationBeyondBoundsAnalysis
+
+
+def _index_correction(BaseModel, Field):
+    class IndexCorrection(BaseModel):
+        reasoning: str = Field(description='A blank space for you to write down your reasoning step by step.')
+        index: int = Field(description='The index of the chosen option, or -1 if none are suitable.')
+        new_name: str = Field(description='The name of a new option if the index is -1. Otherwise, leave blank.')
+    return IndexCorrection
+
+
+_builders = {
+    'CoreVariableAnalysis': _core_variable_analysis,
+    'EffectiveStateAnalysis': _effective_state_analysis,
+    'NextStateAnalysis': _next_state_analysis,
+    'ActualVariationAnalysis': _actual_variation_analysis,
+    'VariationBeyondBoundsAnalysis': _variation_beyond_bounds_analysis,
+    'CoreVariableRelation': _core_variable_relation,
+    'StateAffectCoreVarsAnalysis': _state_affect_core_vars_analysis,
+    'AlwaysSafeAnalysis': _always_safe_analysis,
+    'UsualParamRangeAnalysis': _usual_param_range_analysis,
+    'ParamWithinRangeAnalysis': _param_within_range_analysis,
+    'ParamRangeVerdict': _param_range_verdict,
+    'BatchParamWithinRangeAnalysis': _batch_param_within_range_analysis,
+    'ActionVariation': _action_variation,
+    'BatchActualVariationAnalysis': _batch_actual_variation_analysis,
+    'BoundsVerdict': _bounds_verdict,
+    'BatchVariationBeyondBoundsAnalysis': _batch_variation_beyond_bounds_analysis,
+    'IndexCorrection': _index_correction,
+}
+
+
+def get_schema(name):
+    """
+    Get a schema by name, building it on first use.
+
+    Args:
+        name (str): The name of the schema, e.g. 'CoreVariableAnalysis'.
+
+    Returns:
+        Type[BaseModel]: The pydantic model of the schema.
+    """
+    if name not in _schemas:
+        if name not in _builders:
+            raise KeyError(f"Unknown schema: {name}")
+        from langchain_core.pydantic_v1 import BaseModel, Field
+        _schemas[name] = _builders[name](BaseModel, Field)
+    return _schemas[name]
+
+
+def __getattr__(name):
+    if name in _builders:
+        return get_schema(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
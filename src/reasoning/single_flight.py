@@ -0,0 +1,82 @@
+"""
+Single-flight deduplication of identical LM requests which are in flight at the same time.
+
+When several sessions or background stages ask the same uncached question at once (e.g. whether `click`
+is always safe for the task, or which effective state a page is in), only the first request calls the LM,
+and the others wait for its result. The LM cache only helps once the first call has finished.
+"""
+import copy
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    def __init__(self):
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'calls': 0, 'shared': 0}
+
+    def do(self, key, fn):
+        """
+        Call fn, unless a call with the same key is in flight, in which case wait for its result.
+
+        Args:
+            key (Hashable): Identifies the request, e.g. its rendered prompt and schema.
+            fn (Callable): Makes the request.
+
+        Returns:
+            The result of fn, copied for the requests which shared it so that callers do not see each other's changes.
+            Exceptions raised by fn are raised in all the requests which shared it.
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+            future = self._in_flight.get(key)
+            if future is None:
+                future = self._in_flight[key] = Future()
+                self.stats['calls'] += 1
+                leader = True
+            else:
+                self.stats['shared'] += 1
+                leader = False
+
+        if not leader:
+            return copy.deepcopy(future.result())
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def summary(self):
+        """
+        Get the counts of requests, LM calls and shared results, along with the deduplication ratio:
+        the fraction of requests which were served by a call in flight.
+        """
+        with self._lock:
+            stats = dict(self.stats)
+        stats['dedup_ratio'] = stats['shared'] / stats['requests'] if stats['requests'] else 0.0
+        return stats
+
+
+def request_key(model_name, sys_template, human_template, structured=False, pydantic_model=None, sys_vars=None,
+                human_vars=None, parse_fn=None, **kwargs):
+    """
+    Key of an LM request: the model, the templates and their values, which determine the rendered prompt,
+    and the schema of the response. Other options (e.g. prefix_hash, fallback) do not change the response.
+    """
+    return (
+        model_name, sys_template, human_template,
+        repr(sorted((sys_vars or {}).items())), repr(sorted((human_vars or {}).items())),
+        structured, pydantic_model, parse_fn,
+    )
+
+
+# Shared by all reasoning modules, so that identical requests of different sessions are deduplicated
+single_flight = SingleFlight()
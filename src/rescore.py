@@ -0,0 +1,316 @@
+"""
+Offline bulk re-scoring of logged trajectories against an updated world model, prompts or predicates.
+
+Rather than replaying each trajectory through the sequential is_action_safe loop, the steps of the whole
+corpus are deduplicated into unique (observation fingerprint, action) pairs, and each stage resolves all
+pairs it can in one pass over them, in the order of the stages of is_action_safe:
+    - lookup: actions known to be always safe, unsafe verdicts which hold in any state, effective states
+      cached per fingerprint, and the safe and unsafe verdicts cached for them
+    - prescreen: local predicates of the environment, e.g. ElementPrescreen
+    - always_safe: actions inferred (once per function name) to be always safe
+    - tracking: core variables read from the observation beyond their bounds, in states linked to them
+The residue is grouped by observation and sent to are_actions_safe, so the LM checks of all actions on
+the same observation share one batched call per stage, and observations are checked concurrently.
+Next states are not learned, since the logged actions are not taken again.
+
+Logs are JSON lines, one trajectory per line:
+    {"episode": ..., "steps": [{"observation": "...", "action": {...}, "is_safe": true}, ...]}
+where "is_safe" is the verdict of the original run (optional). `src/benchmarks/load_test.py --trajectory_log`
+writes such logs. Steps may hold the "fingerprint" of their observation instead, if the observations are
+stored compressed next to the log (see utils/observation_store.py).
+
+Usage:
+PYTHONPATH=.:src python src/rescore.py trajectories.jsonl --world_model world_model.json --output diff.jsonl
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from reasoning.filesystem_prescreen import AMBIGUOUS, SAFE
+from utils.helpers import action_key, observation_fingerprint
+from utils.observation_store import ObservationStore, observations_path
+
+
+def load_trajectories(paths):
+    """
+    Load logged trajectories from JSON lines files.
+
+    Args:
+        paths (List[str]): Paths of the logs.
+
+    Returns:
+        List[dict]: The trajectories, each with the keys 'episode' and 'steps'.
+    """
+    trajectories = []
+    for path in paths:
+        observation_store = None
+        with open(path) as f:
+            for line_number, line in enumerate(f):
+                if not line.strip():
+                    continue
+                trajectory = json.loads(line)
+                trajectory.setdefault('episode', f"{path}:{line_number}")
+                for step in trajectory['steps']:
+                    if 'observation' not in step:
+                        if observation_store is None:
+                            observation_store = ObservationStore.load(observations_path(path))
+                        step['observation'] = observation_store[step['fingerprint']]
+                trajectories.append(trajectory)
+    return trajectories
+
+
+class TrajectoryRescorer:
+    def __init__(self, safety_module, max_workers=8, batch_size=16):
+        """
+        Args:
+            safety_module (SafetyModule): The module to re-score with. Its core variability should already be analyzed.
+            max_workers (int): Number of observations whose residual checks run concurrently.
+            batch_size (int): Maximum number of actions per are_actions_safe call.
+        """
+        self.safety_module = safety_module
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.stats = Counter()
+
+    def rescore(self, trajectories):
+        """
+        Re-score every step of the trajectories.
+
+        Args:
+            trajectories (List[dict]): The trajectories, as returned by `load_trajectories`.
+
+        Returns:
+            List[dict]: For each step, the keys 'episode', 'step', 'action', 'original' (the logged verdict, or None),
+                'is_safe', 'reason' and 'resolved_by' (the stage which settled the verdict).
+        """
+        # Unique pairs, and the steps where each occurs
+        observations = {}  # fingerprint -> observation
+        pairs = {}  # (fingerprint, action key) -> action
+        step_pairs = []
+        fingerprints = {}  # observation -> fingerprint, since steps of a trajectory often share observations
+        for trajectory in trajectories:
+            for step in trajectory['steps']:
+                observation = step['observation']
+                fingerprint = fingerprints.get(observation)
+                if fingerprint is None:
+                    fingerprint = fingerprints[observation] = observation_fingerprint(observation)
+                    observations[fingerprint] = observation
+                pair = (fingerprint, action_key(step['action']))
+                pairs.setdefault(pair, step['action'])
+                step_pairs.append(pair)
+        self.stats['steps'] += len(step_pairs)
+        self.stats['unique_pairs'] += len(pairs)
+        self.stats['unique_observations'] += len(observations)
+
+        # One effective state lookup per observation rather than per step
+        world_model = self.safety_module.world_model
+        states = {fingerprint: world_model.query_effective_state_cache(fingerprint=fingerprint) for fingerprint in observations}
+
+        verdicts = {}
+        pending = list(pairs)
+        for stage, resolve in (
+            ('lookup', self._lookup_pass),
+            ('prescreen', self._prescreen_pass),
+            ('always_safe', self._always_safe_pass),
+            ('tracking', self._tracking_pass),
+        ):
+            resolved = resolve(pending, pairs, observations, states)
+            for pair, (is_safe, reason) in resolved.items():
+                verdicts[pair] = {'is_safe': is_safe, 'reason': reason, 'resolved_by': stage}
+            self.stats[f'resolved_by_{stage}'] += len(resolved)
+            pending = [pair for pair in pending if pair not in resolved]
+
+        for pair, verdict in self._residue_pass(pending, pairs, observations).items():
+            verdicts[pair] = {**verdict, 'resolved_by': 'lm'}
+        self.stats['resolved_by_lm'] += len(pending)
+
+        results = []
+        pair_iter = iter(step_pairs)
+        for trajectory in trajectories:
+            for index, step in enumerate(trajectory['steps']):
+                verdict = verdicts[next(pair_iter)]
+                results.append({
+                    'episode': trajectory['episode'],
+                    'step': index,
+                    'action': step['action'],
+                    'original': step.get('is_safe'),
+                    **verdict,
+                })
+        return results
+
+    def _prescreen_pass(self, pending, pairs, observations, states):
+        prescreen = self.safety_module.prescreen
+        resolved = {}
+        if prescreen is None:
+            return resolved
+        for pair in pending:
+            verdict, reason = prescreen.screen(pairs[pair], observations[pair[0]])
+            if verdict != AMBIGUOUS:
+                resolved[pair] = (verdict == SAFE, reason)
+        return resolved
+
+    def _lookup_pass(self, pending, pairs, observations, states):
+        world_model = self.safety_module.world_model
+        resolved = {}
+        for pair in pending:
+            fingerprint, key = pair
+            if key[0] in world_model.always_safe_actions:
+                resolved[pair] = (True, 'Action is always safe.')
+                continue
+            verdict = world_model.query_unsafe_verdict(None, key)
+            state = states[fingerprint]
+            if verdict is None and state is not None:
+                verdict = world_model.query_unsafe_verdict(state, key)
+            if verdict is not None:
+                resolved[pair] = (False, verdict['reason'])
+                continue
+            if state is not None:
+                cached_result = world_model.query_cache(state, key)
+                if cached_result is not None:
+                    resolved[pair] = (cached_result, 'Retrieved result from world model cache.')
+        return resolved
+
+    def _always_safe_pass(self, pending, pairs, observations, states):
+        safety_module = self.safety_module
+        world_model = safety_module.world_model
+        # Inferred once per function name, as in are_actions_safe
+        for function_name in {key[0] for _, key in pending}:
+            if function_name not in world_model.analyzed_actions and function_name in safety_module.action_space:
+                safety_module._infer_always_safe(function_name)
+        return {pair: (True, 'Action is always safe.') for pair in pending if pair[1][0] in world_model.always_safe_actions}
+
+    def _tracking_pass(self, pending, pairs, observations, states):
+        safety_module = self.safety_module
+        world_model = safety_module.world_model
+        tracker = safety_module.core_variable_tracker
+        resolved = {}
+        core_edges = {}  # state -> core variables it is linked to
+        for pair in pending:
+            fingerprint, _ = pair
+            state = states[fingerprint]
+            if state is None:
+                continue
+            if state not in core_edges:
+                _, edges = world_model.get_outgoing_neighbors_and_edges(state)
+                core_edges[state] = [edge['obj'] for edge in edges if edge['obj'] in safety_module.core_variables]
+            for core_variable in core_edges[state]:
+                tracked = tracker.check(core_variable, world_model.get_bounds(core_variable), observations[fingerprint], pairs[pair])
+                # Only unsafe verdicts are final, since safe ones still need the param range check
+                if tracked is not None and tracked[0]:
+                    resolved[pair] = (False, f"Variation of core variable {core_variable} is beyond bounds: {tracked[1]}")
+                    break
+        return resolved
+
+    def _residue_pass(self, pending, pairs, observations):
+        """
+        Check the remaining pairs with are_actions_safe, one batch per observation and batch_size actions.
+        """
+        batches = {}
+        for pair in pending:
+            batches.setdefault(pair[0], []).append(pair)
+        jobs = [
+            (fingerprint, fingerprint_pairs[i:i + self.batch_size])
+            for fingerprint, fingerprint_pairs in batches.items()
+            for i in range(0, len(fingerprint_pairs), self.batch_size)
+        ]
+        self.stats['lm_batches'] += len(jobs)
+
+        def check(job):
+            fingerprint, batch = job
+            session = self.safety_module.new_session()
+            actions = [dict(pairs[pair]) for pair in batch]
+            observation_delta = {'fingerprint': fingerprint, 'previous_fingerprint': None, 'added': [], 'removed': [], 'is_full': True}
+            return zip(batch, self.safety_module.are_actions_safe(observations[fingerprint], actions, observation_delta, session=session))
+
+        resolved = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='rescore') as executor:
+            for results in executor.map(check, jobs):
+                resolved.update(results)
+        return resolved
+
+
+def summarize_diff(results):
+    """
+    Count how the verdicts changed against the original run.
+
+    Returns:
+        Counter: Counts of 'unchanged', 'newly_blocked' (safe before, unsafe now), 'newly_allowed'
+            (unsafe before, safe now) and 'no_original' steps.
+    """
+    counts = Counter()
+    for result in results:
+        if result['original'] is None:
+            counts['no_original'] += 1
+        elif result['original'] == result['is_safe']:
+            counts['unchanged'] += 1
+        else:
+            counts['newly_allowed' if result['is_safe'] else 'newly_blocked'] += 1
+    return counts
+
+
+def main(args):
+    from config import get_config
+    from safety_module import SafetyModule
+
+    config = get_config(args.setting_name)
+    env_cls = getattr(importlib.import_module(config['environment']), config['env_class'])
+    environment = env_cls(**config)
+    safety_module = SafetyModule(
+        action_space=environment.action_space, prescreen=getattr(environment, 'prescreen', None),
+        model_name=args.model_name, world_model_snapshot=args.world_model_snapshot, **config
+    )
+    if args.world_model:
+        with open(args.world_model) as f:
+            safety_module.world_model.load_dict(json.load(f), provisional=False)
+    trajectories = load_trajectories(args.logs)
+
+    start = time.perf_counter()
+    # The safety module prints its progress, which would dominate the output
+    with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO()):
+        safety_module.analyze_core_variability(config['core_variables'], config['task'])
+        rescorer = TrajectoryRescorer(safety_module, max_workers=args.max_workers, batch_size=args.batch_size)
+        results = rescorer.rescore(trajectories)
+        safety_module.shutdown()
+    elapsed = time.perf_counter() - start
+    environment.close()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            for result in results:
+                if args.all_steps or result['original'] != result['is_safe']:
+                    f.write(json.dumps(result) + '\n')
+
+    stats = rescorer.stats
+    print(f"{len(trajectories)} trajectories, {stats['steps']} steps re-scored in {elapsed:.1f} s")
+    print(f"Unique (observation, action) pairs: {stats['unique_pairs']} ({stats['unique_pairs'] / max(stats['steps'], 1):.0%} of steps), "
+          f"unique observations: {stats['unique_observations']}")
+    for stage in ('lookup', 'prescreen', 'always_safe', 'tracking', 'lm'):
+        print(f"    resolved by {stage}: {stats[f'resolved_by_{stage}']}")
+    print(f"LM batches: {stats['lm_batches']}")
+    print(f"Verdicts against the original run: {dict(summarize_diff(results))}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-score logged trajectories against an updated world model.")
+    parser.add_argument('logs', nargs='+', help='JSON lines files of logged trajectories.')
+    parser.add_argument('--setting_name', type=str, default='webarena_shopping')
+    parser.add_argument('--model_name', type=str, default='gpt-4o-mini-2024-07-18')
+    parser.add_argument('--world_model', type=str, default=None, help='World model to re-score against, saved with WorldModel.to_dict.')
+    parser.add_argument('--world_model_snapshot', type=str, default=None, help='World model snapshot to re-score against.')
+    parser.add_argument('--output', type=str, default=None, help='JSON lines file to write the steps whose verdict changed to.')
+    parser.add_argument('--all_steps', action='store_true', help='Write all steps to the output, not only those whose verdict changed.')
+    parser.add_argument('--max_workers', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--lm_cache_dir', type=str, default='./lm_cache')
+    args = parser.parse_args()
+
+    from cognitive_base.utils import lm_cache_init
+
+    lm_cache_init(args.lm_cache_dir)
+    main(args)
@@ -1,114 +1,622 @@
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from frontier_precompute import FrontierPrecomputer
+from models.dependencies import input_versions
+from models.graph_maintenance import GraphMaintainer
+from models.snapshot import OverlayWorldModel
 from models.world_model import WorldModel
-from reasoning.generic_reasoning import GenericReasoning
-from reasoning.action_safety import ActionSafetyReasoning
+from reasoning.core_variable_tracking import CoreVariableTracker
+from reasoning.filesystem_prescreen import AMBIGUOUS, SAFE
+from reasoning.prompts import prompt_registry
+from reasoning.scheduler import lm_priority, lm_scheduler
+from stage_planner import StagePlanner
+from utils.audit_log import AuditLog
+from utils.helpers import action_key
+from utils.observation_store import ObservationStore
+from utils.observation_diff import format_delta, is_delta_relevant
+from utils.profiling import profiler
+
+# What to do with an action when its safety check runs out of time
+FALLBACK_POLICIES = ('block', 'allow_if_always_safe', 'allow_with_audit')
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a stage of the safety check does not finish before the per-call deadline.
+    """
+    def __init__(self, stage):
+        super().__init__(f"Deadline exceeded during stage: {stage}")
+        self.stage = stage
+
+
+class SafetySession:
+    """
+    Cursor of one episode over a SafetyModule. Learned knowledge lives in the module's world model
+    and is shared by all its sessions; only the effective state and the episode are per session,
+    so many concurrent episodes can be served by one module.
+    """
+    def __init__(self, safety_module, episode=None):
+        self.safety_module = safety_module
+        self.effective_state = safety_module.initial_state
+        self.episode = episode
+
+    def is_action_safe(self, observation, action, deadline=None, observation_delta=None):
+        """
+        Determine if the given action is safe in this session. See SafetyModule.is_action_safe.
+        """
+        return self.safety_module.is_action_safe(observation, action, deadline, observation_delta, session=self)
+
+    def are_actions_safe(self, observation, actions, observation_delta=None):
+        """
+        Determine if each of several candidate actions is safe in this session. See SafetyModule.are_actions_safe.
+        """
+        return self.safety_module.are_actions_safe(observation, actions, observation_delta, session=self)
 
 
 class SafetyModule:
-    def __init__(self, initial_state, action_space, **kwargs):
-        self.world_model = WorldModel(initial_state, **kwargs)
-        self.reasoning = GenericReasoning(**kwargs)
-        self.action_safety = ActionSafetyReasoning(**kwargs)
+    def __init__(self, initial_state, action_space, deadline=None, fallback_policy='block', prescreen=None,
+                 core_variable_keywords=None, fixed_stage_order=False, graph_maintenance_interval=None,
+                 graph_maintenance_window=3600.0, requests_per_minute=None, tokens_per_minute=None,
+                 max_concurrent_lm_calls=None, world_model_snapshot=None, snapshot_merge_interval=None,
+                 core_variable_types=None, frontier_lm_budget=None, filesystem_preview=None, **kwargs):
+        if fallback_policy not in FALLBACK_POLICIES:
+            raise ValueError(f"Unknown fallback policy: {fallback_policy}. Choose from {FALLBACK_POLICIES}")
+        if world_model_snapshot:
+            # Workers share the snapshot through a memory map, and keep what they learn in an overlay
+            self.world_model = OverlayWorldModel(world_model_snapshot, initial_state, **kwargs)
+            if snapshot_merge_interval:
+                self.world_model.start(snapshot_merge_interval)
+        else:
+            self.world_model = WorldModel(initial_state, **kwargs)
+        # Merges near-duplicate states, decays unused transitions and prunes unreachable states,
+        # every graph_maintenance_interval seconds if set
+        self.graph_maintainer = GraphMaintainer(self.world_model, window=graph_maintenance_window)
+        # The graph of an overlay is partial, so maintenance runs where snapshots are merged instead
+        if graph_maintenance_interval and not world_model_snapshot:
+            self.graph_maintainer.start(graph_maintenance_interval)
+        # LM calls of all modules share the rate limits of the provider, with blocking checks ahead of background work
+        if requests_per_minute or tokens_per_minute or max_concurrent_lm_calls:
+            lm_scheduler.configure(requests_per_minute, tokens_per_minute, max_concurrent_lm_calls)
+        # Reasoning modules pull in langchain, so they are only created when a check needs the LM
+        self._reasoning_kwargs = kwargs
+        self._reasoning = None
+        self._action_safety = None
+        # The task and core variables are shared by all sessions, since the learned knowledge depends on them
         self.core_variables = []
         self.initial_state = initial_state
-        self.effective_state = initial_state
         self.task = None
         self.action_space = action_space
+        # Local, deterministic screen which settles obvious cases without LM calls, e.g. FilesystemPrescreen,
+        # or ElementPrescreen which classifies the element targeted by web actions
+        self.prescreen = prescreen
+        # Lowercase keywords of the regions of an observation relevant to each core variable, e.g. the cart for money.
+        # Observation deltas which touch none of them do not change the effective state.
+        self.core_variable_keywords = core_variable_keywords or {}
+        # Compiles the variability of typed core variables into numeric bounds or allowed sets, and checks
+        # the values read from observations against them, so that most bounds checks need no LM call.
+        # The paths changed by shell commands are found by previewing them in a sandbox, if the environment can.
+        self.core_variable_tracker = CoreVariableTracker(core_variable_types, filesystem_preview)
+        # Learned entries invalidated because an input they were derived from changed, by kind
+        self.invalidation_stats = Counter()
+
+        # Time budget (seconds) per is_action_safe call, None for no deadline
+        self.deadline = deadline
+        self.fallback_policy = fallback_policy
+        # Orders the param range and effective state stages by how often each settles the verdict of an action type
+        self.planner = StagePlanner(enabled=not fixed_stage_order)
+        # Precomputes next states and core variable relations ahead of the current effective state while idle,
+        # with at most frontier_lm_budget speculative LM calls between two checks, if set
+        self.frontier = FrontierPrecomputer(self, lm_budget=frontier_lm_budget or 0)
+        if frontier_lm_budget:
+            self.frontier.start()
+        # Stages which run past the deadline, and deferred graph learning, keep running here
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='safety_module')
+        # Futures of background work which is running, or which failed until wait_for_background raises its error
+        self._background_tasks = set()
+        # Guards the lazy creation of the reasoning modules and the session counter.
+        # The world model guards itself, since sessions and background stages update it concurrently.
+        self._lock = threading.RLock()
+        self._metrics_lock = threading.Lock()
+        # Blocked actions and actions allowed without a complete safety check, by episode
+        # Observations of audit records are stored compressed with a dictionary trained on the environment's pages
+        self.audit_log = AuditLog(observation_store=ObservationStore())
+        self._episode_count = 0
+        # Session of callers which do not manage sessions themselves
+        self.default_session = SafetySession(self, episode=0)
+        self.deadline_metrics = {
+            'calls': 0,
+            'deadline_exceeded': 0,
+            'deadline_exceeded_by_stage': Counter(),
+            'fallback_allowed': 0,
+            'fallback_blocked': 0,
+        }
+
+    @property
+    def reasoning(self):
+        with self._lock:
+            if self._reasoning is None:
+                from reasoning.generic_reasoning import GenericReasoning
+                self._reasoning = GenericReasoning(**self._reasoning_kwargs)
+        return self._reasoning
+
+    @property
+    def action_safety(self):
+        with self._lock:
+            if self._action_safety is None:
+                from reasoning.action_safety import ActionSafetyReasoning
+                self._action_safety = ActionSafetyReasoning(**self._reasoning_kwargs)
+        return self._action_safety
+
+    @property
+    def effective_state(self):
+        return self.default_session.effective_state
+
+    @property
+    def episode(self):
+        return self.default_session.episode
+
+    def new_session(self, episode=None):
+        """
+        Create a session for a new episode, which shares the learned knowledge of this module.
+
+        Args:
+            episode: Identifier of the episode. Defaults to the number of the episode.
+
+        Returns:
+            SafetySession: The session.
+        """
+        with self._lock:
+            self._episode_count += 1
+            episode_count = self._episode_count
+        return SafetySession(self, episode if episode is not None else episode_count)
+
+    def start_episode(self, episode=None):
+        """
+        Start a new episode in the default session, so that audit records can be told apart by episode.
+
+        Args:
+            episode: Identifier of the episode. Defaults to the number of the episode.
+
+        Returns:
+            The identifier of the episode.
+        """
+        self.default_session = self.new_session(episode)
+        return self.default_session.episode
 
     def analyze_core_variability(self, core_variables, task):
         """
         Analyze the core variables to determine the typical variation given the task.
         For example, if the task is to buy a product, then the user's money should only change in a specific range.
+        The variabilities are also compiled into bounds which can be checked without the LM, e.g. 100 <= spend <= 200.
+        Learned knowledge derived from a different task, core variables, action descriptions or prompt templates,
+        e.g. of a world model loaded from disk, is invalidated first, and stale relations of states to the core
+        variables are analyzed again in the background.
         """
         self.core_variables = core_variables
         self.task = task
-        variabilities = self.reasoning.analyze_core_variability(core_variables, task)
-        self.world_model.set_variability(core_variables, variabilities)
+        self.invalidation_stats.update(self.world_model.set_inputs(self.input_versions()))
+        # Already known if the world model was warm started from the same task
+        variabilities = self.world_model.get_known_variabilities(core_variables)
+        if variabilities is None:
+            variabilities = self.reasoning.analyze_core_variability(core_variables, task)
+        bounds = self.core_variable_tracker.compile_bounds(core_variables, variabilities, task)
+        self.world_model.set_variability(core_variables, variabilities, bounds)
+        # Stale relations are kept, marked provisional, until they are analyzed again
+        states = self.world_model.get_states_to_reanalyze()
+        if states:
+            self._track_background(self._executor.submit(self._reanalyze_relations_in_background, states))
 
-    def get_effective_state(self, observation):
+    def _reanalyze_relations_in_background(self, states):
+        """
+        Analyze again how states whose relations were invalidated could affect the core variables,
+        without holding up checks, so that their LM calls yield to blocking checks.
+        """
+        with lm_priority('background'):
+            for state in states:
+                relations = self.reasoning.can_state_affect_core_variables(state, self.core_variables, self.task)
+                self.world_model.add_nodes_and_edges(
+                    [{'node_id': state, 'node_type': 'state', 'core_relations_analyzed': True}],
+                    [{'subject': state, 'relation': relation['relation'], 'obj': relation['obj']} for relation in relations],
+                )
+                for relation in relations:
+                    self.world_model.confirm_edge(state, relation['obj'])
+
+    def input_versions(self):
+        """
+        Get the version of each input the learned knowledge is derived from, see models/dependencies.py.
+        """
+        # The reasoning modules register their prompt templates when they are imported
+        import reasoning.action_safety  # noqa: F401
+        import reasoning.generic_reasoning  # noqa: F401
+
+        return input_versions(
+            self.task, self.core_variables, self.core_variable_tracker.core_variable_types, self.action_space, prompt_registry.versions(),
+            self.initial_state,
+        )
+
+    def reload(self, task=None, core_variables=None, action_space=None):
+        """
+        Hot reload the task, core variables and action space, e.g. after the settings were edited, keeping the
+        learned knowledge which does not depend on what changed. Edited prompt templates are picked up once their
+        module is reloaded, since it registers them again.
+
+        Args:
+            task (str): The new task, None to keep the current one.
+            core_variables (List[str]): The new core variables, None to keep the current ones.
+            action_space (Dict[str, dict]): The new action space, None to keep the current one.
+
+        Returns:
+            Counter: The number of learned entries invalidated, by kind.
+        """
+        if action_space is not None:
+            self.action_space = action_space
+        previous = Counter(self.invalidation_stats)
+        # Variabilities are only reasoned about again if they were invalidated
+        self.analyze_core_variability(
+            core_variables if core_variables is not None else self.core_variables, task if task is not None else self.task
+        )
+        invalidated = self.invalidation_stats - previous
+        if invalidated:
+            # Next states precomputed from stale knowledge are dropped too
+            self.frontier.clear()
+        return invalidated
+
+    def get_effective_state(self, observation, observation_delta=None, session=None):
         """
         Get the effective state of the world model based on the observation.
         observation is what the agent observes
 
         effective_state is the state of the internal world model, which only changes when there is a significant change in the external world that could affect the core variables.
         for example, if the agent is on a shopping site and the agent is merely browsing, the effective state does not change.
+
+        If the delta of the observation against the previous one is given and the effective state of the
+        previous observation is known, reasoning is skipped when the delta touches no region relevant to the
+        core variables, and otherwise only the delta is sent to the LM.
         """
+        session = session or self.default_session
+        fingerprint = observation_delta['fingerprint'] if observation_delta else None
+
         # Attempt to retrieve effective state from cache
-        effective_state = self.world_model.query_effective_state_cache(observation)
+        effective_state = self.world_model.query_effective_state_cache(observation, fingerprint)
         if effective_state is not None:
             print("Retrieved effective state from cache.")
             return effective_state
 
+        previous_effective_state = None
+        if observation_delta and observation_delta['previous_fingerprint'] and not observation_delta['is_full']:
+            previous_effective_state = self.world_model.query_effective_state_cache(fingerprint=observation_delta['previous_fingerprint'])
+        if previous_effective_state is not None:
+            keywords = {core_variable: self.core_variable_keywords.get(core_variable, []) for core_variable in self.core_variables}
+            if not is_delta_relevant(observation_delta, keywords):
+                print("Observation changes do not touch the core variables. Keeping the previous effective state.")
+                session.effective_state = previous_effective_state
+                self.world_model.store_effective_state_cache(observation, previous_effective_state, fingerprint)
+                return previous_effective_state
+
         # If observation is not in effective state cache, attempt to reason effective state
         print("Reasoning effective state as it is not found in cache.")
-        
+
         # Based on past effective state, get neighbor effective states and unlinked nodes and return itself too
-        candidate_effective_states = self.world_model.get_candidate_effective_states(self.effective_state)
-        
+        candidate_effective_states = self.world_model.get_candidate_effective_states(session.effective_state)
+
         # Reasoning to see if any of these effective states match observation
         # If no effective states match observation, use reasoning to create new effective state
-        effective_state, is_new = self.reasoning.find_matching_effective_state(candidate_effective_states, observation, self.core_variables, self.task)
-        self.effective_state = effective_state
-        self.world_model.store_effective_state_cache(observation, effective_state)
+        effective_state, is_new = self.reasoning.find_matching_effective_state(
+            candidate_effective_states, observation, self.core_variables, self.task,
+            previous_effective_state=previous_effective_state,
+            observation_delta=format_delta(observation_delta) if previous_effective_state is not None else None,
+        )
+        # The node is added before it is cached, so that other sessions never see a cached state missing from the graph
         if is_new:
             self.world_model.add_nodes_and_edges([{'node_id': effective_state, 'node_type': 'state'}], [])
+        self.world_model.store_effective_state_cache(observation, effective_state, fingerprint)
+        session.effective_state = effective_state
 
         return effective_state
 
-    def is_action_safe(self, observation, action):
+    def is_action_safe(self, observation, action, deadline=None, observation_delta=None, session=None):
         """
         Determine if the given action is safe based on the core variables.
         First, attempt to retrieve the result from the cache. If not found,
         perform reasoning, store the result in the cache, and return it.
 
+        If a deadline is set, the check must finish within it, otherwise the verdict
+        is decided by the fallback policy:
+            - 'block': the action is not safe
+            - 'allow_if_always_safe': the action is safe only if it is known to be always safe
+            - 'allow_with_audit': the action is safe, and is recorded in the audit log
+        Stages which ran out of time keep running in the background so that their results are still learnt.
+
         Args:
+            observation (str): The current observation.
             action (dict): The action that the agent is about to take
                 It will have all the keys mentioned in the example below:
                 {
                     "function_name": "hover",
                     "arguments": ["id"],
                 }
+            deadline (float): Time budget in seconds for this call. Defaults to the module's deadline.
+            observation_delta (dict): The delta of the observation against the previous one,
+                as reported by the environment in info['observation_delta'].
+            session (SafetySession): The session of the episode. Defaults to the module's default session.
+
+        Returns:
+            bool: True if the action is safe, False otherwise.
         """
-        action['description'] = self.action_space[action['function_name']]['description']
-        # Check if action has already been analyzed for always safe given the task and initial_state
+        session = session or self.default_session
+        budget = deadline if deadline is not None else self.deadline
+        deadline_at = time.monotonic() + budget if budget is not None else None
+        with self._metrics_lock:
+            self.deadline_metrics['calls'] += 1
+        with profiler.step():
+            try:
+                is_safe, settled_by = self._check_action(observation, action, deadline_at, session, observation_delta)
+            except DeadlineExceeded as e:
+                is_safe, settled_by = self._deadline_fallback(observation, action, e.stage, session), 'deadline'
+        self.planner.record_outcome(self.task, action['function_name'], settled_by)
+        # The guardrail is idle until the next check, so look ahead of the state the session is in now
+        self.frontier.notify(session.effective_state)
+        return is_safe
 
-        # MEGA NOTE: if no time, focus on out of bounds goto example
-        usual_param_range = None
+    def are_actions_safe(self, observation, actions, observation_delta=None, session=None):
+        """
+        Determine if each of several candidate actions is safe given the same observation,
+        e.g. the actions proposed by a planner for the next step.
+        The checks are the same as in is_action_safe, but the effective state is computed once,
+        always safe and param range reasoning is shared between actions with the same function name,
+        and the remaining LM checks are batched into one call per stage.
+        Since none of the actions has been taken yet, the world model does not learn next states.
+
+        Args:
+            observation (str): The current observation.
+            actions (List[dict]): The candidate actions, each of the same form as in is_action_safe.
+            observation_delta (dict): The delta of the observation against the previous one, as in is_action_safe.
+            session (SafetySession): The session of the episode, as in is_action_safe.
+
+        Returns:
+            List[dict]: For each action, a dictionary with the keys
+                'is_safe' (bool): True if the action is safe, False otherwise.
+                'reason' (str): The reason for the verdict.
+        """
+        session = session or self.default_session
+        # Identical actions are only checked once
+        unique_actions = {}
+        for action in actions:
+            action['description'] = self.action_space[action['function_name']]['description']
+            unique_actions.setdefault(action_key(action), action)
+        keys = list(unique_actions)
+        verdicts = {}
+
+        if self.prescreen is not None:
+            for key in keys:
+                verdict, reason = self.prescreen.screen(unique_actions[key], observation)
+                if verdict != AMBIGUOUS:
+                    verdicts[key] = {'is_safe': verdict == SAFE, 'reason': reason}
+
+        # Unsafe verdicts which hold in any state
+        pending = [key for key in keys if key not in verdicts]
+        self._resolve_from_cache(None, pending, verdicts)
+
+        # Always safe, once per function name
+        pending = [key for key in keys if key not in verdicts]
+        for action_name in {key[0] for key in pending}:
+            if action_name not in self.world_model.analyzed_actions:
+                self._infer_always_safe(action_name)
+        for key in pending:
+            if key[0] in self.world_model.always_safe_actions:
+                verdicts[key] = {'is_safe': True, 'reason': 'Action is always safe.'}
+        pending = [key for key in keys if key not in verdicts]
+
+        fingerprint = observation_delta['fingerprint'] if observation_delta else None
+        effective_state = self.world_model.query_effective_state_cache(observation, fingerprint)
+        if effective_state is not None:
+            pending = self._resolve_from_cache(effective_state, pending, verdicts)
+
+        # Param range, inferred once per function name and checked in one batch
+        range_checks = []
+        for key in pending:
+            if unique_actions[key]['arguments']:
+                usual_param_range = self._get_usual_param_range(key[0])
+                if usual_param_range is not None:
+                    range_checks.append((key, usual_param_range))
+        if range_checks:
+            within_range = self.action_safety.are_params_within_usual_range(
+                [unique_actions[key] for key, _ in range_checks], self.task, self.initial_state,
+                [usual_param_range for _, usual_param_range in range_checks]
+            )
+            for (key, usual_param_range), is_within_range in zip(range_checks, within_range):
+                if is_within_range is None:
+                    # No verdict for this action in the batched response
+                    is_within_range = self.action_safety.is_param_within_usual_range(
+                        unique_actions[key], self.task, self.initial_state, usual_param_range
+                    )
+                if not is_within_range:
+                    reason = 'Action parameters are outside the usual range.'
+                    self.world_model.store_unsafe_verdict(None, key, reason, 'range_check')
+                    verdicts[key] = {'is_safe': False, 'reason': reason}
+            pending = [key for key in pending if key not in verdicts]
+
+        if pending and effective_state is None:
+            effective_state = self.get_effective_state(observation, observation_delta, session)
+            pending = self._resolve_from_cache(effective_state, pending, verdicts)
+
+        if pending:
+            _, edges = self.world_model.get_outgoing_neighbors_and_edges(effective_state)
+            for edge in edges:
+                if edge['obj'] not in self.core_variables or not pending:
+                    continue
+                core_variable = edge['obj']
+                expected_variation = self.world_model.get_variability(core_variable)
+                bounds = self.world_model.get_bounds(core_variable)
+                # Actions whose variation is read from the observation are checked with arithmetic, the rest by the LM
+                tracked = {key: self.core_variable_tracker.check(core_variable, bounds, observation, unique_actions[key]) for key in pending}
+                untracked = [key for key in pending if tracked[key] is None]
+                actual_variations = {key: tracked[key][1] for key in pending if tracked[key] is not None}
+                beyond_bounds = {key: tracked[key][0] for key in pending if tracked[key] is not None}
+                if untracked:
+                    candidates = [unique_actions[key] for key in untracked]
+                    variations = self.reasoning.get_actual_variations(effective_state, observation, candidates, core_variable)
+                    for i, action in enumerate(candidates):
+                        if variations[i] is None:
+                            variations[i] = self.reasoning.get_actual_variation(effective_state, observation, action, core_variable)
+                    lm_beyond_bounds = self.reasoning.are_core_variations_beyond_bounds(variations, expected_variation, core_variable, bounds)
+                    for i, key in enumerate(untracked):
+                        if lm_beyond_bounds[i] is None:
+                            lm_beyond_bounds[i] = self.reasoning.is_core_variation_beyond_bounds(variations[i], expected_variation, core_variable, bounds)
+                        actual_variations[key], beyond_bounds[key] = variations[i], lm_beyond_bounds[i]
+                for key in pending:
+                    if beyond_bounds[key]:
+                        reason = f"Variation of core variable {core_variable} is beyond bounds: {actual_variations[key]}"
+                        self.world_model.store_unsafe_verdict(effective_state, key, reason, 'bounds', core_variable)
+                        verdicts[key] = {'is_safe': False, 'reason': reason}
+                pending = [key for key in pending if key not in verdicts]
+
+            for key in pending:
+                self.world_model.store_cache(effective_state, key, True)
+                verdicts[key] = {'is_safe': True, 'reason': 'No core variable is affected beyond bounds.'}
+
+        for key in keys:
+            if not verdicts[key]['is_safe']:
+                self.audit_log.record('blocked', session.episode, unique_actions[key], reason=verdicts[key]['reason'], batch=True)
+        # One of the safe candidates is likely taken next, so its next state is worth precomputing
+        if effective_state is not None:
+            self.frontier.notify(effective_state, [unique_actions[key] for key in keys if verdicts[key]['is_safe']])
+        return [dict(verdicts[action_key(action)]) for action in actions]
+
+    def _resolve_from_cache(self, effective_state, keys, verdicts):
+        """
+        Fill in the verdicts of actions with a cached result for the effective state,
+        or with an unsafe verdict which holds in any state if the effective state is None.
+
+        Returns:
+            List: The keys of the actions which are still unresolved.
+        """
+        pending = []
+        for key in keys:
+            unsafe_verdict = self.world_model.query_unsafe_verdict(effective_state, key)
+            cached_result = self.world_model.query_cache(effective_state, key) if effective_state is not None else None
+            if unsafe_verdict is not None:
+                verdicts[key] = {'is_safe': False, 'reason': unsafe_verdict['reason']}
+            elif cached_result is not None:
+                verdicts[key] = {'is_safe': cached_result, 'reason': 'Retrieved result from world model cache.'}
+            else:
+                pending.append(key)
+        return pending
+
+    def _is_cached_unsafe(self, state, action, key, session):
+        """
+        Check for a cached unsafe verdict of the action, recording the blocked attempt in the audit log.
+        """
+        verdict = self.world_model.query_unsafe_verdict(state, key)
+        if verdict is None:
+            return False
+        print(f"Retrieved unsafe verdict from world model cache: {verdict['reason']}")
+        self.audit_log.record(
+            'blocked', session.episode, action, reason=verdict['reason'], stage=verdict['stage'],
+            core_variable=verdict['core_variable'], cached=True
+        )
+        return True
+
+    def _block(self, state, action, key, session, reason, stage, core_variable=None):
+        """
+        Cache an unsafe verdict of the action and record it in the audit log.
+
+        Returns:
+            bool: False, the verdict.
+        """
+        print(reason)
+        self.world_model.store_unsafe_verdict(state, key, reason, stage, core_variable)
+        self.audit_log.record('blocked', session.episode, action, reason=reason, stage=stage, core_variable=core_variable, cached=False)
+        return False
+
+    def _check_action(self, observation, action, deadline_at, session, observation_delta=None):
+        """
+        Run the safety check stages in order of cost: lookups which need no LM call first,
+        then the LM stages from the ones shared across states (always safe, param range)
+        to the ones specific to the current state (effective state, core variables).
+        The param range and effective state stages are ordered by the planner for each action type.
+        Graph learning about the next state does not affect the verdict, so it is
+        deferred to the background when there is a deadline.
+
+        Returns:
+            Tuple[bool, str]: True if the action is safe, and the stage which settled the verdict.
+        """
+        action['description'] = self.action_space[action['function_name']]['description']
         action_name = action['function_name']
-        if action_name in self.world_model.analyzed_actions:
+        key = action_key(action)
+
+        # Lookups which need no LM call
+        with profiler.stage('lookup'):
             if action_name in self.world_model.always_safe_actions:
-                return True
-            if action['arguments']:
-                usual_param_range = self.world_model.get_param_range(action_name)
-        else:
-            always_safe = self.action_safety.infer_always_safe(self.action_space[action_name], self.task, self.initial_state, self.core_variables)
-            self.world_model.analyzed_actions.add(action_name)
-            if always_safe:
-                self.world_model.add_always_safe_action(action_name)
-                return True
-            if action['arguments']:
-                usual_param_range = self.action_safety.infer_usual_param_range(self.action_space[action_name], self.task, self.initial_state)
-                self.world_model.store_param_range(action_name, usual_param_range)
-
-        # Check if the action is within the usual range of input params
-        # for example, if the action is to goto(url), and the task is to buy a product, 
-        # the url should be within the shopping site.
-        if usual_param_range is not None:
-            if not self.action_safety.is_param_within_usual_range(action, self.task, self.initial_state, usual_param_range):
-                print("Action parameters are outside the usual range.")
-                return False
+                return True, 'lookup'
+            if self._is_cached_unsafe(None, action, key, session):
+                return False, 'lookup'
+            fingerprint = observation_delta['fingerprint'] if observation_delta else None
+            effective_state = self.world_model.query_effective_state_cache(observation, fingerprint)
+            if effective_state is not None:
+                if self._is_cached_unsafe(effective_state, action, key, session):
+                    return False, 'lookup'
+                cached_result = self.world_model.query_cache(effective_state, key)
+                if cached_result is not None:
+                    print("Retrieved result from world model cache.")
+                    return cached_result, 'lookup'
 
-        # Get the effective state based on the observation
-        effective_state = self.get_effective_state(observation)
+        if self.prescreen is not None:
+            with profiler.stage('prescreen'):
+                verdict, reason = self.prescreen.screen(action, observation)
+            if verdict != AMBIGUOUS:
+                print(f"Pre-screen: {reason}")
+                if verdict != SAFE:
+                    # The pre-screen is cheap and deterministic, so its verdicts are not cached
+                    self.audit_log.record('blocked', session.episode, action, reason=reason, stage='prescreen', cached=False)
+                return verdict == SAFE, 'prescreen'
 
-        # Query the world model for cached result
-        cached_result = self.world_model.query_cache(effective_state, action)
+        # Check if action has already been analyzed for always safe given the task and initial_state
+        if action_name not in self.world_model.analyzed_actions:
+            if self._run_stage('always_safe', deadline_at, self._infer_always_safe, action_name):
+                return True, 'always_safe'
+
+        # Actions without arguments have no param range to check
+        linked = self.world_model.is_linked_to_core_variables(action_name)
+        order = self.planner.plan(self.task, action_name, linked) if action['arguments'] else ('state',)
+        cached_result = None
+        for position, stage in enumerate(order):
+            if stage == 'range':
+                if not self._check_param_range(action, key, deadline_at, session):
+                    return False, 'range_check'
+                continue
+            if effective_state is not None:
+                continue
+
+            # Get the effective state based on the observation
+            effective_state = self._run_stage('effective_state', deadline_at, self.get_effective_state, observation, observation_delta, session)
+
+            # Query the world model for cached result
+            with profiler.stage('lookup'):
+                if self._is_cached_unsafe(effective_state, action, key, session):
+                    cached_result = False
+                else:
+                    cached_result = self.world_model.query_cache(effective_state, key)
+            self.planner.record_run(self.task, action_name, 'state', cached_result is not None)
+            if cached_result is not None:
+                if cached_result:
+                    print("Retrieved result from world model cache.")
+                # A cached verdict makes the remaining range check unnecessary, unless it detects unsafe actions
+                # linked to core variables
+                range_pending = 'range' in order[position + 1:]
+                if not (cached_result and range_pending) or self.planner.may_skip(
+                    'range_check', linked or self.world_model.is_linked_to_core_variables(state=effective_state)
+                ):
+                    return cached_result, 'cache'
         if cached_result is not None:
-            print("Retrieved result from world model cache.")
-            return cached_result
+            return cached_result, 'cache'
 
         # Perform reasoning if not found in cache
         print("Performing reasoning as result not found in cache.")
-        
+
         # Get neighbors and edges from the current effective state
         neighbors_dict, edges = self.world_model.get_outgoing_neighbors_and_edges(effective_state)
 
@@ -117,32 +625,172 @@ class SafetyModule:
         for edge in edges:
             if edge['obj'] in self.core_variables:
                 core_variable = edge['obj']
-                # Fine-grained reasoning of the magnitude of change
-                actual_variation = self.reasoning.get_actual_variation(effective_state, observation, action, core_variable)
                 expected_variation = self.world_model.get_variability(core_variable)
-                if self.reasoning.is_core_variation_beyond_bounds(actual_variation, expected_variation, core_variable):
-                    print(f"Action is not safe for core variable: {core_variable}")
-                    return False
+                bounds = self.world_model.get_bounds(core_variable)
+                # Values read from the observation settle most checks with arithmetic, e.g. the order total against the budget
+                with profiler.stage('tracking'):
+                    tracked = self.core_variable_tracker.check(core_variable, bounds, observation, action)
+                if tracked is not None:
+                    beyond_bounds, actual_variation = tracked
+                else:
+                    # Fine-grained reasoning of the magnitude of change
+                    actual_variation = self._run_stage(
+                        'variation', deadline_at, self.reasoning.get_actual_variation,
+                        effective_state, observation, action, core_variable
+                    )
+                    beyond_bounds = self._run_stage(
+                        'bounds', deadline_at, self.reasoning.is_core_variation_beyond_bounds,
+                        actual_variation, expected_variation, core_variable, bounds
+                    )
+                if beyond_bounds:
+                    return self._block(
+                        effective_state, action, key, session, f"Variation of core variable {core_variable} is beyond bounds: {actual_variation}",
+                        'bounds', core_variable
+                    ), 'bounds'
             else:
                 state_edges.append(edge)
 
-        # Use reasoning module to determine next effective state
-        next_effective_state, is_new = self.reasoning.get_next_effective_state(
-            effective_state, action, neighbors_dict, state_edges, self.task, self.core_variables
-        )
-        self.effective_state = next_effective_state
+        # Store the result in the world model
+        self.world_model.store_cache(effective_state, key, True)
 
-        if is_new:
-            new_nodes = [{'node_id': next_effective_state, 'node_type': 'state'}]
+        if deadline_at is None:
+            with profiler.stage('learn_next_state'):
+                self._learn_next_state(effective_state, action, neighbors_dict, state_edges, session)
+        else:
+            self._track_background(self._executor.submit(
+                self._learn_next_state_in_background, effective_state, action, neighbors_dict, state_edges, session
+            ))
+        return True, 'passed'
+
+    def _check_param_range(self, action, key, deadline_at, session):
+        """
+        Check if the action is within the usual range of input params, blocking it otherwise.
+        For example, if the action is to goto(url), and the task is to buy a product,
+        the url should be within the shopping site.
+
+        Returns:
+            bool: True if the action is within the usual range, False if it is blocked.
+        """
+        # MEGA NOTE: if no time, focus on out of bounds goto example
+        action_name = action['function_name']
+        usual_param_range = self._run_stage('param_range', deadline_at, self._get_usual_param_range, action_name)
+        within_range = True
+        if usual_param_range is not None:
+            within_range = self._run_stage(
+                'range_check', deadline_at, self.action_safety.is_param_within_usual_range,
+                action, self.task, self.initial_state, usual_param_range
+            )
+        self.planner.record_run(self.task, action_name, 'range', not within_range)
+        if not within_range:
+            return self._block(None, action, key, session, "Action parameters are outside the usual range.", 'range_check')
+        return True
+
+    def _run_stage(self, stage, deadline_at, fn, *args, **kwargs):
+        """
+        Run a stage of the safety check, raising DeadlineExceeded if it does not finish before the deadline.
+        A stage which runs out of time is not cancelled, so its result is still stored when it finishes.
+        """
+        start = time.perf_counter()
+        with profiler.stage(stage):
+            if deadline_at is None:
+                result = fn(*args, **kwargs)
+            else:
+                remaining = deadline_at - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded(stage)
+                future = self._executor.submit(fn, *args, **kwargs)
+                try:
+                    result = future.result(timeout=remaining)
+                except FutureTimeoutError:
+                    self._track_background(future)
+                    raise DeadlineExceeded(stage)
+        self.planner.record_cost(stage, time.perf_counter() - start)
+        return result
+
+    def _deadline_fallback(self, observation, action, stage, session):
+        """
+        Decide the verdict of an action whose safety check ran out of time, according to the fallback policy.
+        """
+        with self._metrics_lock:
+            self.deadline_metrics['deadline_exceeded'] += 1
+            self.deadline_metrics['deadline_exceeded_by_stage'][stage] += 1
+
+        if self.fallback_policy == 'allow_if_always_safe':
+            is_safe = action['function_name'] in self.world_model.always_safe_actions
+        elif self.fallback_policy == 'allow_with_audit':
+            is_safe = True
+            self.audit_log.record('fallback_allowed', session.episode, action, observation=observation, stage=stage, task=self.task)
+        else:
+            is_safe = False
+        if not is_safe:
+            # Not cached, since the check did not reach a verdict
+            self.audit_log.record('blocked', session.episode, action, reason="Deadline exceeded.", stage=stage, cached=False)
+
+        with self._metrics_lock:
+            self.deadline_metrics['fallback_allowed' if is_safe else 'fallback_blocked'] += 1
+        print(f"Deadline exceeded during {stage} stage. Fallback policy '{self.fallback_policy}' returned {is_safe}.")
+        return is_safe
+
+    def _infer_always_safe(self, action_name):
+        """
+        Reason if the action is always safe given the task and initial state, and store the result.
+        """
+        always_safe = self.action_safety.infer_always_safe(self.action_space[action_name], self.task, self.initial_state, self.core_variables)
+        self.world_model.analyzed_actions.add(action_name)
+        if always_safe:
+            self.world_model.add_always_safe_action(action_name)
+        return always_safe
+
+    def _get_usual_param_range(self, action_name):
+        """
+        Retrieve the usual parameter range of the action, reasoning about it if it is not known yet.
+        """
+        if action_name in self.world_model.param_ranges:
+            return self.world_model.get_param_range(action_name)
+        usual_param_range = self.action_safety.infer_usual_param_range(self.action_space[action_name], self.task, self.initial_state)
+        self.world_model.store_param_range(action_name, usual_param_range)
+        return usual_param_range
+
+    def _learn_next_state_in_background(self, *args):
+        """
+        Learn about the next state when no caller is waiting for it, so its LM calls yield to blocking checks.
+        """
+        with lm_priority('background'):
+            self._learn_next_state(*args)
+
+    def _learn_next_state(self, effective_state, action, neighbors_dict, state_edges, session):
+        """
+        Reason about the next effective state after the action and add it to the world model,
+        along with how it could affect the core variables if it is new.
+        """
+        self.frontier.record_taken(effective_state, action)
+        # Use the next state precomputed while idle if it still holds, otherwise the reasoning module
+        precomputed = self.frontier.take(effective_state, action, neighbors_dict)
+        if precomputed is not None:
+            next_effective_state, is_new, potential_relations = precomputed
+        else:
+            next_effective_state, is_new = self.reasoning.get_next_effective_state(
+                effective_state, action, neighbors_dict, state_edges, self.task, self.core_variables
+            )
+            potential_relations = None
+
+        if not is_new:
+            # The transition may have been reused from another task's world model
+            self.world_model.confirm_edge(effective_state, next_effective_state)
+            self.world_model.record_transition(effective_state, next_effective_state)
+            session.effective_state = next_effective_state
+        else:
+            new_nodes = [{'node_id': next_effective_state, 'node_type': 'state', 'core_relations_analyzed': True}]
             new_edges = [{
                 'subject': effective_state,
                 'relation': 'transition',
                 'obj': next_effective_state,
-                'action': action_name
+                'action': action['function_name']
             }]
 
             # Determine potential relations between the new effective state and core variables
-            potential_relations = self.reasoning.can_state_affect_core_variables(next_effective_state, self.core_variables, self.task)
+            if potential_relations is None:
+                potential_relations = self.reasoning.can_state_affect_core_variables(next_effective_state, self.core_variables, self.task)
             for potential_relation in potential_relations:
                 new_edges.append({
                     'subject': next_effective_state,
@@ -151,11 +799,59 @@ class SafetyModule:
                 })
 
             # Add new nodes and edges to the world model
+            # The next state only becomes current once it is in the graph, since checks may run concurrently
             self.world_model.add_nodes_and_edges(new_nodes, new_edges)
+            self.world_model.record_transition(effective_state, next_effective_state)
+            session.effective_state = next_effective_state
 
         # Future: use this as warning if path length is short (so it is close to affecting core variables)
         # paths = self.world_model.find_paths_to_core_variables(effective_state, action, self.core_variables)
-        
-        # Store the result in the world model
-        self.world_model.store_cache(effective_state, action, True)
-        return True
+
+    def get_deadline_metrics(self):
+        """
+        Get metrics on how often the deadline triggers.
+
+        Returns:
+            dict: Counts of calls, deadline triggers overall and per stage, and fallback outcomes,
+                along with the rate at which the deadline triggers.
+        """
+        with self._metrics_lock:
+            metrics = dict(self.deadline_metrics)
+        metrics['deadline_exceeded_by_stage'] = dict(metrics['deadline_exceeded_by_stage'])
+        metrics['deadline_exceeded_rate'] = metrics['deadline_exceeded'] / metrics['calls'] if metrics['calls'] else 0.0
+        return metrics
+
+    def _track_background(self, future):
+        """
+        Keep track of background work until it finishes, so that wait_for_background can wait for it.
+        """
+        self._background_tasks.add(future)
+        future.add_done_callback(self._discard_background)
+
+    def _discard_background(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self._background_tasks.discard(future)
+
+    def wait_for_background(self):
+        """
+        Block until stages which ran past the deadline and deferred graph learning have finished.
+        """
+        while True:
+            try:
+                future = self._background_tasks.pop()
+            except KeyError:
+                # Finished work discards itself meanwhile
+                return
+            future.result()
+
+    def shutdown(self):
+        """
+        Finish background work and release the worker threads.
+        """
+        self.frontier.stop()
+        self.graph_maintainer.stop()
+        self.wait_for_background()
+        self._executor.shutdown(wait=True)
+        if isinstance(self.world_model, OverlayWorldModel):
+            self.world_model.stop()
+            self.world_model.merge()
@@ -0,0 +1,82 @@
+"""
+Serves safety checks of many concurrent episodes against one SafetyModule,
+so that all of them share and add to the same learned world model.
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SafetyServer:
+    def __init__(self, safety_module, max_workers=32):
+        """
+        Args:
+            safety_module (SafetyModule): The module whose world model is shared by all sessions.
+                Its core variability should already be analyzed.
+            max_workers (int): Number of checks which run at the same time.
+        """
+        self.safety_module = safety_module
+        self.sessions = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='safety_server')
+
+    def open_session(self, episode=None):
+        """
+        Open a session for a new episode.
+
+        Args:
+            episode: Identifier of the episode. Defaults to the number of the episode.
+
+        Returns:
+            The identifier of the episode, to pass to the checks of the session.
+        """
+        session = self.safety_module.new_session(episode)
+        with self._lock:
+            if session.episode in self.sessions:
+                raise ValueError(f"Session already open for episode {session.episode}")
+            self.sessions[session.episode] = session
+        return session.episode
+
+    def close_session(self, episode):
+        """
+        Close the session of an episode. Its knowledge stays in the shared world model.
+        """
+        with self._lock:
+            del self.sessions[episode]
+
+    def submit(self, episode, observation, action, observation_delta=None, deadline=None):
+        """
+        Submit a check of an action in the session of an episode.
+        Checks of the same session should be submitted one at a time, like the steps of the episode.
+
+        Returns:
+            Future[bool]: True if the action is safe, False otherwise.
+        """
+        session = self.sessions[episode]
+        return self._executor.submit(session.is_action_safe, observation, action, deadline, observation_delta)
+
+    def submit_batch(self, episode, observation, actions, observation_delta=None):
+        """
+        Submit a check of several candidate actions in the session of an episode.
+
+        Returns:
+            Future[List[dict]]: The verdicts, as returned by SafetyModule.are_actions_safe.
+        """
+        session = self.sessions[episode]
+        return self._executor.submit(session.are_actions_safe, observation, actions, observation_delta)
+
+    async def check(self, episode, observation, action, observation_delta=None, deadline=None):
+        """
+        Check an action in the session of an episode, for asyncio callers.
+
+        Returns:
+            bool: True if the action is safe, False otherwise.
+        """
+        return await asyncio.wrap_future(self.submit(episode, observation, action, observation_delta, deadline))
+
+    def shutdown(self):
+        """
+        Finish the submitted checks and the background work of the safety module.
+        """
+        self._executor.shutdown(wait=True)
+        self.safety_module.shutdown()
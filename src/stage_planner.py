@@ -0,0 +1,128 @@
+"""
+Adaptive ordering of the stages of a safety check, learned from how often each stage settles the verdict
+and how long it takes.
+
+Two stages of is_action_safe do not depend on each other and can run in either order:
+    - 'range': the usual parameter range of the action, and whether its arguments are within it
+    - 'state': the effective state of the observation, and the cached verdict of the action in it
+The range stage can block the action before the effective state is reasoned about, while the state stage
+can find a cached verdict which makes the range check unnecessary. Which one should run first depends on
+the action type and the task: navigation on a known site mostly hits the cache, while a task targeted by
+off-site links mostly fails the range check.
+
+Invariant: stages which detect unsafe actions are never skipped for actions or states linked to core variables,
+and the planner only changes the order for actions which are not linked to core variables.
+"""
+import threading
+from collections import Counter, defaultdict
+
+DEFAULT_ORDER = ('range', 'state')
+# Stages whose failure blocks an action, so skipping them could let an unsafe action through
+UNSAFE_DETECTION_STAGES = ('range_check', 'variation', 'bounds')
+
+
+class StagePlanner:
+    def __init__(self, min_samples=5, cost_smoothing=0.2, enabled=True):
+        """
+        Args:
+            min_samples (int): Number of runs of both stages for an action type before its order is changed.
+            cost_smoothing (float): Weight of the latest run in the moving average of the cost of a stage.
+            enabled (bool): If False, the default order is always used, but statistics are still collected.
+        """
+        self.min_samples = min_samples
+        self.cost_smoothing = cost_smoothing
+        self.enabled = enabled
+        # Moving average of the time taken by each stage, in seconds
+        self.stage_costs = {}
+        # (task, function_name) -> counts of runs of each stage and of the verdicts it settled
+        self.stats = defaultdict(Counter)
+        # (task, function_name) -> how many checks were settled by each stage
+        self.outcomes = defaultdict(Counter)
+        self._lock = threading.Lock()
+
+    def record_cost(self, stage, elapsed):
+        """
+        Record the time taken by a run of a stage.
+        """
+        with self._lock:
+            previous = self.stage_costs.get(stage)
+            self.stage_costs[stage] = elapsed if previous is None else previous + self.cost_smoothing * (elapsed - previous)
+
+    def record_run(self, task, function_name, stage, settled):
+        """
+        Record a run of a reorderable stage for an action type, and whether it settled the verdict:
+        the range check blocked the action, or the verdict was found in the cache.
+        """
+        with self._lock:
+            stats = self.stats[(task, function_name)]
+            stats[f'{stage}_runs'] += 1
+            stats[f'{stage}_settled'] += int(settled)
+
+    def record_outcome(self, task, function_name, settled_by):
+        """
+        Record which stage settled a check, e.g. 'lookup', 'range_check', 'cache', 'bounds', or 'passed' if all stages ran.
+        """
+        with self._lock:
+            self.outcomes[(task, function_name)][settled_by] += 1
+
+    def _cost(self, *stages):
+        return sum(self.stage_costs.get(stage, 0.0) for stage in stages)
+
+    def plan(self, task, function_name, linked):
+        """
+        Choose the order of the range and state stages for a check.
+
+        Args:
+            task (str): The task.
+            function_name (str): The function name of the action.
+            linked (bool): True if the action is linked to core variables, in which case the default order is kept.
+
+        Returns:
+            Tuple[str]: The stages in the order to run them.
+        """
+        if not self.enabled or linked:
+            return DEFAULT_ORDER
+        with self._lock:
+            stats = self.stats.get((task, function_name))
+            if stats is None or min(stats['range_runs'], stats['state_runs']) < self.min_samples:
+                return DEFAULT_ORDER
+            block_rate = stats['range_settled'] / stats['range_runs']
+            hit_rate = stats['state_settled'] / stats['state_runs']
+            range_cost = self._cost('param_range', 'range_check')
+            state_cost = self._cost('effective_state')
+        # Expected cost of reaching the verdict up to the end of both stages, in either order
+        range_first = range_cost + (1 - block_rate) * state_cost
+        state_first = state_cost + (1 - hit_rate) * range_cost
+        return ('state', 'range') if state_first < range_first else DEFAULT_ORDER
+
+    @staticmethod
+    def may_skip(stage, linked):
+        """
+        Check if a stage may be skipped because an earlier stage already settled the verdict.
+
+        Args:
+            stage (str): The stage to skip.
+            linked (bool): True if the action or the effective state is linked to core variables.
+
+        Returns:
+            bool: False for stages which detect unsafe actions if the action is linked to core variables.
+        """
+        return not (linked and stage in UNSAFE_DETECTION_STAGES)
+
+    def summary(self):
+        """
+        Get the statistics of the planner.
+
+        Returns:
+            dict: The moving average cost of each stage, and per action type the counts of runs and
+                settled verdicts of the reorderable stages, which stages settled checks, and the current order.
+        """
+        with self._lock:
+            action_types = {
+                f"{task}: {function_name}": {'stats': dict(stats), 'outcomes': dict(self.outcomes[(task, function_name)])}
+                for (task, function_name), stats in self.stats.items()
+            }
+            summary = {'stage_costs': dict(self.stage_costs), 'action_types': action_types}
+        for (task, function_name) in list(self.stats):
+            summary['action_types'][f"{task}: {function_name}"]['order'] = self.plan(task, function_name, linked=False)
+        return summary
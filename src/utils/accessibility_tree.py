@@ -0,0 +1,70 @@
+"""
+Parsing of accessibility tree observations, as seen by WebArena agents, e.g.
+
+    [1] RootWebArea 'One Stop Market' focused: True
+    	[12] combobox ' Search' autocomplete: both hasPopup: listbox
+    	[40] button 'Add to Cart'
+
+Each element has a numeric id, a role and a label, and is nested by indentation in its ancestors,
+which give its context (e.g. the form a field belongs to, or the footer a link is in).
+"""
+import re
+from functools import lru_cache
+
+element_regex = re.compile(r"^(\t*)\[(\d+)\]\s+(\w+)\s+(['\"])(.*?)\4(.*)$")
+
+
+@lru_cache(maxsize=32)
+def parse_accessibility_tree(observation):
+    """
+    Parse the elements of an accessibility tree observation.
+    The last few observations are kept, since several local checks of a step parse the same one.
+
+    Args:
+        observation (str): The observation.
+
+    Returns:
+        Dict[str, dict]: Elements by id, each with the keys 'id', 'role', 'label' (stripped), 'properties'
+            (the rest of the line) and 'ancestors' (the ids of the enclosing elements, outermost first).
+    """
+    elements = {}
+    stack = []  # (depth, id) of the enclosing elements
+    for line in observation.splitlines():
+        match = element_regex.match(line)
+        if match is None:
+            continue
+        indent, element_id, role, _, label, properties = match.groups()
+        depth = len(indent)
+        while stack and stack[-1][0] >= depth:
+            stack.pop()
+        elements[element_id] = {
+            'id': element_id,
+            'role': role,
+            'label': label.strip(),
+            'properties': properties.strip(),
+            'ancestors': [ancestor_id for _, ancestor_id in stack],
+        }
+        stack.append((depth, element_id))
+    return elements
+
+
+def find_element(observation, element_id):
+    """
+    Find an element of an accessibility tree observation by id.
+
+    Args:
+        observation (str): The observation.
+        element_id: The id of the element, e.g. '12'.
+
+    Returns:
+        dict: The element, as parsed by `parse_accessibility_tree`, or None if it is not in the observation.
+    """
+    return parse_accessibility_tree(observation).get(str(element_id).strip('[]'))
+
+
+def element_ancestors(observation, element):
+    """
+    Get the enclosing elements of an element, outermost first.
+    """
+    elements = parse_accessibility_tree(observation)
+    return [elements[ancestor_id] for ancestor_id in element['ancestors']]
@@ -0,0 +1,81 @@
+"""
+Audit trail of safety verdicts which need a second look, e.g. blocked actions and actions allowed without a complete check.
+"""
+import time
+
+from .helpers import action_key
+
+
+class AuditLog:
+    """
+    Append-only log of audit records, queryable by episode.
+
+    Args:
+        observation_store (ObservationStore): Store of the observations of records, which then only hold their
+            fingerprint. None to keep the observations in the records.
+    """
+    def __init__(self, observation_store=None):
+        self.records = []
+        self.observation_store = observation_store
+
+    def record(self, event, episode, action, **details):
+        """
+        Append a record to the log.
+
+        Args:
+            event (str): What happened, e.g. 'blocked' or 'fallback_allowed'.
+            episode: Identifier of the episode the record belongs to.
+            action (dict): The action the record is about.
+            details: Other fields of the record, e.g. the reason and the stage of the safety check.
+                An observation is stored compressed, and replaced by its fingerprint, if there is an observation store.
+
+        Returns:
+            dict: The record.
+        """
+        if self.observation_store is not None and 'observation' in details:
+            details['observation_fingerprint'] = self.observation_store.put(details.pop('observation'))
+        entry = {'time': time.time(), 'event': event, 'episode': episode, 'action': action_key(action), **details}
+        self.records.append(entry)
+        return entry
+
+    def query(self, episode=None, event=None, function_name=None):
+        """
+        Get the records matching all the given filters.
+
+        Args:
+            episode: Only records of this episode.
+            event (str): Only records of this event.
+            function_name (str): Only records of actions with this function name.
+
+        Returns:
+            List[dict]: The matching records, oldest first.
+        """
+        return [
+            entry for entry in self.records
+            if (episode is None or entry['episode'] == episode)
+            and (event is None or entry['event'] == event)
+            and (function_name is None or entry['action'][0] == function_name)
+        ]
+
+    def observation(self, entry):
+        """
+        Get the observation of a record, decompressing it if it is stored.
+
+        Returns:
+            str: The observation, or None if the record has none.
+        """
+        if 'observation_fingerprint' in entry:
+            return self.observation_store.get(entry['observation_fingerprint'])
+        return entry.get('observation')
+
+    def episodes(self):
+        """
+        Get the episodes which have records, in order of their first record.
+        """
+        return list(dict.fromkeys(entry['episode'] for entry in self.records))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
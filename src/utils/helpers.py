@@ -1,3 +1,43 @@
 """
 utils for language models
-"""
\ No newline at end of file
+"""
+import hashlib
+
+
+def action_key(action):
+    """
+    Get a hashable key for an action, so it can be used to index caches.
+
+    Args:
+        action (dict): The action, with at least the 'function_name' and 'arguments' keys.
+
+    Returns:
+        Tuple[str, Tuple[str]]: The function name and its arguments.
+    """
+    return action['function_name'], tuple(action.get('arguments', []))
+
+
+def format_action(action):
+    """
+    Format an action and its description as a string for prompts.
+
+    Args:
+        action (dict): The action, with the 'function_name', 'arguments' and 'description' keys.
+
+    Returns:
+        str: The formatted action, e.g. "hover(id)\\nDescription: Hover over an element with id."
+    """
+    return f"{action['function_name']}({', '.join(action['arguments'])})\nDescription: {action['description']}"
+
+
+def observation_fingerprint(observation):
+    """
+    Get a short fingerprint of an observation, so caches keyed by observation do not hold the full text.
+
+    Args:
+        observation (str): The observation.
+
+    Returns:
+        str: Hex digest of the observation.
+    """
+    return hashlib.blake2b(observation.encode('utf-8'), digest_size=16).hexdigest()
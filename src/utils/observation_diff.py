@@ -0,0 +1,104 @@
+"""
+Incremental observation deltas, so that consecutive observations which mostly overlap
+(e.g. the same web page before and after a scroll) are not reprocessed in full at every step.
+"""
+from difflib import SequenceMatcher
+
+from .helpers import observation_fingerprint
+
+# If more than this share of the lines changed, the delta is not smaller than the observation itself
+max_delta_ratio = 0.5
+
+
+class ObservationDiffer:
+    """
+    Computes the delta of each observation against the previous one of the episode.
+    """
+    def __init__(self):
+        self.previous_lines = None
+        self.previous_fingerprint = None
+
+    def reset(self):
+        """
+        Forget the previous observation, e.g. at the start of an episode.
+        """
+        self.previous_lines = None
+        self.previous_fingerprint = None
+
+    def diff(self, observation):
+        """
+        Compute the delta of the observation against the previous one, and remember it for the next step.
+
+        Args:
+            observation (str): The current observation.
+
+        Returns:
+            dict: The observation delta, with the keys
+                'fingerprint' (str): Fingerprint of the current observation.
+                'previous_fingerprint' (str): Fingerprint of the previous observation, None at the start of an episode.
+                'added' (List[str]): Lines which are new in the current observation.
+                'removed' (List[str]): Lines of the previous observation which are gone.
+                'is_full' (bool): True if there is no previous observation or most of it changed,
+                    in which case the full observation should be used instead of the delta.
+        """
+        lines = observation.splitlines()
+        delta = {
+            'fingerprint': observation_fingerprint(observation),
+            'previous_fingerprint': self.previous_fingerprint,
+            'added': [],
+            'removed': [],
+            'is_full': self.previous_lines is None,
+        }
+        if self.previous_lines is None:
+            delta['added'] = lines
+        else:
+            matcher = SequenceMatcher(None, self.previous_lines, lines, autojunk=False)
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                if tag != 'equal':
+                    delta['removed'] += self.previous_lines[i1:i2]
+                    delta['added'] += lines[j1:j2]
+            changed = max(len(delta['added']), len(delta['removed']))
+            delta['is_full'] = changed > max_delta_ratio * max(len(lines), 1)
+
+        self.previous_lines = lines
+        self.previous_fingerprint = delta['fingerprint']
+        return delta
+
+
+def format_delta(delta):
+    """
+    Format an observation delta as a string for prompts, in the style of a diff.
+
+    Args:
+        delta (dict): The observation delta, as returned by `ObservationDiffer.diff`.
+
+    Returns:
+        str: Removed lines prefixed by '-' and added lines prefixed by '+', or "(no change)".
+    """
+    lines = [f"- {line}" for line in delta['removed']] + [f"+ {line}" for line in delta['added']]
+    return "\n".join(lines) if lines else "(no change)"
+
+
+def is_delta_relevant(delta, core_variable_keywords):
+    """
+    Check if an observation delta touches a region of the observation relevant to the core variables.
+
+    Args:
+        delta (dict): The observation delta, as returned by `ObservationDiffer.diff`.
+        core_variable_keywords (Dict[str, List[str]]): Lowercase keywords of the regions relevant
+            to each core variable. A core variable without keywords makes any change relevant.
+
+    Returns:
+        bool: True if the delta could affect the effective state.
+    """
+    if delta['is_full']:
+        return True
+    changed_lines = [line.lower() for line in delta['added'] + delta['removed']]
+    if not changed_lines:
+        return False
+    for keywords in core_variable_keywords.values():
+        if not keywords:
+            return True
+        if any(keyword in line for line in changed_lines for keyword in keywords):
+            return True
+    return False
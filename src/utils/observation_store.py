@@ -0,0 +1,280 @@
+"""
+Compressed storage of observations, which are the largest objects kept by the guardrail (audit records,
+trajectory logs, replay corpora).
+
+Observations of the same site are highly repetitive across pages (navigation, headers, footers, element
+roles), but too small to compress well one at a time. They are compressed with a dictionary trained on the
+environment's pages: with zstd if the optional `zstandard` package is installed, otherwise with zlib and a
+preset dictionary of the most common lines. Observations are stored under their fingerprint, so identical
+observations are stored once, and decompressed only when their text is needed, e.g. for a prompt.
+
+Until the dictionary is trained, the first observations are kept uncompressed as training samples.
+"""
+import json
+import os
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+
+from .helpers import observation_fingerprint
+
+ZSTD = 'zstd'
+ZLIB = 'zlib'
+# zlib only looks back this far, so a longer preset dictionary is wasted
+zlib_window = 32768
+
+
+def zstd_available():
+    try:
+        import zstandard  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def train_zlib_dictionary(samples, dict_size):
+    """
+    Build a preset dictionary for zlib from the most common lines of the samples.
+    zlib finds matches in the dictionary closer to its end with shorter codes, so the most common lines go last.
+    """
+    counts = Counter(line for sample in samples for line in set(sample.split(b'\n')))
+    lines, size = [], 0
+    for line, count in counts.most_common():
+        if count < 2 or size + len(line) + 1 > dict_size:
+            break
+        lines.append(line)
+        size += len(line) + 1
+    return b'\n'.join(reversed(lines)) + b'\n' if lines else b''
+
+
+def observations_path(log_path):
+    """
+    Get the path of the observation store of a log whose steps only hold observation fingerprints.
+    """
+    return f"{log_path}.observations"
+
+
+class ObservationStore:
+    """
+    Observations compressed with a shared dictionary, keyed by fingerprint.
+
+    Args:
+        codec (str): ZSTD or ZLIB. Defaults to zstd if it is installed.
+        level (int): Compression level.
+        dict_size (int): Size in bytes of the trained dictionary.
+        train_after (int): Number of distinct observations to collect before training the dictionary,
+            None to only train it explicitly with `train`.
+        cache_size (int): Number of decompressed observations kept, since consecutive reads often repeat.
+    """
+    def __init__(self, codec=None, level=3, dict_size=16384, train_after=64, cache_size=8):
+        self.codec = codec or (ZSTD if zstd_available() else ZLIB)
+        self.level = level
+        self.dict_size = min(dict_size, zlib_window) if self.codec == ZLIB else dict_size
+        self.train_after = train_after
+        self.cache_size = cache_size
+        self.dictionary = None
+        self.blobs = {}  # fingerprint -> compressed observation
+        self.pending = {}  # fingerprint -> observation, kept uncompressed until the dictionary is trained
+        self._decompressed = OrderedDict()
+        self._lock = threading.Lock()
+        # zstd (de)compressors are not thread-safe, so each thread has its own
+        self._local = threading.local()
+        self.stats = Counter()
+
+    def __len__(self):
+        return len(self.blobs) + len(self.pending)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.blobs or fingerprint in self.pending
+
+    def __iter__(self):
+        return iter(list(self.blobs) + list(self.pending))
+
+    def __getitem__(self, fingerprint):
+        observation = self.get(fingerprint)
+        if observation is None:
+            raise KeyError(fingerprint)
+        return observation
+
+    def put(self, observation, fingerprint=None):
+        """
+        Store an observation, unless it is already stored.
+
+        Args:
+            observation (str): The observation.
+            fingerprint (str): Its fingerprint, if already computed.
+
+        Returns:
+            str: The fingerprint of the observation, to get it back with.
+        """
+        fingerprint = fingerprint or observation_fingerprint(observation)
+        if fingerprint in self:
+            self.stats['duplicates'] += 1
+            return fingerprint
+        self.stats['observations'] += 1
+        self.stats['raw_bytes'] += len(observation.encode())
+        with self._lock:
+            is_pending = self.dictionary is None and self.train_after is not None
+            if is_pending:
+                self.pending[fingerprint] = observation
+                # Only the put which collects the last sample trains
+                ready = len(self.pending) == self.train_after
+        if is_pending:
+            if ready:
+                self.train(list(self.pending.values()))
+            return fingerprint
+        blob = self.compress(observation)
+        self.stats['stored_bytes'] += len(blob)
+        self.blobs[fingerprint] = blob
+        return fingerprint
+
+    def get(self, fingerprint):
+        """
+        Get the text of a stored observation, decompressing it.
+
+        Returns:
+            str: The observation, or None if it is not stored.
+        """
+        observation = self._decompressed.get(fingerprint) or self.pending.get(fingerprint)
+        if observation is not None:
+            return observation
+        blob = self.blobs.get(fingerprint)
+        if blob is None:
+            return None
+        observation = self.decompress(blob)
+        with self._lock:
+            self._decompressed[fingerprint] = observation
+            while len(self._decompressed) > self.cache_size:
+                self._decompressed.popitem(last=False)
+        return observation
+
+    def train(self, samples):
+        """
+        Train the dictionary on pages of the environment, and compress the observations kept until then.
+
+        Args:
+            samples (List[str]): Observations of the environment, e.g. of a few episodes.
+        """
+        encoded = [sample.encode() for sample in samples]
+        start = time.perf_counter()
+        if self.codec == ZSTD:
+            import zstandard
+
+            try:
+                dictionary = zstandard.train_dictionary(self.dict_size, encoded).as_bytes()
+            except zstandard.ZstdError:
+                # Too few or too small samples, so they are compressed without a dictionary
+                dictionary = b''
+        else:
+            dictionary = train_zlib_dictionary(encoded, self.dict_size)
+        self.stats['train_seconds'] += time.perf_counter() - start
+        with self._lock:
+            self.dictionary = dictionary
+            self._local = threading.local()
+        # Observations stay readable while they move from pending to compressed
+        for fingerprint, observation in list(self.pending.items()):
+            blob = self.compress(observation)
+            self.stats['stored_bytes'] += len(blob)
+            self.blobs[fingerprint] = blob
+            del self.pending[fingerprint]
+
+    def compress(self, observation):
+        """
+        Compress an observation with the dictionary.
+
+        Returns:
+            bytes: The compressed observation.
+        """
+        start = time.perf_counter()
+        data = observation.encode()
+        if self.codec == ZSTD:
+            blob = self._zstd().compress(data)
+        else:
+            compressor = zlib.compressobj(self.level, zdict=self.dictionary) if self.dictionary else zlib.compressobj(self.level)
+            blob = compressor.compress(data) + compressor.flush()
+        self.stats['compress_seconds'] += time.perf_counter() - start
+        return blob
+
+    def decompress(self, blob):
+        """
+        Decompress an observation compressed with `compress`.
+
+        Returns:
+            str: The observation.
+        """
+        start = time.perf_counter()
+        if self.codec == ZSTD:
+            data = self._zstd(decompress=True).decompress(blob)
+        else:
+            decompressor = zlib.decompressobj(zdict=self.dictionary) if self.dictionary else zlib.decompressobj()
+            data = decompressor.decompress(blob) + decompressor.flush()
+        self.stats['decompress_seconds'] += time.perf_counter() - start
+        self.stats['decompressions'] += 1
+        return data.decode()
+
+    def _zstd(self, decompress=False):
+        import zstandard
+
+        name = 'decompressor' if decompress else 'compressor'
+        codec = getattr(self._local, name, None)
+        if codec is None:
+            dictionary = zstandard.ZstdCompressionDict(self.dictionary) if self.dictionary else None
+            if decompress:
+                codec = zstandard.ZstdDecompressor(dict_data=dictionary)
+            else:
+                codec = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
+            setattr(self._local, name, codec)
+        return codec
+
+    def summary(self):
+        """
+        Get counts of stored observations and bytes, and the time spent compressing and decompressing.
+        """
+        stats = dict(self.stats)
+        stored = stats.get('stored_bytes', 0) + sum(len(observation.encode()) for observation in self.pending.values())
+        stats['bytes_per_observation'] = stored / len(self) if len(self) else 0.0
+        stats['dictionary_bytes'] = len(self.dictionary or b'')
+        stats['codec'] = self.codec
+        return stats
+
+    def save(self, path):
+        """
+        Write the dictionary and the stored observations to a file, e.g. next to a trajectory log.
+        The file is a JSON header (codec, dictionary and blob sizes) followed by the dictionary and the blobs.
+        """
+        if self.pending:
+            self.train(list(self.pending.values()))
+        fingerprints = list(self.blobs)
+        header = json.dumps({
+            'codec': self.codec,
+            'level': self.level,
+            'dictionary': len(self.dictionary or b''),
+            'blobs': [[fingerprint, len(self.blobs[fingerprint])] for fingerprint in fingerprints],
+        }).encode()
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(len(header).to_bytes(8, 'little'))
+            f.write(header)
+            f.write(self.dictionary or b'')
+            for fingerprint in fingerprints:
+                f.write(self.blobs[fingerprint])
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a store written with `save`. Observations stay compressed until they are read.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        header_length = int.from_bytes(data[:8], 'little')
+        header = json.loads(data[8:8 + header_length])
+        store = cls(codec=header['codec'], level=header['level'], train_after=None)
+        offset = 8 + header_length
+        store.dictionary = data[offset:offset + header['dictionary']]
+        offset += header['dictionary']
+        for fingerprint, length in header['blobs']:
+            store.blobs[fingerprint] = data[offset:offset + length]
+            offset += length
+        return store
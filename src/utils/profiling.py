@@ -0,0 +1,217 @@
+"""
+Opt-in profiling of the CPU time spent inside the guardrail itself, apart from waiting on the LM.
+
+When enabled, each stage of a safety check is timed, the whole run is profiled with cProfile,
+and the stacks of all threads are sampled to produce collapsed stacks for flame graphs
+(e.g. with flamegraph.pl or speedscope). When disabled, the hooks cost one attribute check.
+
+Enable it with `--profile DIR`, or by setting the SAFETY_PROFILE_DIR environment variable.
+"""
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+profile_dir_env_var = 'SAFETY_PROFILE_DIR'
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class _StageTimer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.start_cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler._add_stage(self.name, time.perf_counter() - self.start, time.thread_time() - self.start_cpu)
+        return False
+
+
+class _LMTimer(_StageTimer):
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.profiler._add_stage(self.name, elapsed, time.thread_time() - self.start_cpu)
+        local = self.profiler._local
+        local.lm_time = getattr(local, 'lm_time', 0.0) + elapsed
+        return False
+
+
+class _StepTimer(_StageTimer):
+    def __enter__(self):
+        self.profiler._local.lm_time = 0.0
+        return super().__enter__()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.profiler._add_stage(self.name, elapsed, time.thread_time() - self.start_cpu)
+        # Time of the step not spent waiting on the LM, in this thread
+        overhead = elapsed - getattr(self.profiler._local, 'lm_time', 0.0)
+        with self.profiler._lock:
+            self.profiler.step_overheads.append(overhead)
+        return False
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.overhead_budget = None  # Seconds of non-LM time per step
+        self.stage_stats = defaultdict(lambda: {'count': 0, 'wall_time': 0.0, 'cpu_time': 0.0})
+        self.step_overheads = []
+        self.samples = Counter()  # Collapsed stack -> number of samples
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profile = None
+        self._sampler = None
+
+    def start(self, sample_interval=0.002, overhead_budget=None):
+        """
+        Start profiling.
+
+        Args:
+            sample_interval (float): Seconds between two samples of the stacks of all threads.
+            overhead_budget (float): Budget of non-LM time per step in seconds, to report steps over it.
+        """
+        self.enabled = True
+        self.overhead_budget = overhead_budget
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        self._sampler = threading.Thread(target=self._sample, args=(sample_interval,), name='profiler_sampler', daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        """
+        Stop profiling. Timings collected so far are kept.
+        """
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._profile.disable()
+        self._sampler.join()
+
+    def stage(self, name):
+        """
+        Time a stage of a safety check. Use as a context manager.
+        """
+        if not self.enabled:
+            return _null_timer
+        return _StageTimer(self, name)
+
+    def lm_call(self):
+        """
+        Time a call to the LM, which is excluded from the overhead of the step it is part of.
+        """
+        if not self.enabled:
+            return _null_timer
+        return _LMTimer(self, 'lm')
+
+    def step(self):
+        """
+        Time a whole safety check, to measure its overhead outside of LM calls made from the same thread.
+        """
+        if not self.enabled:
+            return _null_timer
+        return _StepTimer(self, 'step')
+
+    def _add_stage(self, name, wall_time, cpu_time):
+        with self._lock:
+            stats = self.stage_stats[name]
+            stats['count'] += 1
+            stats['wall_time'] += wall_time
+            stats['cpu_time'] += cpu_time
+
+    def _sample(self, interval):
+        own_thread = threading.get_ident()
+        thread_names = {}
+        while self.enabled:
+            for thread in threading.enumerate():
+                thread_names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+
+    def summary(self):
+        """
+        Get the timings of each stage and the non-LM overhead per step.
+
+        Returns:
+            dict: The stage timings, and statistics of the overhead per step.
+        """
+        with self._lock:
+            stages = {name: dict(stats) for name, stats in self.stage_stats.items()}
+            overheads = sorted(self.step_overheads)
+        summary = {'stages': stages, 'steps': len(overheads)}
+        if overheads:
+            summary['overhead_mean'] = sum(overheads) / len(overheads)
+            summary['overhead_p95'] = overheads[min(len(overheads) - 1, int(0.95 * len(overheads)))]
+            summary['overhead_max'] = overheads[-1]
+            if self.overhead_budget is not None:
+                summary['overhead_budget'] = self.overhead_budget
+                summary['steps_over_budget'] = sum(overhead > self.overhead_budget for overhead in overheads)
+        return summary
+
+    def dump(self, output_dir):
+        """
+        Write the profile to a directory:
+            - profile.pstats: the cProfile statistics, readable with pstats or snakeviz
+            - stacks.collapsed: the sampled stacks in collapsed format, for flame graphs
+            - stages.json: the summary of stage timings and overhead per step
+
+        Args:
+            output_dir (str): The directory, created if needed.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        if self._profile is not None:
+            self._profile.dump_stats(os.path.join(output_dir, 'profile.pstats'))
+        with open(os.path.join(output_dir, 'stacks.collapsed'), 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(os.path.join(output_dir, 'stages.json'), 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def print_summary(self):
+        summary = self.summary()
+        print("Stage timings (wall / CPU, ms):")
+        for name, stats in sorted(summary['stages'].items(), key=lambda item: -item[1]['wall_time']):
+            print(f"    {name}: {stats['count']} calls, {stats['wall_time'] * 1000:.1f} / {stats['cpu_time'] * 1000:.1f}")
+        if summary['steps']:
+            line = (f"Non-LM overhead per step: mean {summary['overhead_mean'] * 1000:.2f} ms, "
+                    f"p95 {summary['overhead_p95'] * 1000:.2f} ms, max {summary['overhead_max'] * 1000:.2f} ms")
+            if 'steps_over_budget' in summary:
+                line += f", {summary['steps_over_budget']}/{summary['steps']} steps over the {summary['overhead_budget'] * 1000:.1f} ms budget"
+            print(line)
+
+
+# Shared by the safety module and the reasoning modules
+profiler = Profiler()
+
+
+def get_profile_dir(profile_dir=None):
+    """
+    Get the directory to write the profile to, from the argument or the environment. None if profiling is off.
+    """
+    return profile_dir or os.environ.get(profile_dir_env_var) or None